@@ -4,7 +4,145 @@ import numpy as np
 from tensorpack import *
 from tensorpack.utils.utils import get_rng
 
-from sklearn.neighbors import KDTree
+from scipy.spatial import cKDTree
+import timeit
+
+
+def knn_query(points, k):
+    """Builds a KD-tree and queries the k nearest neighbors of all its points on all cores.
+
+    Args:
+        points: point cloud of shape [N, D]
+        k: neighborhood size
+
+    Returns:
+        distances of shape [N, k] and neighbor indices of shape [N, k]
+    """
+    kdt = cKDTree(points, leafsize=16)
+    try:
+        dist, neighborhood = kdt.query(points, k=k, workers=-1)
+    except TypeError:
+        # scipy < 1.6
+        dist, neighborhood = kdt.query(points, k=k, n_jobs=-1)
+    if k == 1:
+        dist, neighborhood = dist[:, None], neighborhood[:, None]
+    return dist, neighborhood
+
+
+def sampling_keys(weights, rng):
+    """Keys of weighted random sampling without replacement (Efraimidis, Spirakis).
+
+    Sorting by key in descending order gives a weighted sample without replacement.
+    Computed in log space as log(u) / w, which has the same order as u^(1 / w).
+
+    Args:
+        weights: non-negative weights of shape [N]
+        rng: numpy RandomState
+
+    Returns:
+        keys of shape [N]
+    """
+    return np.log(rng.random_sample(len(weights))) / np.maximum(weights, 1e-12)
+
+
+def top_keys(keys, k):
+    """Indices of the k largest keys in descending order of their keys.
+
+    Args:
+        keys: keys of shape [N] from sampling_keys
+        k: number of samples
+
+    Returns:
+        indices of shape [k], uint32
+    """
+    idxs = np.argpartition(-keys, k - 1)[:k]
+    return idxs[np.argsort(-keys[idxs])].astype(np.uint32)
+
+
+def compute_levels(location, feature, sample_sizes, neighborhood_sizes, rng,
+                   global_density=False, time_dataflow=False):
+    """Density weighted subsampling of a point cloud into several levels with neighborhoods.
+
+    Args:
+        location: point cloud of shape [N, D]
+        feature: features of shape [N, C]
+        sample_sizes: number of points per level
+        neighborhood_sizes: neighborhood size per level
+        rng: numpy RandomState
+        global_density: define density only on first level
+
+    Returns:
+        list of [location, feature, weights, neighborhood_idx, subsample_idxs] per level.
+        weights are omitted for the first level if it keeps all N points
+    """
+    current_location = location
+    current_feature = feature
+
+    ret = []
+    # B, Dp, N = location.shape
+    N = len(current_location)
+    assert sample_sizes[0] <= N
+
+    if time_dataflow:
+        start_time = timeit.default_timer()
+
+    current_dist, current_neighborhood = knn_query(
+        current_location, neighborhood_sizes[0])
+
+    if time_dataflow:
+        elapsed = timeit.default_timer() - start_time
+        print('kdt build and query: elapsed: ', elapsed)
+
+    startIdx = 0
+    if N == sample_sizes[0]:
+
+        ret += [
+            current_location, current_feature,
+            current_neighborhood.astype(np.uint32),
+            np.arange(len(current_location), dtype=np.uint32)
+        ]
+        startIdx = 1
+
+    keys = None
+    for i, [sample_size, current_k] in enumerate(
+            list(zip(sample_sizes,
+                     neighborhood_sizes))[startIdx:]):
+
+        if time_dataflow:
+            start_time = timeit.default_timer()
+
+        density = np.sum(current_dist, 1)
+        density /= density.sum()
+        weights = density
+
+        if keys is None or not global_density:
+            keys = sampling_keys(density, rng)
+        # With global density the keys of the surviving points are reused,
+        # so every level is a prefix of the previous one
+        idxs = top_keys(keys, sample_size)
+        keys = keys[idxs]
+
+        if time_dataflow:
+            elapsed = timeit.default_timer() - start_time
+            print('sampling: elapsed: ', elapsed)
+
+        current_location = current_location[idxs]
+        current_feature = current_feature[idxs]
+
+        if global_density:
+            _, current_neighborhood = knn_query(current_location, current_k)
+            current_dist = current_dist[idxs]
+        else:
+            current_dist, current_neighborhood = knn_query(
+                current_location, current_k)
+
+        ret += [
+            current_location, current_feature,
+            weights,
+            current_neighborhood.astype(np.uint32), idxs
+        ]
+
+    return ret
 
 
 class WRSDataFlow(RNGDataFlow):
@@ -67,7 +205,7 @@ class WRSDataFlow(RNGDataFlow):
                 - radii
         """
 
-        super(NeighborhoodDensitySubSample, self).__init__()
+        super(WRSDataFlow, self).__init__()
         if sample_sizes is not None:
             if type(neighborhood_sizes) is list:
                 assert len(sample_sizes) == len(neighborhood_sizes)
@@ -108,149 +246,11 @@ class WRSDataFlow(RNGDataFlow):
                 dp)
             location = np.transpose(location[0])
             feature = np.transpose(feature[0])
-            num_elements = location.shape[0]
-            idxs = list(range(num_elements))
-
-            current_location = location
-            current_feature = feature
-
-            cum_density = None
-
-            ret = []
-            # B, Dp, N = location.shape
-            N = len(current_location)
-            assert self.sample_sizes[0] <= N
-
-            if self.time_dataflow:
-                start_time = timeit.default_timer()
-
-            kdt = KDTree(current_location, leaf_size=16, metric='euclidean')
-
-            if self.time_dataflow:
-                elapsed = timeit.default_timer() - start_time
-                print('kdt build: elapsed: ', elapsed)
-
-                start_time = timeit.default_timer()
-
-            # print('DensityNN query %i from %i' % (self.neighborhood_sizes[0], location.shape[0]))
-
-            current_dist, current_neighborhood = kdt.query(
-                current_location,
-                k=self.neighborhood_sizes[0],
-                dualtree=False,
-                return_distance=True)
-
-            if self.time_dataflow:
-                elapsed = timeit.default_timer() - start_time
-                print('kdt query: elapsed: ', elapsed)
-
-            startIdx = 0
-            if N == self.sample_sizes[0]:
-
-                ret += [
-                    current_location, current_feature,
-                    current_neighborhood.astype(np.uint32),
-                    np.arange(len(current_location), dtype=np.uint32)
-                ]
-                startIdx = 1
-
-            # TODO: itertools.izip (python2)
-            for i, [sample_size, current_k] in enumerate(
-                    zip(self.sample_sizes,
-                        self.neighborhood_sizes)[startIdx:]):
-
-                #                     print i, sample_size, current_k
-
-                if self.time_dataflow:
-                    start_time = timeit.default_timer()
-
-                density = np.sum(current_dist, 1)
-                density /= density.sum()
-                weights = density
-                # cum_density = np.cumsum(density)
-                # cum_density /= cum_density[-1]
-
-                # print('cum_density.max(): ', cum_density.max())
-
-                # print 'cum_density: ', cum_density
-
-                subN = sample_size
-
-                # bins = np.linspace(0, 1, self.sample_resolution)
-                # inverse = np.digitize(bins, cum_density, right=True)
-
-                idxs = []
-                while (len(idxs) < subN):
-                    # samples = self.rng.random_sample(2 * subN)
-                    # idx = [[
-                    #     np.argwhere(cum_density == min(cum_density[(
-                    #         cum_density - s) > 0]))
-                    # ] for s in samples]
-                    # idx = np.unique(idx).tolist()
-                    # idxs = np.unique(np.concatenate([idxs, idx]))
-                    #             print len(idxs)
-
-                    if self.time_dataflow:
-                        start_time = timeit.default_timer()
-
-                    # bins = np.linspace(0, 1, self.sample_resolution)
-                    # inverse = np.digitize(bins, cum_density, right=True)
-                    # print 'inverse: ', inverse
-                    # samples = self.rng.randint(0, self.sample_resolution,
-                    #                            2 * subN)
-
-                    idx = self.rng.choice(
-                        np.arange(len(density)), 2 * subN, p=density)
-
-                    # print 'samples: ', samples
-
-                    # idx = inverse[samples]
-
-                    idxs = np.concatenate([idxs, idx])
-
-                    unique_indexes = np.unique(idxs, return_index=True)[1]
-                    idxs = [idxs[i] for i in sorted(unique_indexes)]
-
-                    if self.time_dataflow:
-                        elapsed = timeit.default_timer() - start_time
-                        print('sampling: elapsed: ', elapsed)
-                        print('len(idxs): ', len(idxs), ' N: ', subN)
-
-                idxs = np.asarray(idxs[:subN], dtype=np.uint32)
-
-                current_location = current_location[idxs]
-                current_feature = current_feature[idxs]
-
-                kdt = KDTree(
-                    current_location, leaf_size=16, metric='euclidean')
-
-                if self.global_density:
-                    current_neighborhood = kdt.query(
-                        current_location,
-                        k=current_k,
-                        dualtree=False,
-                        return_distance=False)
-
-                    current_dist = current_dist[idxs]
-                else:
-                    current_dist, current_neighborhood = kdt.query(
-                        current_location,
-                        k=current_k,
-                        dualtree=False,
-                        return_distance=True)
-
-                # locations.append(current_location)
-                # neighborhoods.append(current_neighborhood)
-                # features.append(current_feature)
-                # idxs_list.append(idxs)
-
-                ret += [
-                    current_location, current_feature,
-                    weights,
-                    current_neighborhood.astype(np.uint32), idxs
-                ]
 
-                yield ret
+            yield compute_levels(location, feature, self.sample_sizes,
+                                 self.neighborhood_sizes, self.rng,
+                                 global_density=self.global_density,
+                                 time_dataflow=self.time_dataflow)
 
     def wrs_downsample_ids(survive_pobability, coarse_resolution):
         '''
@@ -1,18 +1,27 @@
 import os
 import multiprocessing
+import cPickle as pickle
 
+import lmdb
 import tensorflow as tf
 from tensorpack.dataflow import (
-    PrintData, BatchData, PrefetchDataZMQ, TestDataSpeed, MapData, JoinData)
+    PrintData, BatchData, PrefetchDataZMQ, TestDataSpeed, MapData, JoinData,
+    DataFlow, RNGDataFlow, ProxyDataFlow)
+from tensorpack.callbacks import Callback
 from tensorpack.utils import logger
+from tensorpack.utils.utils import get_rng
+from tensorpack.utils.serialize import loads
 from tensorpack.dataflow.serialize import LMDBSerializer
 from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
 
 import numpy as np
 
 import random as rnd
 
 from sampler import *
+from pointcloud_shards import ShardData
+from shared_prefetch import SharedMemoryPrefetchData
 
 ############################################
 # Important! Set path to .lmdb data:
@@ -80,12 +89,178 @@ def get_allowed_categories(version):
     return 0
 
 
-def prepare_df(df, parallel, prefetch_data, batch_size):
+def _open_lmdb(path):
+    return lmdb.open(path, subdir=os.path.isdir(path), readonly=True,
+                     lock=False, readahead=True, map_size=1099511627776 * 2,
+                     max_readers=100)
+
+
+def build_category_index(path, force=False):
+    """
+    Builds the sidecar category index of an lmdb file written by LMDBSerializer.
+    The index maps each category id to the list of record keys with that label
+    and is stored next to the lmdb file as <path>.catidx.
+    It is only rebuilt if it is missing, older than the lmdb file or force=True.
+
+    :param path: Path to the lmdb file
+    :param force: Rebuild the index even if an up to date one exists
+    :return: dict {category id: [record keys]}
+    """
+    index_path = path + ".catidx"
+    if not force and os.path.isfile(index_path) and \
+            os.path.getmtime(index_path) >= os.path.getmtime(path):
+        with open(index_path, 'rb') as f:
+            return pickle.load(f)
+
+    logger.info("Building category index for " + path)
+    index = {}
+    env = _open_lmdb(path)
+    with env.begin(write=False) as txn:
+        for key, value in txn.cursor():
+            if key == b'__keys__':
+                continue
+            index.setdefault(int(loads(value)[0]), []).append(key)
+    env.close()
+
+    # Write to a temporary file first so concurrent readers never see a partial index
+    tmp_path = index_path + ".tmp" + str(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, index_path)
+    return index
+
+
+class LMDBCategoryData(RNGDataFlow):
+    """
+    Reads only the records of the given categories from an lmdb file written by LMDBSerializer.
+    Record keys are looked up in the sidecar category index, so records of other categories
+    are never read or deserialized.
+    Produces datapoints [label, positions, normals] split from the stored [label, array(3 or 6, N)]
+    records, in lmdb order or shuffled over the index.
+    """
+
+    def __init__(self, path, categories, shuffle=False):
+        """
+        :param path: Path to the lmdb file
+        :param categories: List of category ids to read
+        :param shuffle: Wether to shuffle the selected keys every epoch
+        """
+        self._path = path
+        self._shuffle = shuffle
+        index = build_category_index(path)
+        # Sorted keys keep unshuffled reads sequential on disk
+        self.keys = sorted(k for c in categories for k in index.get(c, []))
+        logger.info("Selected " + str(len(self.keys)) +
+                    " records of categories " + str(categories))
+
+    def reset_state(self):
+        super(LMDBCategoryData, self).reset_state()
+        self._lmdb = _open_lmdb(self._path)
+        self._txn = self._lmdb.begin()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _split(self, value):
+        label, data = loads(value)
+        return [label, data[:3], data[3:]]
+
+    def get(self, idx):
+        """
+        Random access to the idx-th selected record. Safe to call from several threads.
+        """
+        with self._lmdb.begin() as txn:
+            return self._split(txn.get(self.keys[idx]))
+
+    def __iter__(self):
+        keys = list(self.keys)
+        if self._shuffle:
+            self.rng.shuffle(keys)
+        for k in keys:
+            yield self._split(self._txn.get(k))
+
+
+class ShardedRecordData(DataFlow):
+    """
+    Iterates a deterministic shard of a record store supporting random access with get(i),
+    e.g. LMDBCategoryData or ShardData.
+    In every epoch all records are ordered by a permutation derived from seed and the epoch number
+    (or kept in order if shuffle=False) and every num_shards-th record starting at shard_index is read.
+    All shards of an epoch are disjoint, have the same length and together cover the records up to
+    less than num_shards left over ones, so several training processes can split an epoch.
+
+    When the dataflow is copied into num_workers prefetch processes, each worker reads a disjoint
+    part of the shard, so the workers together still read the shard exactly once per epoch.
+    """
+
+    def __init__(self, records, shard_index=0, num_shards=1, shuffle=False, seed=0, num_workers=1):
+        """
+        :param records: Record store with get(i) and len()
+        :param shard_index: Index of the shard to read. In [0, num_shards)
+        :param num_shards: Number of shards the records are split into
+        :param shuffle: Wether to permute the records every epoch
+        :param seed: Seed of the permutations. Needs to be the same for all shards
+        :param num_workers: Number of prefetch processes iterating copies of this dataflow
+        """
+        assert 0 <= shard_index < num_shards
+        assert num_workers > 0
+        self.records = records
+        self.shard_index = shard_index
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_workers = num_workers
+        self.epoch = 0
+        # Shared across forks, hands out worker ids in reset_state
+        self._worker_counter = multiprocessing.Value('i', 0)
+        self._worker = 0
+
+    def reset_state(self):
+        self.records.reset_state()
+        with self._worker_counter.get_lock():
+            self._worker = self._worker_counter.value % self.num_workers
+            self._worker_counter.value += 1
+
+    def __len__(self):
+        # Length of the whole shard, which is what all workers produce per epoch together
+        return len(self.records) // self.num_shards
+
+    def __iter__(self):
+        num_records = len(self) * self.num_shards
+        if self.shuffle:
+            order = np.random.RandomState(
+                (self.seed + self.epoch) % 2**32).permutation(len(self.records))
+        else:
+            order = np.arange(len(self.records))
+        self.epoch += 1
+        shard = order[:num_records][self.shard_index::self.num_shards]
+        for idx in shard[self._worker::self.num_workers]:
+            yield self.records.get(idx)
+
+
+def prepare_df(df, parallel, prefetch_data, batch_size, prefetch_mode="zmq", shapes=None, buckets=None):
+    """
+    Prefetches and batches a dataflow.
+    With prefetch_mode="zmq" datapoints are sent through PrefetchDataZMQ and batched afterwards.
+    With prefetch_mode="shm" datapoints are batched inside the workers and moved through
+    SharedMemoryPrefetchData, which needs the fixed shapes of the unbatched datapoint components.
+    If buckets are given, datapoints of varying size are batched with PaddedBatchData.
+    """
+    assert prefetch_mode in ["zmq", "shm"]
+    assert buckets is None or prefetch_mode == "zmq", "Padded batches have no fixed shape"
     if parallel < 16:
         logger.warn(
             "DataFlow may become the bottleneck when too few processes are used.")
+    if prefetch_data and prefetch_mode == "shm":
+        assert shapes is not None
+        if batch_size > 1:
+            df = BatchData(df, batch_size)
+            shapes = [(batch_size,) + tuple(shape) for shape in shapes]
+        return SharedMemoryPrefetchData(df, parallel, shapes)
     if prefetch_data:
         df = PrefetchDataZMQ(df, parallel)
+    if buckets is not None:
+        return PaddedBatchData(df, batch_size, buckets)
     if batch_size == 1:
         logger.warn("Batch size is 1. Data will not be batched.")
         return df
@@ -93,15 +268,475 @@ def prepare_df(df, parallel, prefetch_data, batch_size):
     return df
 
 
-def random_downsample(positions, factor):
-    rnd_idx = np.random.randint(positions.shape[1], size=factor)
-    return positions[:, rnd_idx]
+# Padded input points are moved here, far away from the normalized clouds
+PAD_POSITION = 1000.0
+
 
+def pad_points(points, size, fill=None):
+    """
+    Pads a point cloud of shape [C, n] to [C, size].
+    With fill None its points are repeated cyclically. Otherwise the padded points are set to fill,
+    which keeps them out of the neighborhoods of real points when fill is far away, e.g. PAD_POSITION.
+    A repeated point would lie at distance 0 to its original and take one of its K neighbor slots.
 
-def wrs_sample(positions, factor, sess):
+    :return: Padded point cloud of shape [C, size] and validity mask of shape [size], float32
+    """
+    n = points.shape[1]
+    assert 0 < n <= size
+    mask = (np.arange(size) < n).astype(np.float32)
+    if fill is None:
+        return points[:, np.arange(size) % n], mask
+    padded = np.full([points.shape[0], size], fill, dtype=np.float32)
+    padded[:, :n] = points
+    return padded, mask
+
+
+class PaddedBatchData(ProxyDataFlow):
+    """
+    Batches datapoints [positions, vertex_normals, gt_positions] of varying point counts.
+    Every sample is put into the smallest bucket holding its number of input points and padded to
+    the bucket size with points at PAD_POSITION, so they do not enter the neighborhoods of real points.
+    A bucket is emitted as batch once it holds batch_size samples.
+    Ground truth is padded to the largest ground truth of the batch by repeating its points,
+    the losses mask them out.
+    Samples with more input points than the largest bucket are randomly subsampled to it.
+
+    Produces [positions [B, 3, S], vertex_normals [B, C, M], gt_positions [B, 3, M],
+    positions_mask [B, S], gt_mask [B, M]] where masks are 1 for real and 0 for padded points.
+    """
+
+    def __init__(self, ds, batch_size, buckets, remainder=False):
+        """
+        :param ds: Incoming dataflow of [positions, vertex_normals, gt_positions] of shapes [3, n], [C, m], [3, m]
+        :param batch_size: Number of samples per batch
+        :param buckets: List of padded point counts
+        :param remainder: Wether to emit not completely filled buckets at the end of each epoch
+        """
+        super(PaddedBatchData, self).__init__(ds)
+        assert batch_size > 0
+        self.batch_size = batch_size
+        self.buckets = sorted(buckets)
+        self.remainder = remainder
+
+    def reset_state(self):
+        super(PaddedBatchData, self).reset_state()
+        self.rng = get_rng(self)
+
+    def __len__(self):
+        # Approximate, samples may stay in partially filled buckets
+        return len(self.ds) // self.batch_size
+
+    def _batch(self, samples, size):
+        gt_size = max(dp[2].shape[1] for dp in samples)
+        positions, positions_mask = zip(*[pad_points(dp[0], size, PAD_POSITION) for dp in samples])
+        gt_positions, gt_mask = zip(*[pad_points(dp[2], gt_size) for dp in samples])
+        vertex_normals = [pad_points(dp[1], gt_size)[0] if len(dp[1]) else
+                          np.empty([0, gt_size], dtype=np.float32) for dp in samples]
+        return [np.asarray(x, dtype=np.float32) for x in
+                [positions, vertex_normals, gt_positions, positions_mask, gt_mask]]
+
+    def __iter__(self):
+        holders = dict((size, []) for size in self.buckets)
+        for dp in self.ds:
+            positions = dp[0]
+            if positions.shape[1] > self.buckets[-1]:
+                positions = random_downsample(positions, self.buckets[-1], rng=self.rng)
+            size = next(b for b in self.buckets if b >= positions.shape[1])
+            holders[size].append([positions, dp[1], dp[2]])
+            if len(holders[size]) == self.batch_size:
+                yield self._batch(holders[size], size)
+                holders[size] = []
+        if self.remainder:
+            for size in self.buckets:
+                if holders[size]:
+                    yield self._batch(holders[size], size)
+
+
+def first_downsample(positions, factor, rng=None):
     return positions[:, 0:factor]
 
 
+def random_downsample(positions, factor, rng=np.random):
+    # Without replacement, duplicates would crowd the neighborhoods of their originals
+    rnd_idx = rng.choice(positions.shape[1], factor, replace=factor > positions.shape[1])
+    return positions[:, rnd_idx]
+
+
+def wrs_downsample(positions, factor, rng=np.random, K=8):
+    """
+    Density aware weighted reservoir sampling without replacement.
+    CPU counterpart of sampler.wrs_downsample_ids: every point is weighted by the summed distance
+    to its K nearest neighbors, so points in sparse regions are more likely to survive.
+    The factor points with the largest keys u^(1 / weight) are kept, computed in log space.
+
+    :param positions: Point cloud of shape [3, N]
+    :param factor: Number of points to keep
+    :param rng: numpy RandomState
+    :param K: Neighborhood size of the density estimate
+    :return: Subsampled point cloud of shape [3, factor]
+    """
+    N = positions.shape[1]
+    if factor >= N:
+        return positions[:, 0:factor]
+    points = positions.T
+    # First neighbor is the point itself with distance 0
+    dist, _ = cKDTree(points).query(points, k=K + 1)
+    density = dist.sum(axis=1)
+    density /= density.sum()
+    keys = np.log(rng.random_sample(N)) / np.maximum(density, 1e-12)
+    idx = np.argpartition(-keys, factor - 1)[:factor]
+    return positions[:, idx]
+
+
+def voxel_downsample(positions, factor, rng=np.random):
+    """
+    Voxel grid subsampling. The grid resolution is doubled until at least factor voxels are occupied,
+    one point is kept per occupied voxel and factor of those are drawn at random.
+    If too few voxels can be occupied, e.g. due to duplicate points, the rest is filled with random points.
+
+    :param positions: Point cloud of shape [3, N]
+    :param factor: Number of points to keep
+    :param rng: numpy RandomState
+    :return: Subsampled point cloud of shape [3, factor]
+    """
+    N = positions.shape[1]
+    if factor >= N:
+        return positions[:, 0:factor]
+    lower = positions.min(axis=1, keepdims=True)
+    extent = max(float((positions.max(axis=1, keepdims=True) - lower).max()), 1e-12)
+    resolution = max(1, int(np.ceil(factor ** (1 / 3.))))
+    while True:
+        cells = np.floor((positions - lower) / extent * resolution).astype(np.int64)
+        cells = np.minimum(cells, resolution - 1)
+        keys = (cells[0] * resolution + cells[1]) * resolution + cells[2]
+        _, idx = np.unique(keys, return_index=True)
+        if len(idx) >= factor or resolution >= 1024:
+            break
+        resolution *= 2
+    if len(idx) >= factor:
+        idx = rng.choice(idx, factor, replace=False)
+    else:
+        rest = np.setdiff1d(np.arange(N), idx)
+        idx = np.concatenate([idx, rng.choice(rest, factor - len(idx), replace=False)])
+    return positions[:, idx]
+
+
+SAMPLING_METHODS = {
+    "first": first_downsample,
+    "random": random_downsample,
+    "wrs": wrs_downsample,
+    "voxel": voxel_downsample
+}
+
+
+class DownsampleData(ProxyDataFlow):
+    """
+    Subsamples the point cloud of shape [3, N] in component index of each datapoint
+    and appends the subsampled point cloud of shape [3, num_points] as last component.
+    Runs in the dataflow workers with an own rng per worker.
+    """
+
+    def __init__(self, ds, num_points, method="first", index=1):
+        """
+        :param ds: Incoming dataflow
+        :param num_points: Number of points to keep
+        :param method: Sampling method. String in {'first', 'random', 'wrs', 'voxel'}
+        :param index: Component of the datapoint holding the point cloud
+        """
+        super(DownsampleData, self).__init__(ds)
+        assert method in SAMPLING_METHODS
+        self.num_points = num_points
+        self.sample = SAMPLING_METHODS[method]
+        self.index = index
+
+    def reset_state(self):
+        super(DownsampleData, self).reset_state()
+        self.rng = get_rng(self)
+
+    def __iter__(self):
+        for dp in self.ds:
+            yield list(dp) + [self.sample(dp[self.index], self.num_points, rng=self.rng)]
+
+
+def random_indices(positions, factor, rng=np.random):
+    """
+    :return: Indices of factor random points of a point cloud of shape [3, N], in random order
+    """
+    return rng.choice(positions.shape[1], factor, replace=False)
+
+
+def stratified_indices(positions, factor, rng=np.random):
+    """
+    Spatially stratified sampling. Points are ordered by voxel along a grid of about factor occupied voxels,
+    the order is split into factor strata of equal size and one random point is drawn per stratum.
+    The result is randomly permuted, so any prefix is still spread over the whole object.
+
+    :return: Indices of factor points of a point cloud of shape [3, N]
+    """
+    N = positions.shape[1]
+    lo = positions.min(axis=1, keepdims=True)
+    extent = np.maximum(positions.max(axis=1, keepdims=True) - lo, 1e-12)
+    resolution = max(int(np.ceil(factor ** (1.0 / 3))), 1)
+    cells = np.minimum((positions - lo) / extent * resolution, resolution - 1).astype(np.int64)
+    order = np.argsort((cells[0] * resolution + cells[1]) * resolution + cells[2], kind='stable')
+    bounds = (np.arange(factor + 1) * N) // factor
+    idx = order[bounds[:-1] + (rng.random_sample(factor) * (bounds[1:] - bounds[:-1])).astype(np.int64)]
+    return rng.permutation(idx)
+
+
+def farthest_point_indices(positions, factor, rng=np.random):
+    """
+    Farthest point sampling starting from a random point. Costs factor passes over all N points.
+    Every prefix of the result is a farthest point sampling itself.
+
+    :return: Indices of factor points of a point cloud of shape [3, N], in sampling order
+    """
+    N = positions.shape[1]
+    points = positions.T
+    idx = np.empty([factor], dtype=np.int64)
+    idx[0] = rng.randint(N)
+    dist = np.sum((points - points[idx[0]]) ** 2, axis=1)
+    for i in range(1, factor):
+        idx[i] = np.argmax(dist)
+        np.minimum(dist, np.sum((points - points[idx[i]]) ** 2, axis=1), out=dist)
+    return idx
+
+
+GT_SAMPLING_METHODS = {
+    "random": random_indices,
+    "stratified": stratified_indices,
+    "fps": farthest_point_indices
+}
+
+
+class GTDownsampleData(ProxyDataFlow):
+    """
+    Subsamples the ground truth of datapoints [label, positions, normals, ...] to gt_points points.
+    positions and normals are gathered with the same indices. Runs in the dataflow workers.
+    """
+
+    def __init__(self, ds, gt_points, method="random"):
+        """
+        :param ds: Incoming dataflow
+        :param gt_points: Number of ground truth points to keep
+        :param method: Sampling method. String in {'random', 'stratified', 'fps'}
+        """
+        super(GTDownsampleData, self).__init__(ds)
+        assert method in GT_SAMPLING_METHODS
+        self.gt_points = gt_points
+        self.sample = GT_SAMPLING_METHODS[method]
+
+    def reset_state(self):
+        super(GTDownsampleData, self).reset_state()
+        self.rng = get_rng(self)
+
+    def __iter__(self):
+        for dp in self.ds:
+            idx = self.sample(dp[1], self.gt_points, rng=self.rng)
+            yield [dp[0], dp[1][:, idx], dp[2][:, idx]] + list(dp[3:])
+
+
+class GTScheduleData(ProxyDataFlow):
+    """
+    Truncates the ground truth of batches [positions, vertex_normals, gt_positions, ...] to the first
+    gt_points points. Padded batches also get their gt_mask truncated.
+    Runs after batching in the training process, so gt_points can be changed during training,
+    e.g. by GTSizeSchedule. The incoming ground truth needs to be ordered such that its prefixes are
+    good subsamples, as produced by GT_SAMPLING_METHODS.
+    """
+
+    def __init__(self, ds, gt_points):
+        super(GTScheduleData, self).__init__(ds)
+        self.gt_points = gt_points
+
+    def __iter__(self):
+        for dp in self.ds:
+            n = self.gt_points
+            dp = [dp[0], dp[1][..., :n], dp[2][..., :n]] + list(dp[3:])
+            if len(dp) == 5:
+                dp[4] = dp[4][..., :n]
+            yield dp
+
+
+class GTSizeSchedule(Callback):
+    """
+    Sets the number of ground truth points of the GTScheduleData inside a dataflow before every epoch.
+    Batches already prefetched by the input source keep their previous size.
+    """
+
+    def __init__(self, df, schedule):
+        """
+        :param df: Training dataflow containing a GTScheduleData,
+         e.g. from get_modelnet_dataflow with gt_schedule set
+        :param schedule: List of (epoch, gt_points). gt_points is used from that epoch on
+        """
+        while not isinstance(df, GTScheduleData):
+            assert isinstance(df, ProxyDataFlow), "Dataflow contains no GTScheduleData"
+            df = df.ds
+        self.df = df
+        self.schedule = sorted(schedule)
+
+    def _before_epoch(self):
+        gt_points = self.df.gt_points
+        for epoch, size in self.schedule:
+            if self.epoch_num >= epoch:
+                gt_points = size
+        if gt_points != self.df.gt_points:
+            logger.info("Using " + str(gt_points) + " ground truth points")
+            self.df.gt_points = gt_points
+
+
+def _as_batch(component):
+    # [B, C, N] float32 array from either a batch or an unbatched list of one [C, N] array
+    component = np.asarray(component, dtype=np.float32)
+    batch_size = int(np.prod(component.shape[:-2]))
+    return component.reshape((batch_size,) + component.shape[-2:])
+
+
+def augment_batch(positions, vertex_normals, gt_positions, rng,
+                  noise_level=0.0, rotate=False, scale_level=0.0, dropout_ratio=0.0, up_axis=1):
+    """
+    Augments a whole batch of point clouds at once. All random numbers of the batch are drawn
+    with a single call to rng.
+
+    - rotate: random rotation about up_axis per sample, applied to positions, gt_positions and normals
+    - scale_level: anisotropic scaling by factors in [1 - scale_level, 1 + scale_level] per sample and axis,
+      applied to positions and gt_positions, normals are transformed accordingly and renormalized
+    - dropout_ratio: per sample a ratio in [0, dropout_ratio] of input points is replaced by the first point
+    - noise_level: uniform jitter in [-noise_level, noise_level] on the input positions
+
+    :param positions: Input point clouds of shape [B, 3, N], float32. Not modified
+    :param vertex_normals: Normals of shape [B, 3, M] or [B, 0, M], float32
+    :param gt_positions: Ground truth point clouds of shape [B, 3, M], float32
+    :param rng: numpy RandomState
+    :return: [positions, vertex_normals, gt_positions]
+    """
+    B, _, N = positions.shape
+    sizes = [B if rotate else 0,
+             3 * B if scale_level > 0 else 0,
+             B if dropout_ratio > 0 else 0,
+             B * N if dropout_ratio > 0 else 0,
+             3 * B * N if noise_level > 0 else 0]
+    draws = np.split(rng.random_sample(sum(sizes)).astype(np.float32),
+                     np.cumsum(sizes)[:-1])
+
+    if rotate or scale_level > 0:
+        transform = np.tile(np.eye(3, dtype=np.float32), (B, 1, 1))
+        normal_transform = transform.copy()
+        if rotate:
+            angle = draws[0] * np.float32(2 * np.pi)
+            i, j = [a for a in range(3) if a != up_axis]
+            transform[:, i, i] = np.cos(angle)
+            transform[:, i, j] = -np.sin(angle)
+            transform[:, j, i] = np.sin(angle)
+            transform[:, j, j] = np.cos(angle)
+            normal_transform[:] = transform
+        if scale_level > 0:
+            scale = draws[1].reshape(B, 3)
+            scale *= 2 * scale_level
+            scale += 1 - scale_level
+            transform *= scale[:, :, None]
+            # Normals transform with the inverse transpose, which is S^-1 R for rotation R
+            normal_transform /= scale[:, :, None]
+        positions = np.matmul(transform, positions)
+        gt_positions = np.matmul(transform, gt_positions)
+        if vertex_normals.shape[1] == 3:
+            vertex_normals = np.matmul(normal_transform, vertex_normals)
+            vertex_normals /= np.maximum(
+                np.linalg.norm(vertex_normals, axis=1, keepdims=True), 1e-12)
+
+    if (dropout_ratio > 0 or noise_level > 0) and not (rotate or scale_level > 0):
+        # The inputs may be views of upstream data, e.g. of gt_positions, read-only shards
+        # or prefetch buffers, so dropout and jitter work on a copy
+        positions = np.array(positions, dtype=np.float32, copy=True)
+
+    if dropout_ratio > 0:
+        ratio = draws[2] * dropout_ratio
+        dropped = draws[3].reshape(B, N) < ratio[:, None]
+        np.copyto(positions, positions[:, :, :1], where=dropped[:, None, :])
+
+    if noise_level > 0:
+        noise = draws[4].reshape(B, 3, N)
+        noise *= 2 * noise_level
+        noise -= noise_level
+        positions += noise
+
+    return [positions, vertex_normals, gt_positions]
+
+
+class BatchAugmentData(ProxyDataFlow):
+    """
+    Augments datapoints [positions, vertex_normals, gt_positions, ...] of whole batches with augment_batch.
+    Components are converted to float32 arrays of shape [B, C, N], which also holds for unbatched
+    datapoints with batch size 1.
+    """
+
+    def __init__(self, ds, noise_level=0.0, rotate=False, scale_level=0.0, dropout_ratio=0.0, up_axis=1):
+        """
+        :param ds: Incoming (batched) dataflow
+        :param noise_level: Amplitude of uniform jitter on input positions
+        :param rotate: Wether to randomly rotate about up_axis
+        :param scale_level: Maximum deviation of anisotropic scaling factors from 1
+        :param dropout_ratio: Maximum ratio of dropped input points
+        :param up_axis: Axis to rotate about. 0, 1 or 2
+        """
+        super(BatchAugmentData, self).__init__(ds)
+        assert up_axis in [0, 1, 2]
+        self.noise_level = noise_level
+        self.rotate = rotate
+        self.scale_level = scale_level
+        self.dropout_ratio = dropout_ratio
+        self.up_axis = up_axis
+
+    def reset_state(self):
+        super(BatchAugmentData, self).reset_state()
+        self.rng = get_rng(self)
+
+    def __iter__(self):
+        for dp in self.ds:
+            # Further components, e.g. masks of PaddedBatchData, are passed through
+            yield augment_batch(_as_batch(dp[0]), _as_batch(dp[1]), _as_batch(dp[2]), self.rng,
+                                noise_level=self.noise_level,
+                                rotate=self.rotate,
+                                scale_level=self.scale_level,
+                                dropout_ratio=self.dropout_ratio,
+                                up_axis=self.up_axis) + list(dp[3:])
+
+
+def get_modelnet_records(name, model_ver="40", normals=False, shuffle=False, storage="lmdb"):
+    """
+    Returns the record store of the Modelnet data set restricted to the allowed categories.
+    See get_modelnet_dataflow for the file layout.
+    The resulting dataflow produces [label, positions, normals] and supports random access
+    to the i-th record with get(i) after reset_state().
+
+    :param name: Train or test data. String in {'train','test'}
+    :param model_ver: Modelnet version. String in {'10', '40'}
+    :param normals: Wether to read the files including normals
+    :param shuffle: Wether to shuffle records when iterating
+    :param storage: Storage backend to read from. String in {'lmdb', 'shards'}
+    :return: LMDBCategoryData or ShardData object
+    """
+    assert name in ['train', 'test']
+    assert model_ver in ['10', '40']
+    assert storage in ['lmdb', 'shards']
+
+    # Construct correct filename
+    normals_str = ""
+    if not normals:
+        normals_str = "-positions"
+
+    file_name = "model" + model_ver + "-" + name + \
+        normals_str + "-10000." + storage
+    path = os.path.join(MODEL40PATH, file_name)
+
+    allowed_categories = get_allowed_categories("big")
+
+    if storage == "shards":
+        return ShardData(path, allowed_categories, shuffle=shuffle)
+    return LMDBCategoryData(path, allowed_categories, shuffle=shuffle)
+
+
 def get_modelnet_dataflow(
     name, batch_size=6,
     num_points=10000,
@@ -110,7 +745,20 @@ def get_modelnet_dataflow(
     shuffle=False,
     normals=False,
     prefetch_data=False,
-    noise_level=0.00
+    noise_level=0.00,
+    storage="lmdb",
+    sampling="first",
+    rotate=False,
+    scale_level=0.0,
+    dropout_ratio=0.0,
+    prefetch_mode="zmq",
+    shard_index=0,
+    num_shards=1,
+    seed=None,
+    buckets=None,
+    gt_points=None,
+    gt_sampling="random",
+    gt_schedule=None
 ):
     """
     Loads Modelnet40 point cloud data and returns
@@ -124,6 +772,9 @@ def get_modelnet_dataflow(
     The files consist of the following, depending on the filename:
     model{10,40}-{train,test}-{positions-}{1024,10000}.lmdb
 
+    With storage="shards" the same data is read from the memory-mapped shard directory
+    model{10,40}-{train,test}-{positions-}10000.shards written by pointcloud_shards.py
+
     Modelnet generated the point cloud data by sampling many different objects 10000 times thus that many samples are
     available per object. This option of 10000 samples per object is set by default by :param num_points.
     To get faster loading and iteration times, a second option of 1024 is available.
@@ -149,98 +800,83 @@ def get_modelnet_dataflow(
     :param shuffle: Wether to shuffle data or not for data flow
     :param normals: Determines if normals should be included in data or not. Boolean.
     :param prefetch_data: Determines whether to prefetch data with PrefetchDataZMQ or not
+    :param noise_level: Amplitude of uniform jitter added to the input positions
+    :param storage: Storage backend to read from. String in {'lmdb', 'shards'}
+    :param sampling: How num_points samples are drawn from the 10000 stored ones. String in
+     {'first', 'random', 'wrs', 'voxel'}. See DownsampleData
+    :param rotate: Wether to randomly rotate each object about the up axis
+    :param scale_level: Maximum deviation of random anisotropic scaling factors from 1
+    :param dropout_ratio: Maximum ratio of randomly dropped input points per object
+    :param prefetch_mode: How prefetched data is moved from the workers. String in {'zmq', 'shm'}.
+     'shm' passes datapoints through shared memory, see SharedMemoryPrefetchData
+    :param shard_index: Index of the shard of records to read. In [0, num_shards)
+    :param num_shards: Number of disjoint shards every epoch is split into, e.g. one per training process
+    :param seed: Seed of the per epoch record order. If set, or if num_shards > 1, the records are read
+     through ShardedRecordData and the order is reproducible. Needs to be the same for all shards
+    :param buckets: List of point counts. If set, batches are padded to these sizes and carry validity masks,
+     see PaddedBatchData. The model needs PC['masked'] = True
+    :param gt_points: Number of ground truth points per object. All 10000 stored points are used if None.
+     The model needs PC['gt'] = gt_points
+    :param gt_sampling: How gt_points ground truth points are drawn. String in {'random', 'stratified', 'fps'}
+    :param gt_schedule: List of (epoch, gt_points) raising the number of ground truth points during training.
+     Apply it with the callback GTSizeSchedule(df, gt_schedule). The model needs PC['gt'] = None
     :return: Dataflow object
     """
     # Check arguments
     assert batch_size > 0
     assert name in ['train', 'test']
     assert model_ver in ['10', '40']
+    assert storage in ['lmdb', 'shards']
+    assert sampling in SAMPLING_METHODS
+    assert gt_sampling in GT_SAMPLING_METHODS
+    assert gt_schedule is None or gt_points is not None, "gt_schedule needs initial gt_points"
     # Two different data sets exist with either 1024 samples per object or 10000 samples per object.
     # Different amounts of samples can still be used by choosing 10000 samples per object and selecting
     # a subset of them with the disadvantage of slower loading and sampling time.
     #assert num_points in [256, 1024, 7500, 10000]
     assert num_points <= 10000
     
-    # Construct correct filename
-    normals_str = ""
-    if not normals:
-        normals_str = "-positions"
-
-    file_name = "model" + model_ver + "-" + name + \
-        normals_str + "-10000.lmdb"
-    path = os.path.join(MODEL40PATH, file_name)
-
     # Try using multiple processing cores to load data
     if parallel is None:
         parallel = min(40, multiprocessing.cpu_count() // 2)
         logger.info("Using " + str(parallel) + " processing cores")
 
-    allowed_categories = get_allowed_categories("big")
-
-    wrs_session = tf.Session()
-
-    # Construct dataflow object by loading lmdb file
-    df = LMDBSerializer.load(path, shuffle=shuffle)
+    # Records of allowed categories as [label, positions, normals]
+    if num_shards > 1 or seed is not None:
+        records = get_modelnet_records(name, model_ver=model_ver, normals=normals,
+                                       storage=storage)
+        df = ShardedRecordData(records, shard_index=shard_index, num_shards=num_shards,
+                               shuffle=shuffle, seed=seed or 0,
+                               num_workers=parallel if prefetch_data else 1)
+    else:
+        df = get_modelnet_records(name, model_ver=model_ver, normals=normals,
+                                  shuffle=shuffle, storage=storage)
+
+    # Subsample input point cloud, appended as dp[3]
+    df = DownsampleData(df, num_points, method=sampling)
+
+    # Subsample ground truth to the largest size used during training
+    max_gt_points = 10000
+    if gt_points is not None:
+        max_gt_points = max([gt_points] + [size for _, size in gt_schedule or []])
+        df = GTDownsampleData(df, max_gt_points, method=gt_sampling)
 
     # seperate df from labels and seperate into positions and vertex normals
-    df = MapData(df, lambda dp: [[wrs_sample(dp[1][:3], num_points, wrs_session) + (np.random.rand(3, num_points)*2*noise_level - noise_level)], [dp[1][3:]], [dp[1][:3]]]  # , dp[1][:3] + (np.random.rand(3,1024)*0.002 - 0.001)]
-                 if dp[0] in allowed_categories else None)
-    df = prepare_df(df, parallel, prefetch_data, batch_size)
+    df = MapData(df, lambda dp: [dp[3], dp[2], dp[1]])
+    shapes = [(3, num_points), (3 if normals else 0, max_gt_points), (3, max_gt_points)]
+    df = prepare_df(df, parallel, prefetch_data, batch_size,
+                    prefetch_mode=prefetch_mode, shapes=shapes, buckets=buckets)
+    if gt_schedule is not None:
+        df = GTScheduleData(df, gt_points)
+    # Augment whole batches of shape [B, 3, N] at once
+    df = BatchAugmentData(df, noise_level=noise_level, rotate=rotate,
+                          scale_level=scale_level, dropout_ratio=dropout_ratio)
     df.reset_state()
     return df
 
 
 if __name__ == '__main__':
-
-    #sess = tf.Session()
-    points = np.loadtxt(
-        "/graphics/scratch/students/heid/evaluation_set/custom/baptism.xyz", delimiter=' ')
-   
-    points = np.transpose(points)
-    p7500 = random_downsample(points, 7500)
-    p256 = random_downsample(points, 256)
-    p1024 = random_downsample(points, 1024)
-
-    np.savetxt('/home/heid/tmp/bap7500.txt',
-               np.transpose(p7500), delimiter=',', fmt='%1.5f')
-    np.savetxt('/home/heid/tmp/bap1024.txt',
-               np.transpose(p1024), delimiter=',', fmt='%1.5f')
-    np.savetxt('/home/heid/tmp/bap256.txt',
-               np.transpose(p256), delimiter=',', fmt='%1.5f')
-
-    
-    df = get_modelnet_dataflow(
-        'train', batch_size=8, num_points=10000, model_ver="10", normals=False)
-    # Test speed!
-    TestDataSpeed(df, 2000).start()
-
+    # Quick smoke test. Use benchmark_dataflow.py to sweep settings and record results
     df = get_modelnet_dataflow(
         'train', batch_size=8, num_points=1024, model_ver="40", normals=False)
-    # Test speed!
     TestDataSpeed(df, 2000).start()
-
-        num_points=10000,
-    df = get_modelnet_dataflow(
-        'train', batch_size=8, num_points=10000, model_ver="40", normals=False)
-    # Test speed!
-    TestDataSpeed(df, 2000).start()
-
-    df = get_modelnet_dataflow(
-        'train', batch_size=8, num_points=1024, model_ver="10", normals=True)
-    # Test speed!
-    TestDataSpeed(df, 2000).start()
-
-    df = get_modelnet_dataflow(
-        'train', batch_size=8, num_points=10000, model_ver="10", normals=True)
-    # Test speed!
-    TestDataSpeed(df, 2000).start()
-    df = get_modelnet_dataflow(
-        'train', batch_size=8, num_points=1024, model_ver="40", normals=True)
-    # Test speed!
-    TestDataSpeed(df, 2000).start()
-
-    df = get_modelnet_dataflow(
-        'train', batch_size=8, num_points=10000, model_ver="40", normals=True)
-    # Test speed!
-    TestDataSpeed(df, 2000).start()
-    
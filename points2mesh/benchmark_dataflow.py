@@ -0,0 +1,180 @@
+"""
+Throughput benchmark of the training dataflow.
+
+Sweeps every combination of the given settings of get_modelnet_dataflow and reports per configuration
+samples/sec, bytes/sec and the CPU utilization of the dataflow worker processes.
+Each configuration runs in its own process, so its prefetch workers are torn down before the next one starts.
+Each run is appended to a JSON file holding the configuration and measurements of every combination, to compare runs over time.
+
+Example:
+    python benchmark_dataflow.py --num_points 1024,10000 --parallel 4,8,16 --prefetch_mode zmq,shm \
+        --output dataflow_benchmark.json
+"""
+
+import os
+import json
+import time
+import socket
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+from tensorpack.utils import logger
+
+from PointCloudDataFlow import get_modelnet_dataflow, SAMPLING_METHODS
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+    logger.warn("psutil not found, worker CPU utilization will not be reported.")
+
+SWEEP_KEYS = ['num_points', 'parallel', 'batch_size', 'normals', 'storage', 'prefetch_mode']
+
+
+def _cpu_times(processes):
+    times = {}
+    for proc in processes:
+        try:
+            cpu = proc.cpu_times()
+            times[proc.pid] = cpu.user + cpu.system
+        except psutil.NoSuchProcess:
+            pass
+    return times
+
+
+def _forever(df):
+    while True:
+        for dp in df:
+            yield dp
+
+
+def benchmark_config(config, num_batches=200, warmup=20):
+    """
+    Measures the throughput of a single dataflow configuration.
+
+    :param config: Keyword arguments of get_modelnet_dataflow
+    :param num_batches: Number of timed batches
+    :param warmup: Number of batches fetched before timing starts, e.g. to fill the prefetch queues
+    :return: Dict of measurements
+    """
+    df = get_modelnet_dataflow('train', shuffle=True, **config)
+    itr = _forever(df)
+    for _ in range(warmup):
+        next(itr)
+
+    workers = []
+    if psutil is not None:
+        workers = psutil.Process().children(recursive=True)
+        cpu_start = _cpu_times(workers)
+    num_samples = 0
+    num_bytes = 0
+    start = time.time()
+    for _ in range(num_batches):
+        dp = next(itr)
+        num_samples += len(dp[0])
+        num_bytes += sum(np.asarray(c).nbytes for c in dp)
+    elapsed = time.time() - start
+
+    result = {
+        'batches_per_sec': num_batches / elapsed,
+        'samples_per_sec': num_samples / elapsed,
+        'bytes_per_sec': num_bytes / elapsed,
+        'num_workers': len(workers),
+        'worker_cpu': None,
+        'worker_cpu_total': None,
+    }
+    if workers:
+        cpu_end = _cpu_times(workers)
+        # Fraction of one core used by each worker while timing
+        per_worker = [(cpu_end[pid] - cpu_start[pid]) / elapsed
+                      for pid in cpu_start if pid in cpu_end]
+        result['worker_cpu'] = per_worker
+        result['worker_cpu_total'] = sum(per_worker)
+    return result
+
+
+def _run(config, num_batches, warmup, queue):
+    try:
+        queue.put(benchmark_config(config, num_batches=num_batches, warmup=warmup))
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_sweep(sweep, fixed, num_batches=200, warmup=20):
+    """
+    Benchmarks all combinations of the swept settings.
+
+    :param sweep: Dict of get_modelnet_dataflow argument to list of values
+    :param fixed: Dict of get_modelnet_dataflow arguments shared by all configurations
+    :return: List of dicts holding configuration and measurements
+    """
+    keys = sorted(sweep.keys())
+    results = []
+    for values in itertools.product(*[sweep[k] for k in keys]):
+        config = dict(fixed)
+        config.update(zip(keys, values))
+        logger.info("Benchmarking " + json.dumps(config, sort_keys=True))
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=_run, args=(config, num_batches, warmup, queue))
+        proc.start()
+        result = queue.get()
+        proc.join()
+        if 'error' in result:
+            logger.error("Failed: " + result['error'])
+        else:
+            logger.info("%.1f samples/sec, %.1f MB/sec" % (
+                result['samples_per_sec'], result['bytes_per_sec'] / 2 ** 20))
+        result['config'] = config
+        results.append(result)
+    return results
+
+
+def _list(type_):
+    def parse(value):
+        return [type_(v) for v in value.split(',')]
+    return parse
+
+
+def _bool(value):
+    assert value in ['0', '1', 'false', 'true'], "Expected 0, 1, false or true"
+    return value in ['1', 'true']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the dataflow throughput. Comma separated values are swept.')
+    parser.add_argument('--num_points', type=_list(int), default=[1024, 10000])
+    parser.add_argument('--parallel', type=_list(int), default=[multiprocessing.cpu_count()])
+    parser.add_argument('--batch_size', type=_list(int), default=[8])
+    parser.add_argument('--normals', type=_list(_bool), default=[False])
+    parser.add_argument('--storage', type=_list(str), default=['lmdb'])
+    parser.add_argument('--prefetch_mode', type=_list(str), default=['zmq'])
+    parser.add_argument('--model_ver', default='40')
+    parser.add_argument('--sampling', default='first', choices=sorted(SAMPLING_METHODS.keys()))
+    parser.add_argument('--num_batches', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--output', default='dataflow_benchmark.json',
+                        help='JSON file the results are appended to')
+    args = parser.parse_args()
+
+    sweep = dict((k, getattr(args, k)) for k in SWEEP_KEYS)
+    fixed = {'model_ver': args.model_ver, 'sampling': args.sampling}
+    results = run_sweep(sweep, fixed, num_batches=args.num_batches, warmup=args.warmup)
+
+    run = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': socket.gethostname(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'num_batches': args.num_batches,
+        'results': results,
+    }
+    runs = []
+    if os.path.isfile(args.output):
+        with open(args.output, 'r') as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(args.output, 'w') as f:
+        json.dump(runs, f, indent=2, sort_keys=True)
+    logger.info("Wrote " + str(len(results)) + " results to " + args.output)
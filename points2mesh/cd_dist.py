@@ -5,7 +5,19 @@ nn_distance_module = tf.load_op_library('./external/tf_nndistance_so.so')
 
 def nn_distance(xyz1, xyz2):
     '''
-Computes the distance of nearest neighbors for a pair of point clouds
+Computes the distance of nearest neighbors for a single pair of point clouds
+input: xyz1: (#points_1,3)  the first point cloud
+input: xyz2: (#points_2,3)  the second point cloud
+output: as batch_nn_distance with batch_size 1
+    '''
+    xyz1 = tf.expand_dims(xyz1, 0)
+    xyz2 = tf.expand_dims(xyz2, 0)
+    return nn_distance_module.nn_distance(xyz1, xyz2)
+
+
+def batch_nn_distance(xyz1, xyz2):
+    '''
+Computes the distance of nearest neighbors for a batch of pairs of point clouds
 input: xyz1: (batch_size,#points_1,3)  the first point cloud
 input: xyz2: (batch_size,#points_2,3)  the second point cloud
 output: dist1: (batch_size,#point_1)   distance from first to second
@@ -13,8 +25,6 @@ output: idx1:  (batch_size,#point_1)   nearest neighbor from first to second
 output: dist2: (batch_size,#point_2)   distance from second to first
 output: idx2:  (batch_size,#point_2)   nearest neighbor from second to first
     '''
-    xyz1 = tf.expand_dims(xyz1, 0)
-    xyz2 = tf.expand_dims(xyz2, 0)
     return nn_distance_module.nn_distance(xyz1, xyz2)
 # @tf.RegisterShape('NnDistance')
 # def _nn_distance_shape(op):
@@ -47,7 +57,7 @@ if __name__ == '__main__':
         if True:
             inp1 = tf.Variable(xyz1)
             inp2 = tf.constant(xyz2)
-            reta, retb, retc, retd = nn_distance(inp1, inp2)
+            reta, retb, retc, retd = batch_nn_distance(inp1, inp2)
             loss = tf.reduce_sum(reta)+tf.reduce_sum(retc)
             train = tf.train.GradientDescentOptimizer(
                 learning_rate=0.05).minimize(loss)
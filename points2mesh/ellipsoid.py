@@ -0,0 +1,186 @@
+"""
+Binary template format for the base meshes in utils/ellipsoid.
+
+The original .dat files are Python 2 pickles of
+    [coord, support1, support2, support3, pool_idx, faces, lape_idx_unused, lape_idx]
+where every support is a list of sparse matrices (indices, values, shape).
+Unpickling them and patching the Laplacian indices costs noticeable time on every graph build.
+
+convert_template writes the same data as an uncompressed .npz bundle next to the .dat file:
+    coord                       - float32 [V, 3]
+    support{l}_{j}_{field}      - CSR matrix j of level l in {1, 2, 3}, field in {indptr, indices, data, shape}
+    pool_idx_{i}, edges_{i}     - int32 [E, 2]
+    lape_idx_{i}                - int32 [V_i, 10], -1 entries already replaced by the padding index
+    faces_{i}                   - int32 [F, 3 or 4]
+
+load_template reads a bundle, converting the .dat file once if the bundle is missing or outdated,
+and keeps it in a process-wide cache shared by all towers and predictors. It also combines the
+supports of every level into one adjacency for the fused graph convolution, see combine_supports.
+
+Example:
+    python ellipsoid.py utils/ellipsoid/info_ellipsoid.dat utils/ellipsoid/torus_small.dat
+"""
+
+import os
+import sys
+import argparse
+import tempfile
+
+import numpy as np
+from six.moves import cPickle as pickle
+from scipy.sparse import coo_matrix, csr_matrix
+from tensorpack.utils import logger
+
+_TEMPLATES = {}
+
+
+def _load_pickle(path):
+    with open(path, 'rb') as f:
+        if sys.version_info[0] >= 3:
+            return pickle.load(f, encoding='latin1')
+        return pickle.load(f)
+
+
+def _bundle_path(path):
+    return os.path.splitext(path)[0] + ".npz"
+
+
+def _is_current(bundle, path):
+    return os.path.isfile(bundle) and os.path.getmtime(bundle) >= os.path.getmtime(path)
+
+
+def convert_template(path, output=None):
+    """
+    Converts a pickled base mesh into an .npz template bundle. The bundle is written under a temporary
+    name and renamed into place, so concurrent readers never see a partly written file.
+
+    :param path: Path to the .dat file
+    :param output: Path of the bundle. Next to the .dat file if None
+    :return: Path of the bundle
+    """
+    pkl = _load_pickle(path)
+    output = output or _bundle_path(path)
+    arrays = {'coord': np.asarray(pkl[0], dtype=np.float32)}
+    for level in range(1, 4):
+        for j, (indices, values, shape) in enumerate(pkl[level]):
+            indices = np.asarray(indices)
+            support = csr_matrix(coo_matrix(
+                (np.asarray(values, dtype=np.float32), (indices[:, 0], indices[:, 1])), shape=shape))
+            support.sort_indices()
+            prefix = "support%i_%i_" % (level, j)
+            arrays[prefix + 'indptr'] = support.indptr.astype(np.int64)
+            arrays[prefix + 'indices'] = support.indices.astype(np.int64)
+            arrays[prefix + 'data'] = support.data
+            arrays[prefix + 'shape'] = np.asarray(shape, dtype=np.int64)
+        # Edges are the nonzeros of the second support of each level, in their original order
+        arrays['edges_%i' % (level - 1)] = np.asarray(pkl[level][1][0], dtype=np.int32)
+    for i, pool_idx in enumerate(pkl[4]):
+        arrays['pool_idx_%i' % i] = np.asarray(pool_idx, dtype=np.int32)
+    for i, faces in enumerate(pkl[5]):
+        arrays['faces_%i' % i] = np.asarray(faces, dtype=np.int32)
+    for i, lape_idx in enumerate(pkl[7]):
+        lape_idx = np.array(lape_idx, dtype=np.int32)
+        lape_idx[lape_idx == -1] = np.max(lape_idx) + 1
+        arrays['lape_idx_%i' % i] = lape_idx
+    fd, tmp = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.chmod(tmp, 0o644)
+        os.rename(tmp, output)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    logger.info("Converted " + path + " to " + output)
+    return output
+
+
+def _coo_indices(support):
+    # Row-major COO indices as expected by tf.SparseTensor
+    rows = np.repeat(np.arange(support.shape[0], dtype=np.int64), np.diff(support.indptr))
+    return np.stack([rows, support.indices.astype(np.int64)], axis=1)
+
+
+def combine_supports(supports):
+    """
+    Combines the supports A_0 .. A_{S-1} of a level into one adjacency [N, N * S] with
+    entry (r, c * S + s) = A_s(r, c). Multiplied with the per-vertex products of all S weight
+    matrices [N * S, F], interleaved per vertex, it sums over all supports in one sparse product.
+
+    :param supports: List of (indices, values, shape) of one level
+    :return: (indices, values, shape) of the combined adjacency
+    """
+    num_supports = len(supports)
+    rows, cols, values = [], [], []
+    for j, (indices, data, _) in enumerate(supports):
+        rows.append(indices[:, 0])
+        cols.append(indices[:, 1] * num_supports + j)
+        values.append(data)
+    shape = np.asarray(supports[0][2], dtype=np.int64) * [1, num_supports]
+    combined = csr_matrix(coo_matrix(
+        (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=shape))
+    combined.sort_indices()
+    return _coo_indices(combined), combined.data.astype(np.float32), shape
+
+
+def _read_bundle(path):
+    with np.load(path) as bundle:
+        template = {
+            'coord': bundle['coord'],
+            'supports': [],
+            'edges': [bundle['edges_%i' % i] for i in range(3)],
+            'pool_idx': [bundle['pool_idx_%i' % i] for i in range(2)],
+            'lape_idx': [bundle['lape_idx_%i' % i] for i in range(3)],
+            'faces': [bundle['faces_%i' % i] for i in range(3)],
+            'combined_supports': [],
+        }
+        for level in range(1, 4):
+            supports = []
+            j = 0
+            while "support%i_%i_indptr" % (level, j) in bundle:
+                prefix = "support%i_%i_" % (level, j)
+                shape = bundle[prefix + 'shape']
+                support = csr_matrix((bundle[prefix + 'data'], bundle[prefix + 'indices'],
+                                      bundle[prefix + 'indptr']), shape=shape)
+                supports.append((_coo_indices(support), support.data, shape))
+                j += 1
+            template['supports'].append(supports)
+            template['combined_supports'].append(combine_supports(supports))
+    return template
+
+
+def load_template(path):
+    """
+    Loads a base mesh template. Cached per process, so repeated graph builds do not read it again.
+
+    :param path: Path to an .npz bundle or to a .dat file. A .dat file is converted once into a bundle
+     next to it, or into the temp directory if that location is not writable
+    :return: Dict with coord [V, 3], supports (list per level of (indices, values, shape)),
+     combined_supports (one per level), edges, pool_idx, lape_idx and faces
+    """
+    key = os.path.abspath(path)
+    if key in _TEMPLATES:
+        return _TEMPLATES[key]
+
+    bundle = path
+    if not path.endswith('.npz'):
+        bundle = _bundle_path(path)
+        if not _is_current(bundle, path):
+            try:
+                convert_template(path, bundle)
+            except (IOError, OSError) as e:
+                logger.warn("Cannot write template bundle, " + str(e))
+                bundle = os.path.join(tempfile.gettempdir(), os.path.basename(bundle))
+                if not _is_current(bundle, path):
+                    convert_template(path, bundle)
+    _TEMPLATES[key] = _read_bundle(bundle)
+    return _TEMPLATES[key]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert pickled base meshes into .npz template bundles')
+    parser.add_argument('dat', nargs='+', help='pickled base mesh files')
+    args = parser.parse_args()
+
+    for path in args.dat:
+        convert_template(path)
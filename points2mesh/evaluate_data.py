@@ -1,5 +1,6 @@
 import tensorflow as tf
 import os
+import sys
 from os import listdir
 from os.path import isfile, join
 import cv2
@@ -8,7 +9,9 @@ from fetcher import *
 from pc_meshlab_loader import *
 import re
 import cPickle as pickle
-from flex_conv_layers import knn_bf_sym
+from flex_conv_layers import knn_search
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'external'))
+from tf_approxmatch import batch_emd
 
 enable_argscope_for_module(tf.layers)
 
@@ -31,11 +34,15 @@ flags.DEFINE_integer('feature_depth', 32,
 flags.DEFINE_integer('coord_dim', 3, 'Number of units in output layer')
 flags.DEFINE_float('weight_decay', 5e-6, 'Weight decay for L2 loss.')
 flags.DEFINE_float('collapse_epsilon', 0.008, 'Collapse loss epsilon')
+flags.DEFINE_float('collapse_softness', 0.0,
+                   'Width of the sigmoid replacing the collapse loss threshold, 0 keeps the hard threshold')
 flags.DEFINE_integer('pc_num', 1024, 'Number of points per pointcloud object')
 flags.DEFINE_integer('dp', 3, 'Dimension of points in pointcloud')
 flags.DEFINE_integer(
     'num_neighbors', 6, 'Number of neighbors considered during Graph projection layer')
 flags.DEFINE_integer('batch_size', 1, 'Batchsize')
+flags.DEFINE_integer('knn_memory_budget', 0,
+                     'Megabytes of distance buffers for tiled brute-force knn on the CPU, 0 runs knn_bf_sym')
 flags.DEFINE_string('base_model_path', 'utils/ellipsoid/info_ellipsoid.dat',
                     'Path to base model for mesh deformation')
 # flags.DEFINE_string('base_model_path', 'utils/ellipsoid/torus_small.dat',
@@ -85,7 +92,8 @@ def predict(predictor, data, path):
     #vertices_3 = predictor(data)[2]
 
     # return [vertices_1, vertices_2, vertices_3]
-    return predictor(data)[2]
+    # Outputs are batched [B, N, 3], data holds a single point cloud
+    return predictor(data)[2][0]
 
 
 def loadModel():
@@ -154,14 +162,18 @@ for pc in pcs:
     model_count[obj_class] += 1.0
 
     # Evaluate min dist from label to pred and pred to label
-    _, op_dist_pred_label, _ = knn_bf_sym(pred_tensor, label_tensor, K=1)
-    _, op_dist_label_pred, _ = knn_bf_sym(label_tensor, pred_tensor, K=1)
+    _, op_dist_pred_label = knn_search(pred_tensor, label_tensor, K=1)
+    _, op_dist_label_pred = knn_search(label_tensor, pred_tensor, K=1)
 
     dist_pred_label = np.squeeze(sess.run(op_dist_pred_label))
     dist_label_pred = np.squeeze(sess.run(op_dist_label_pred))
 
     cd = np.mean(dist_pred_label) + np.mean(dist_label_pred)
 
+    op_emd = batch_emd(tf.transpose(pred_tensor, [0, 2, 1]),
+                       tf.transpose(label_tensor, [0, 2, 1]))
+    emd = sess.run(op_emd)[0]
+
     f = f_score(np.transpose(np.squeeze(label)), np.transpose(
         np.squeeze(pred)), dist_pred_label, dist_label_pred, thresholds)
 
@@ -176,6 +188,7 @@ for pc in pcs:
         min_cd_id[obj_class] = obj_number
     sum_f[obj_class] += f
     sum_cd[obj_class] += cd
+    sum_emd[obj_class] += emd
     counter += 1
     if counter == max_len / 2:
         print "halfway done"
@@ -185,15 +198,17 @@ for i in classes:
     number = model_count[i]
     f = sum_f[i] / number
     cd = (sum_cd[i] / number) * 1000.0
-    print i, int(number), f, cd
+    emd = (sum_emd[i] / number) * 100.0
+    print i, int(number), f, cd, emd
     print >> log, i, int(
-        number), f, cd, min_f[i], min_cd[i], min_f_id[i], min_cd_id[i]
+        number), f, cd, emd, min_f[i], min_cd[i], min_f_id[i], min_cd_id[i]
 
 log.close()
 sess.close()
 
 print sum_f
 print sum_cd
+print sum_emd
 
 print min_f_id
 print min_cd_id
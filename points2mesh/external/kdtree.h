@@ -0,0 +1,112 @@
+// kd-tree over a 3d point cloud for exact k nearest neighbor queries, shared by the CPU kernels
+#ifndef EXTERNAL_KDTREE_H_
+#define EXTERNAL_KDTREE_H_
+#include <algorithm>
+#include <limits>
+#include <vector>
+
+// Leaves hold at most this many reference points
+static const int kLeafSize=16;
+
+struct KdNode{
+	int start,end;
+	int left,right;
+	int dim;
+	float split;
+};
+
+// Points of a node are the contiguous range [start, end) of xyz, leaves have left == -1
+struct KdTree{
+	std::vector<KdNode> nodes;
+	std::vector<int> index;
+	std::vector<float> xyz;
+};
+
+static inline int kdbuild(KdTree& tree,const float * points,int point_stride,int dim_stride,int start,int end){
+	KdNode node;
+	node.start=start;
+	node.end=end;
+	node.left=-1;
+	node.right=-1;
+	node.dim=0;
+	node.split=0;
+	int id=tree.nodes.size();
+	tree.nodes.push_back(node);
+	if (end-start<=kLeafSize)
+		return id;
+	float lo[3],hi[3];
+	for (int d=0;d<3;d++){
+		lo[d]=hi[d]=points[d*dim_stride+tree.index[start]*point_stride];
+	}
+	for (int i=start+1;i<end;i++){
+		for (int d=0;d<3;d++){
+			float v=points[d*dim_stride+tree.index[i]*point_stride];
+			lo[d]=std::min(lo[d],v);
+			hi[d]=std::max(hi[d],v);
+		}
+	}
+	int dim=0;
+	for (int d=1;d<3;d++){
+		if (hi[d]-lo[d]>hi[dim]-lo[dim])
+			dim=d;
+	}
+	int mid=(start+end)/2;
+	const float * coord=points+dim*dim_stride;
+	std::nth_element(tree.index.begin()+start,tree.index.begin()+mid,tree.index.begin()+end,
+		[coord,point_stride](int a,int b){return coord[a*point_stride]<coord[b*point_stride];});
+	tree.nodes[id].dim=dim;
+	tree.nodes[id].split=coord[tree.index[mid]*point_stride];
+	int left=kdbuild(tree,points,point_stride,dim_stride,start,mid);
+	int right=kdbuild(tree,points,point_stride,dim_stride,mid,end);
+	tree.nodes[id].left=left;
+	tree.nodes[id].right=right;
+	return id;
+}
+
+// Builds the tree over m points, coordinate d of point i is points[i*point_stride+d*dim_stride]
+static inline void kdtree(const float * points,int m,int point_stride,int dim_stride,KdTree& tree){
+	tree.nodes.clear();
+	tree.nodes.reserve(4*m/kLeafSize+1);
+	tree.index.resize(m);
+	for (int i=0;i<m;i++)
+		tree.index[i]=i;
+	kdbuild(tree,points,point_stride,dim_stride,0,m);
+	// Store the points in leaf order so leaves are scanned from contiguous memory
+	tree.xyz.resize(m*3);
+	for (int i=0;i<m;i++){
+		for (int d=0;d<3;d++)
+			tree.xyz[i*3+d]=points[d*dim_stride+tree.index[i]*point_stride];
+	}
+}
+
+// best and besti hold the k nearest points found so far in ascending order
+static inline void kdsearch(const KdTree& tree,int id,const float * q,int k,float * best,int * besti){
+	const KdNode& node=tree.nodes[id];
+	if (node.left<0){
+		for (int i=node.start;i<node.end;i++){
+			float x=tree.xyz[i*3+0]-q[0];
+			float y=tree.xyz[i*3+1]-q[1];
+			float z=tree.xyz[i*3+2]-q[2];
+			float d=x*x+y*y+z*z;
+			if (d>=best[k-1])
+				continue;
+			int j=k-1;
+			while (j>0 && best[j-1]>d){
+				best[j]=best[j-1];
+				besti[j]=besti[j-1];
+				j--;
+			}
+			best[j]=d;
+			besti[j]=tree.index[i];
+		}
+		return;
+	}
+	float diff=q[node.dim]-node.split;
+	int near=diff<0?node.left:node.right;
+	int far=diff<0?node.right:node.left;
+	kdsearch(tree,near,q,k,best,besti);
+	if (diff*diff<best[k-1])
+		kdsearch(tree,far,q,k,best,besti);
+}
+
+#endif
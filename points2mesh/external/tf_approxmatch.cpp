@@ -1,5 +1,6 @@
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/util/work_sharder.h"
 #include <algorithm>
 #include <vector>
 #include <math.h>
@@ -13,6 +14,10 @@ REGISTER_OP("MatchCost")
 	.Input("xyz2: float32")
 	.Input("match: float32")
 	.Output("cost: float32");
+REGISTER_OP("ApproxMatchCost")
+	.Input("xyz1: float32")
+	.Input("xyz2: float32")
+	.Output("cost: float32");
 REGISTER_OP("MatchCostGrad")
 	.Input("xyz1: float32")
 	.Input("xyz2: float32")
@@ -20,128 +25,160 @@ REGISTER_OP("MatchCostGrad")
 	.Output("grad1: float32")
 	.Output("grad2: float32");
 
-void approxmatch_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,float * match){
-	for (int i=0;i<b;i++){
-		int factorl=std::max(n,m)/n;
-		int factorr=std::max(n,m)/m;
-		std::vector<double> saturatedl(n,double(factorl)),saturatedr(m,double(factorr));
-		std::vector<double> weight(n*m);
-		for (int j=0;j<n*m;j++)
-			match[j]=0;
-		for (int j=8;j>=-2;j--){
-			//printf("i=%d j=%d\n",i,j);
-			double level=-powf(4.0,j);
-			if (j==-2)
-				level=0;
-			for (int k=0;k<n;k++){
-				double x1=xyz1[k*3+0];
-				double y1=xyz1[k*3+1];
-				double z1=xyz1[k*3+2];
-				for (int l=0;l<m;l++){
-					double x2=xyz2[l*3+0];
-					double y2=xyz2[l*3+1];
-					double z2=xyz2[l*3+2];
-					weight[k*m+l]=expf(level*((x1-x2)*(x1-x2)+(y1-y2)*(y1-y2)+(z1-z2)*(z1-z2)))*saturatedr[l];
-				}
-			}
-			std::vector<double> ss(m,1e-9);
-			for (int k=0;k<n;k++){
-				double s=1e-9;
-				for (int l=0;l<m;l++){
-					s+=weight[k*m+l];
-				}
-				for (int l=0;l<m;l++){
-					weight[k*m+l]=weight[k*m+l]/s*saturatedl[k];
-				}
+// Levels of the approximate matching, from 4^7 down to 0, as in the CUDA kernel
+static inline float matchlevel(int j){
+	return j==-2?0:-powf(4.0f,j);
+}
+static inline float sqdist(const float * p1,const float * p2){
+	float x=p2[0]-p1[0];
+	float y=p2[1]-p1[1];
+	float z=p2[2]-p1[2];
+	return x*x+y*y+z*z;
+}
+// Approximate matching of xyz1 [b,n,3] and xyz2 [b,m,3], match [b,m,n] or NULL. When cost [b] is given the matching
+// cost is accumulated on the fly, so with match NULL the memory stays linear in the number of points
+static void approxmatch_cpu(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,float * match,float * cost){
+	if (match)
+		std::fill(match,match+int64(b)*n*m,0.0f);
+	if (cost)
+		std::fill(cost,cost+b,0.0f);
+	if (n==0 || m==0)
+		return;
+	auto pool=context->device()->tensorflow_cpu_worker_threads();
+	float multiL=1,multiR=1;
+	if (n>=m)
+		multiR=n/m;
+	else
+		multiL=m/n;
+	std::vector<float> remainL(int64(b)*n,multiL),remainR(int64(b)*m,multiR);
+	std::vector<float> ratioL(int64(b)*n),ratioR(int64(b)*m);
+	std::vector<double> costL(cost?int64(b)*n:0,0.0);
+	for (int j=7;j>=-2;j--){
+		float level=matchlevel(j);
+		// Share every point of xyz1 can give to the remaining capacity of xyz2
+		Shard(pool->num_threads,pool->workers,int64(b)*n,int64(m)*30,[&](int64 begin,int64 end){
+			for (int64 q=begin;q<end;q++){
+				int i=q/n;
+				const float * p2=xyz2+int64(i)*m*3;
+				const float * rR=&remainR[int64(i)*m];
+				double suml=1e-9;
 				for (int l=0;l<m;l++)
-					ss[l]+=weight[k*m+l];
+					suml+=expf(level*sqdist(xyz1+q*3,p2+l*3))*rR[l];
+				ratioL[q]=remainL[q]/suml;
 			}
-			for (int l=0;l<m;l++){
-				double s=ss[l];
-				double r=std::min(saturatedr[l]/s,1.0);
-				ss[l]=r;
+		});
+		// Fraction of what every point of xyz2 is offered that it can still take
+		Shard(pool->num_threads,pool->workers,int64(b)*m,int64(n)*30,[&](int64 begin,int64 end){
+			for (int64 q=begin;q<end;q++){
+				int i=q/m;
+				const float * p1=xyz1+int64(i)*n*3;
+				const float * rL=&ratioL[int64(i)*n];
+				double sumr=0;
+				for (int k=0;k<n;k++)
+					sumr+=expf(level*sqdist(p1+k*3,xyz2+q*3))*rL[k];
+				sumr*=remainR[q];
+				float consumption=std::min(float(remainR[q]/(sumr+1e-9)),1.0f);
+				ratioR[q]=consumption*remainR[q];
+				remainR[q]=std::max(0.0f,float(remainR[q]-sumr));
 			}
-			std::vector<double> ss2(m,0);
-			for (int k=0;k<n;k++){
-				double s=0;
+		});
+		// Every point of xyz1 writes its own column of the match
+		Shard(pool->num_threads,pool->workers,int64(b)*n,int64(m)*40,[&](int64 begin,int64 end){
+			for (int64 q=begin;q<end;q++){
+				int i=q/n,k=q%n;
+				const float * p2=xyz2+int64(i)*m*3;
+				const float * rR=&ratioR[int64(i)*m];
+				double suml=0,c=0;
 				for (int l=0;l<m;l++){
-					weight[k*m+l]*=ss[l];
-					s+=weight[k*m+l];
-					ss2[l]+=weight[k*m+l];
+					float d=sqdist(xyz1+q*3,p2+l*3);
+					float w=expf(level*d)*ratioL[q]*rR[l];
+					if (match)
+						match[int64(i)*n*m+int64(l)*n+k]+=w;
+					if (cost)
+						c+=w*sqrtf(d);
+					suml+=w;
 				}
-				saturatedl[k]=std::max(saturatedl[k]-s,0.0);
-			}
-			for (int k=0;k<n*m;k++)
-				match[k]+=weight[k];
-			for (int l=0;l<m;l++){
-				saturatedr[l]=std::max(saturatedr[l]-ss2[l],0.0);
+				remainL[q]=std::max(0.0f,float(remainL[q]-suml));
+				if (cost)
+					costL[q]+=c;
 			}
+		});
+	}
+	if (cost){
+		for (int i=0;i<b;i++){
+			double s=0;
+			for (int k=0;k<n;k++)
+				s+=costL[int64(i)*n+k];
+			cost[i]=s;
 		}
-		xyz1+=n*3;
-		xyz2+=m*3;
-		match+=n*m;
 	}
 }
-void matchcost_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * cost){
+static void matchcost_cpu(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * cost){
+	auto pool=context->device()->tensorflow_cpu_worker_threads();
+	std::vector<double> rowcost(int64(b)*m);
+	Shard(pool->num_threads,pool->workers,int64(b)*m,int64(n)*10,[&](int64 begin,int64 end){
+		for (int64 q=begin;q<end;q++){
+			int i=q/m;
+			const float * p1=xyz1+int64(i)*n*3;
+			double s=0;
+			for (int k=0;k<n;k++)
+				s+=sqrtf(sqdist(p1+k*3,xyz2+q*3))*match[q*n+k];
+			rowcost[q]=s;
+		}
+	});
 	for (int i=0;i<b;i++){
 		double s=0;
-		for (int j=0;j<n;j++)
-			for (int k=0;k<m;k++){
-				float x1=xyz1[j*3+0];
-				float y1=xyz1[j*3+1];
-				float z1=xyz1[j*3+2];
-				float x2=xyz2[k*3+0];
-				float y2=xyz2[k*3+1];
-				float z2=xyz2[k*3+2];
-				float d=sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1))*match[j*m+k];
-				s+=d;
-			}
-		cost[0]=s;
-		xyz1+=n*3;
-		xyz2+=m*3;
-		match+=n*m;
-		cost+=1;
+		for (int l=0;l<m;l++)
+			s+=rowcost[int64(i)*m+l];
+		cost[i]=s;
 	}
 }
-void matchcostgrad_cpu(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * grad1,float * grad2){
-	for (int i=0;i<b;i++){
-		for (int j=0;j<n;j++)
-			grad1[j*3+0]=0;
-		for (int j=0;j<m;j++){
-			float sx=0,sy=0,sz=0;
+static void matchcostgrad_cpu(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * grad1,float * grad2){
+	auto pool=context->device()->tensorflow_cpu_worker_threads();
+	Shard(pool->num_threads,pool->workers,int64(b)*n,int64(m)*15,[&](int64 begin,int64 end){
+		for (int64 q=begin;q<end;q++){
+			int i=q/n,k=q%n;
+			const float * p1=xyz1+q*3;
+			float dx=0,dy=0,dz=0;
+			for (int l=0;l<m;l++){
+				const float * p2=xyz2+(int64(i)*m+l)*3;
+				float d=match[int64(i)*n*m+int64(l)*n+k]/sqrtf(std::max(sqdist(p1,p2),1e-20f));
+				dx+=(p1[0]-p2[0])*d;
+				dy+=(p1[1]-p2[1])*d;
+				dz+=(p1[2]-p2[2])*d;
+			}
+			grad1[q*3+0]=dx;
+			grad1[q*3+1]=dy;
+			grad1[q*3+2]=dz;
+		}
+	});
+	Shard(pool->num_threads,pool->workers,int64(b)*m,int64(n)*15,[&](int64 begin,int64 end){
+		for (int64 q=begin;q<end;q++){
+			int i=q/m;
+			const float * p2=xyz2+q*3;
+			float dx=0,dy=0,dz=0;
 			for (int k=0;k<n;k++){
-				float x2=xyz2[j*3+0];
-				float y2=xyz2[j*3+1];
-				float z2=xyz2[j*3+2];
-				float x1=xyz1[k*3+0];
-				float y1=xyz1[k*3+1];
-				float z1=xyz1[k*3+2];
-				float d=std::max(sqrtf((x2-x1)*(x2-x1)+(y2-y1)*(y2-y1)+(z2-z1)*(z2-z1)),1e-20f);
-				float dx=match[k*m+j]*((x2-x1)/d);
-				float dy=match[k*m+j]*((y2-y1)/d);
-				float dz=match[k*m+j]*((z2-z1)/d);
-				grad1[k*3+0]-=dx;
-				grad1[k*3+1]-=dy;
-				grad1[k*3+2]-=dz;
-				sx+=dx;
-				sy+=dy;
-				sz+=dz;
+				const float * p1=xyz1+(int64(i)*n+k)*3;
+				float d=match[q*n+k]/sqrtf(std::max(sqdist(p1,p2),1e-20f));
+				dx+=(p2[0]-p1[0])*d;
+				dy+=(p2[1]-p1[1])*d;
+				dz+=(p2[2]-p1[2])*d;
 			}
-			grad2[j*3+0]=sx;
-			grad2[j*3+1]=sy;
-			grad2[j*3+2]=sz;
+			grad2[q*3+0]=dx;
+			grad2[q*3+1]=dy;
+			grad2[q*3+2]=dz;
 		}
-		xyz1+=n*3;
-		xyz2+=m*3;
-		match+=n*m;
-		grad1+=n*3;
-		grad2+=m*3;
-	}
+	});
 }
+
+// Built without the CUDA kernels by the cpu make target
+#ifndef APPROXMATCH_CPU_ONLY
 void approxmatchLauncher(int b,int n,int m,const float * xyz1,const float * xyz2,float * match,float * temp);
 void matchcostLauncher(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * out);
 void matchcostgradLauncher(int b,int n,int m,const float * xyz1,const float * xyz2,const float * match,float * grad1,float * grad2);
+#endif
 
+#ifndef APPROXMATCH_CPU_ONLY
 class ApproxMatchGpuOp: public OpKernel{
 	public:
 		explicit ApproxMatchGpuOp(OpKernelConstruction* context):OpKernel(context){}
@@ -172,6 +209,7 @@ class ApproxMatchGpuOp: public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("ApproxMatch").Device(DEVICE_GPU), ApproxMatchGpuOp);
+#endif
 class ApproxMatchOp: public OpKernel{
 	public:
 		explicit ApproxMatchOp(OpKernelConstruction* context):OpKernel(context){}
@@ -194,10 +232,11 @@ class ApproxMatchOp: public OpKernel{
 			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,m,n},&match_tensor));
 			auto match_flat=match_tensor->flat<float>();
 			float * match=&(match_flat(0));
-			approxmatch_cpu(b,n,m,xyz1,xyz2,match);
+			approxmatch_cpu(context,b,n,m,xyz1,xyz2,match,NULL);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("ApproxMatch").Device(DEVICE_CPU), ApproxMatchOp);
+#ifndef APPROXMATCH_CPU_ONLY
 class MatchCostGpuOp: public OpKernel{
 	public:
 		explicit MatchCostGpuOp(OpKernelConstruction* context):OpKernel(context){}
@@ -228,6 +267,7 @@ class MatchCostGpuOp: public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCost").Device(DEVICE_GPU), MatchCostGpuOp);
+#endif
 class MatchCostOp: public OpKernel{
 	public:
 		explicit MatchCostOp(OpKernelConstruction* context):OpKernel(context){}
@@ -254,11 +294,12 @@ class MatchCostOp: public OpKernel{
 			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b},&cost_tensor));
 			auto cost_flat=cost_tensor->flat<float>();
 			float * cost=&(cost_flat(0));
-			matchcost_cpu(b,n,m,xyz1,xyz2,match,cost);
+			matchcost_cpu(context,b,n,m,xyz1,xyz2,match,cost);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCost").Device(DEVICE_CPU), MatchCostOp);
 
+#ifndef APPROXMATCH_CPU_ONLY
 class MatchCostGradGpuOp: public OpKernel{
 	public:
 		explicit MatchCostGradGpuOp(OpKernelConstruction* context):OpKernel(context){}
@@ -293,6 +334,7 @@ class MatchCostGradGpuOp: public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCostGrad").Device(DEVICE_GPU), MatchCostGradGpuOp);
+#endif
 class MatchCostGradOp: public OpKernel{
 	public:
 		explicit MatchCostGradOp(OpKernelConstruction* context):OpKernel(context){}
@@ -323,7 +365,32 @@ class MatchCostGradOp: public OpKernel{
 			OP_REQUIRES_OK(context,context->allocate_output(1,TensorShape{b,m,3},&grad2_tensor));
 			auto grad2_flat=grad2_tensor->flat<float>();
 			float * grad2=&(grad2_flat(0));
-			matchcostgrad_cpu(b,n,m,xyz1,xyz2,match,grad1,grad2);
+			matchcostgrad_cpu(context,b,n,m,xyz1,xyz2,match,grad1,grad2);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("MatchCostGrad").Device(DEVICE_CPU), MatchCostGradOp);
+class ApproxMatchCostOp: public OpKernel{
+	public:
+		explicit ApproxMatchCostOp(OpKernelConstruction* context):OpKernel(context){}
+		void Compute(OpKernelContext * context)override{
+			const Tensor& xyz1_tensor=context->input(0);
+			OP_REQUIRES(context,xyz1_tensor.dims()==3 && xyz1_tensor.shape().dim_size(2)==3,errors::InvalidArgument("ApproxMatchCost expects (batch_size,num_points,3) xyz1 shape"));
+			auto xyz1_flat=xyz1_tensor.flat<float>();
+			const float * xyz1=&(xyz1_flat(0));
+			int b=xyz1_tensor.shape().dim_size(0);
+			int n=xyz1_tensor.shape().dim_size(1);
+
+			const Tensor& xyz2_tensor=context->input(1);
+			OP_REQUIRES(context,xyz2_tensor.dims()==3 && xyz2_tensor.shape().dim_size(2)==3 && xyz2_tensor.shape().dim_size(0)==b,errors::InvalidArgument("ApproxMatchCost expects (batch_size,num_points,3) xyz2 shape, and batch_size must match"));
+			int m=xyz2_tensor.shape().dim_size(1);
+			auto xyz2_flat=xyz2_tensor.flat<float>();
+			const float * xyz2=&(xyz2_flat(0));
+
+			Tensor * cost_tensor=NULL;
+			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b},&cost_tensor));
+			auto cost_flat=cost_tensor->flat<float>();
+			float * cost=&(cost_flat(0));
+			approxmatch_cpu(context,b,n,m,xyz1,xyz2,NULL,cost);
+		}
+};
+REGISTER_KERNEL_BUILDER(Name("ApproxMatchCost").Device(DEVICE_CPU), ApproxMatchCostOp);
@@ -51,6 +51,48 @@ def _match_cost_shape(op):
     return [tf.TensorShape([shape1.dims[0]])]
 
 
+def approx_match_cost(xyz1, xyz2):
+    '''
+Cost of the approximate matching without the match matrix, memory stays linear in the number of points
+input:
+    xyz1 : batch_size * #dataset_points * 3
+    xyz2 : batch_size * #query_points * 3
+returns:
+    cost : batch_size, as match_cost(xyz1, xyz2, approx_match(xyz1, xyz2))
+    '''
+    return approxmatch_module.approx_match_cost(xyz1, xyz2)
+
+
+ops.NoGradient('ApproxMatchCost')
+@ops.RegisterShape('ApproxMatchCost')
+def _approx_match_cost_shape(op):
+    shape1 = op.inputs[0].get_shape().with_rank(3)
+    return [tf.TensorShape([shape1.dims[0]])]
+
+
+def batch_emd(xyz1, xyz2, bounded_memory=True):
+    '''
+Approximate earth mover's distance between a batch of pairs of point clouds
+input:
+    xyz1 : batch_size * #points_1 * 3
+    xyz2 : batch_size * #points_2 * 3
+    bounded_memory : accumulate the cost while matching instead of building the
+        batch_size * #points_2 * #points_1 match, CPU only
+returns:
+    emd : batch_size, matching cost per unit of matched mass
+    '''
+    if bounded_memory:
+        cost = approxmatch_module.approx_match_cost(xyz1, xyz2)
+    else:
+        match = approxmatch_module.approx_match(xyz1, xyz2)
+        cost = approxmatch_module.match_cost(xyz1, xyz2, match)
+    # Points of the smaller cloud carry weight max(n, m) // min(n, m), as in the kernels
+    n = tf.shape(xyz1)[1]
+    m = tf.shape(xyz2)[1]
+    mass = tf.minimum(n * tf.maximum(m // n, 1), m * tf.maximum(n // m, 1))
+    return cost / tf.cast(mass, tf.float32)
+
+
 @tf.RegisterGradient('MatchCost')
 def _match_cost_grad(op, grad_cost):
     xyz1 = op.inputs[0]
@@ -0,0 +1,78 @@
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/framework/shape_inference.h"
+#include "tensorflow/core/util/work_sharder.h"
+#include "kdtree.h"
+REGISTER_OP("KnnKdtree")
+	.Attr("K: int >= 1")
+	.Input("queries: float32")
+	.Input("references: float32")
+	.Output("neighborhood: int32")
+	.Output("distances: float32")
+	.SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c){
+		::tensorflow::shape_inference::ShapeHandle queries;
+		::tensorflow::shape_inference::ShapeHandle references;
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(0),3,&queries));
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(1),3,&references));
+		int k;
+		TF_RETURN_IF_ERROR(c->GetAttr("K",&k));
+		auto out=c->MakeShape({c->Dim(queries,0),c->Dim(queries,2),c->MakeDim(k)});
+		c->set_output(0,out);
+		c->set_output(1,out);
+		return ::tensorflow::Status::OK();
+	});
+using namespace tensorflow;
+
+static void kdquery(const KdTree& tree,const float * queries,int n,int j,int k,int * idx,float * dist){
+	float q[3]={queries[j],queries[n+j],queries[2*n+j]};
+	for (int i=0;i<k;i++){
+		dist[i]=std::numeric_limits<float>::infinity();
+		idx[i]=0;
+	}
+	kdsearch(tree,0,q,k,dist,idx);
+}
+
+class KnnKdtreeOp : public OpKernel{
+	public:
+		explicit KnnKdtreeOp(OpKernelConstruction* context):OpKernel(context){
+			OP_REQUIRES_OK(context,context->GetAttr("K",&k_));
+		}
+		void Compute(OpKernelContext * context)override{
+			const Tensor& queries_tensor=context->input(0);
+			const Tensor& references_tensor=context->input(1);
+			OP_REQUIRES(context,queries_tensor.dims()==3 && queries_tensor.shape().dim_size(1)==3,errors::InvalidArgument("KnnKdtree requires queries be of shape (batch,3,#points)"));
+			OP_REQUIRES(context,references_tensor.dims()==3 && references_tensor.shape().dim_size(1)==3,errors::InvalidArgument("KnnKdtree requires references be of shape (batch,3,#points)"));
+			int b=queries_tensor.shape().dim_size(0);
+			int n=queries_tensor.shape().dim_size(2);
+			int m=references_tensor.shape().dim_size(2);
+			OP_REQUIRES(context,references_tensor.shape().dim_size(0)==b,errors::InvalidArgument("KnnKdtree expects queries and references have same batch size"));
+			OP_REQUIRES(context,m>=k_,errors::InvalidArgument("KnnKdtree needs at least K reference points"));
+			const float * queries=queries_tensor.flat<float>().data();
+			const float * references=references_tensor.flat<float>().data();
+			Tensor * neighborhood_tensor=NULL;
+			Tensor * distances_tensor=NULL;
+			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,n,k_},&neighborhood_tensor));
+			OP_REQUIRES_OK(context,context->allocate_output(1,TensorShape{b,n,k_},&distances_tensor));
+			int * idx=neighborhood_tensor->flat<int>().data();
+			float * dist=distances_tensor->flat<float>().data();
+			if (b==0 || n==0)
+				return;
+
+			auto pool=context->device()->tensorflow_cpu_worker_threads();
+			std::vector<KdTree> trees(b);
+			Shard(pool->num_threads,pool->workers,b,int64(m)*20,[&](int64 begin,int64 end){
+				for (int64 i=begin;i<end;i++)
+					kdtree(references+i*3*m,m,1,m,trees[i]);
+			});
+			int k=k_;
+			Shard(pool->num_threads,pool->workers,int64(b)*n,int64(k)*kLeafSize*8,[&](int64 begin,int64 end){
+				for (int64 q=begin;q<end;q++){
+					int i=q/n;
+					kdquery(trees[i],queries+int64(i)*3*n,n,q%n,k,idx+q*k,dist+q*k);
+				}
+			});
+		}
+	private:
+		int k_;
+};
+REGISTER_KERNEL_BUILDER(Name("KnnKdtree").Device(DEVICE_CPU), KnnKdtreeOp);
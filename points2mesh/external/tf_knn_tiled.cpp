@@ -0,0 +1,129 @@
+#include "tensorflow/core/framework/op.h"
+#include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/framework/shape_inference.h"
+#include "tensorflow/core/util/work_sharder.h"
+#include <algorithm>
+#include <limits>
+#include <vector>
+REGISTER_OP("KnnTiled")
+	.Attr("K: int >= 1")
+	.Attr("memory_budget: int = 67108864")
+	.Input("queries: float32")
+	.Input("references: float32")
+	.Output("neighborhood: int32")
+	.Output("distances: float32")
+	.SetShapeFn([](::tensorflow::shape_inference::InferenceContext* c){
+		::tensorflow::shape_inference::ShapeHandle queries;
+		::tensorflow::shape_inference::ShapeHandle references;
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(0),3,&queries));
+		TF_RETURN_IF_ERROR(c->WithRank(c->input(1),3,&references));
+		int k;
+		TF_RETURN_IF_ERROR(c->GetAttr("K",&k));
+		auto out=c->MakeShape({c->Dim(queries,0),c->Dim(queries,2),c->MakeDim(k)});
+		c->set_output(0,out);
+		c->set_output(1,out);
+		return ::tensorflow::Status::OK();
+	});
+using namespace tensorflow;
+
+// Queries per tile, the reference tile width follows from the memory budget
+static const int kQueryTile=64;
+
+// Distances of the queries [3, n] in [j0, j1) to the references [3, m] in [r0, r1), tile is (j1-j0)*(r1-r0)
+static void distancetile(const float * queries,int n,int j0,int j1,const float * references,int m,int r0,int r1,float * tile){
+	int w=r1-r0;
+	for (int j=j0;j<j1;j++){
+		float x1=queries[j],y1=queries[n+j],z1=queries[2*n+j];
+		const float * x2=references+r0;
+		const float * y2=references+m+r0;
+		const float * z2=references+2*m+r0;
+		float * row=tile+(j-j0)*w;
+		for (int r=0;r<w;r++){
+			float x=x2[r]-x1;
+			float y=y2[r]-y1;
+			float z=z2[r]-z1;
+			row[r]=x*x+y*y+z*z;
+		}
+	}
+}
+
+// Merges one row of a tile into the running top k of a query, best and besti are ascending
+static void mergetopk(const float * row,int w,int r0,int k,float * best,int * besti){
+	for (int r=0;r<w;r++){
+		float d=row[r];
+		if (d>=best[k-1])
+			continue;
+		int j=k-1;
+		while (j>0 && best[j-1]>d){
+			best[j]=best[j-1];
+			besti[j]=besti[j-1];
+			j--;
+		}
+		best[j]=d;
+		besti[j]=r0+r;
+	}
+}
+
+// Searches the queries [j0, j1) of one batch sample, tile holds kQueryTile*width floats
+static void knntiled(const float * queries,int n,int j0,int j1,const float * references,int m,int k,int width,float * tile,int * idx,float * dist){
+	for (int i=j0*k;i<j1*k;i++){
+		dist[i]=std::numeric_limits<float>::infinity();
+		idx[i]=0;
+	}
+	for (int r0=0;r0<m;r0+=width){
+		int r1=std::min(r0+width,m);
+		distancetile(queries,n,j0,j1,references,m,r0,r1,tile);
+		for (int j=j0;j<j1;j++)
+			mergetopk(tile+(j-j0)*(r1-r0),r1-r0,r0,k,dist+j*k,idx+j*k);
+	}
+}
+
+class KnnTiledOp : public OpKernel{
+	public:
+		explicit KnnTiledOp(OpKernelConstruction* context):OpKernel(context){
+			OP_REQUIRES_OK(context,context->GetAttr("K",&k_));
+			OP_REQUIRES_OK(context,context->GetAttr("memory_budget",&memory_budget_));
+		}
+		void Compute(OpKernelContext * context)override{
+			const Tensor& queries_tensor=context->input(0);
+			const Tensor& references_tensor=context->input(1);
+			OP_REQUIRES(context,queries_tensor.dims()==3 && queries_tensor.shape().dim_size(1)==3,errors::InvalidArgument("KnnTiled requires queries be of shape (batch,3,#points)"));
+			OP_REQUIRES(context,references_tensor.dims()==3 && references_tensor.shape().dim_size(1)==3,errors::InvalidArgument("KnnTiled requires references be of shape (batch,3,#points)"));
+			int b=queries_tensor.shape().dim_size(0);
+			int n=queries_tensor.shape().dim_size(2);
+			int m=references_tensor.shape().dim_size(2);
+			OP_REQUIRES(context,references_tensor.shape().dim_size(0)==b,errors::InvalidArgument("KnnTiled expects queries and references have same batch size"));
+			OP_REQUIRES(context,m>=k_,errors::InvalidArgument("KnnTiled needs at least K reference points"));
+			const float * queries=queries_tensor.flat<float>().data();
+			const float * references=references_tensor.flat<float>().data();
+			Tensor * neighborhood_tensor=NULL;
+			Tensor * distances_tensor=NULL;
+			OP_REQUIRES_OK(context,context->allocate_output(0,TensorShape{b,n,k_},&neighborhood_tensor));
+			OP_REQUIRES_OK(context,context->allocate_output(1,TensorShape{b,n,k_},&distances_tensor));
+			int * idx=neighborhood_tensor->flat<int>().data();
+			float * dist=distances_tensor->flat<float>().data();
+			if (b==0 || n==0)
+				return;
+
+			// Every worker and the calling thread hold one distance tile
+			auto pool=context->device()->tensorflow_cpu_worker_threads();
+			int64 tile_floats=memory_budget_/int64(sizeof(float))/(pool->num_threads+1);
+			int width=std::max<int64>(1,std::min<int64>(m,tile_floats/kQueryTile));
+			int blocks=(n+kQueryTile-1)/kQueryTile;
+			int k=k_;
+			Shard(pool->num_threads,pool->workers,int64(b)*blocks,int64(kQueryTile)*m*8,[&](int64 begin,int64 end){
+				std::vector<float> tile(int64(kQueryTile)*width);
+				for (int64 block=begin;block<end;block++){
+					int i=block/blocks;
+					int j0=(block%blocks)*kQueryTile;
+					int j1=std::min(j0+kQueryTile,n);
+					knntiled(queries+int64(i)*3*n,n,j0,j1,references+int64(i)*3*m,m,k,width,&tile[0],
+						idx+int64(i)*n*k,dist+int64(i)*n*k);
+				}
+			});
+		}
+	private:
+		int k_;
+		int64 memory_budget_;
+};
+REGISTER_KERNEL_BUILDER(Name("KnnTiled").Device(DEVICE_CPU), KnnTiledOp);
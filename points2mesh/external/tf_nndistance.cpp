@@ -1,5 +1,7 @@
 #include "tensorflow/core/framework/op.h"
 #include "tensorflow/core/framework/op_kernel.h"
+#include "tensorflow/core/util/work_sharder.h"
+#include "kdtree.h"
 REGISTER_OP("NnDistance")
 	.Input("xyz1: float32")
 	.Input("xyz2: float32")
@@ -18,28 +20,31 @@ REGISTER_OP("NnDistanceGrad")
 	.Output("grad_xyz2: float32");
 using namespace tensorflow;
 
-static void nnsearch(int b,int n,int m,const float * xyz1,const float * xyz2,float * dist,int * idx){
-	for (int i=0;i<b;i++){
-		for (int j=0;j<n;j++){
-			float x1=xyz1[(i*n+j)*3+0];
-			float y1=xyz1[(i*n+j)*3+1];
-			float z1=xyz1[(i*n+j)*3+2];
-			double best=0;
+// Nearest neighbor in xyz2 [b,m,3] of every point of xyz1 [b,n,3], one kd-tree per batch sample
+static void nnsearch(OpKernelContext * context,int b,int n,int m,const float * xyz1,const float * xyz2,float * dist,int * idx){
+	if (b==0 || n==0)
+		return;
+	// Nothing to search, report distance 0 to index 0 like the original kernel
+	if (m==0){
+		std::fill(dist,dist+int64(b)*n,0.0f);
+		std::fill(idx,idx+int64(b)*n,0);
+		return;
+	}
+	auto pool=context->device()->tensorflow_cpu_worker_threads();
+	std::vector<KdTree> trees(b);
+	Shard(pool->num_threads,pool->workers,b,int64(m)*20,[&](int64 begin,int64 end){
+		for (int64 i=begin;i<end;i++)
+			kdtree(xyz2+i*m*3,m,3,1,trees[i]);
+	});
+	Shard(pool->num_threads,pool->workers,int64(b)*n,kLeafSize*16,[&](int64 begin,int64 end){
+		for (int64 j=begin;j<end;j++){
+			float best=std::numeric_limits<float>::infinity();
 			int besti=0;
-			for (int k=0;k<m;k++){
-				float x2=xyz2[(i*m+k)*3+0]-x1;
-				float y2=xyz2[(i*m+k)*3+1]-y1;
-				float z2=xyz2[(i*m+k)*3+2]-z1;
-				double d=x2*x2+y2*y2+z2*z2;
-				if (k==0 || d<best){
-					best=d;
-					besti=k;
-				}
-			}
-			dist[i*n+j]=best;
-			idx[i*n+j]=besti;
+			kdsearch(trees[j/n],0,xyz1+j*3,1,&best,&besti);
+			dist[j]=best;
+			idx[j]=besti;
 		}
-	}
+	});
 }
 
 class NnDistanceOp : public OpKernel{
@@ -76,8 +81,8 @@ class NnDistanceOp : public OpKernel{
 			int * idx1=&(idx1_flat(0));
 			float * dist2=&(dist2_flat(0));
 			int * idx2=&(idx2_flat(0));
-			nnsearch(b,n,m,xyz1,xyz2,dist1,idx1);
-			nnsearch(b,m,n,xyz2,xyz1,dist2,idx2);
+			nnsearch(context,b,n,m,xyz1,xyz2,dist1,idx1);
+			nnsearch(context,b,m,n,xyz2,xyz1,dist2,idx2);
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("NnDistance").Device(DEVICE_CPU), NnDistanceOp);
@@ -127,44 +132,51 @@ class NnDistanceGradOp : public OpKernel{
 				grad_xyz1[i]=0;
 			for (int i=0;i<b*m*3;i++)
 				grad_xyz2[i]=0;
-			for (int i=0;i<b;i++){
-				for (int j=0;j<n;j++){
-					float x1=xyz1[(i*n+j)*3+0];
-					float y1=xyz1[(i*n+j)*3+1];
-					float z1=xyz1[(i*n+j)*3+2];
-					int j2=idx1[i*n+j];
-					float x2=xyz2[(i*m+j2)*3+0];
-					float y2=xyz2[(i*m+j2)*3+1];
-					float z2=xyz2[(i*m+j2)*3+2];
-					float g=grad_dist1[i*n+j]*2;
-					grad_xyz1[(i*n+j)*3+0]+=g*(x1-x2);
-					grad_xyz1[(i*n+j)*3+1]+=g*(y1-y2);
-					grad_xyz1[(i*n+j)*3+2]+=g*(z1-z2);
-					grad_xyz2[(i*m+j2)*3+0]-=(g*(x1-x2));
-					grad_xyz2[(i*m+j2)*3+1]-=(g*(y1-y2));
-					grad_xyz2[(i*m+j2)*3+2]-=(g*(z1-z2));
+			// Gradients scatter to the nearest neighbors within a batch sample, so samples are the unit of work
+			auto pool=context->device()->tensorflow_cpu_worker_threads();
+			Shard(pool->num_threads,pool->workers,b,int64(n+m)*30,[&](int64 begin,int64 end){
+				for (int i=begin;i<end;i++){
+					for (int j=0;j<n;j++){
+						float x1=xyz1[(i*n+j)*3+0];
+						float y1=xyz1[(i*n+j)*3+1];
+						float z1=xyz1[(i*n+j)*3+2];
+						int j2=idx1[i*n+j];
+						float x2=xyz2[(i*m+j2)*3+0];
+						float y2=xyz2[(i*m+j2)*3+1];
+						float z2=xyz2[(i*m+j2)*3+2];
+						float g=grad_dist1[i*n+j]*2;
+						grad_xyz1[(i*n+j)*3+0]+=g*(x1-x2);
+						grad_xyz1[(i*n+j)*3+1]+=g*(y1-y2);
+						grad_xyz1[(i*n+j)*3+2]+=g*(z1-z2);
+						grad_xyz2[(i*m+j2)*3+0]-=(g*(x1-x2));
+						grad_xyz2[(i*m+j2)*3+1]-=(g*(y1-y2));
+						grad_xyz2[(i*m+j2)*3+2]-=(g*(z1-z2));
+					}
+					for (int j=0;j<m;j++){
+						float x1=xyz2[(i*m+j)*3+0];
+						float y1=xyz2[(i*m+j)*3+1];
+						float z1=xyz2[(i*m+j)*3+2];
+						int j2=idx2[i*m+j];
+						float x2=xyz1[(i*n+j2)*3+0];
+						float y2=xyz1[(i*n+j2)*3+1];
+						float z2=xyz1[(i*n+j2)*3+2];
+						float g=grad_dist2[i*m+j]*2;
+						grad_xyz2[(i*m+j)*3+0]+=g*(x1-x2);
+						grad_xyz2[(i*m+j)*3+1]+=g*(y1-y2);
+						grad_xyz2[(i*m+j)*3+2]+=g*(z1-z2);
+						grad_xyz1[(i*n+j2)*3+0]-=(g*(x1-x2));
+						grad_xyz1[(i*n+j2)*3+1]-=(g*(y1-y2));
+						grad_xyz1[(i*n+j2)*3+2]-=(g*(z1-z2));
+					}
 				}
-				for (int j=0;j<m;j++){
-					float x1=xyz2[(i*m+j)*3+0];
-					float y1=xyz2[(i*m+j)*3+1];
-					float z1=xyz2[(i*m+j)*3+2];
-					int j2=idx2[i*m+j];
-					float x2=xyz1[(i*n+j2)*3+0];
-					float y2=xyz1[(i*n+j2)*3+1];
-					float z2=xyz1[(i*n+j2)*3+2];
-					float g=grad_dist2[i*m+j]*2;
-					grad_xyz2[(i*m+j)*3+0]+=g*(x1-x2);
-					grad_xyz2[(i*m+j)*3+1]+=g*(y1-y2);
-					grad_xyz2[(i*m+j)*3+2]+=g*(z1-z2);
-					grad_xyz1[(i*n+j2)*3+0]-=(g*(x1-x2));
-					grad_xyz1[(i*n+j2)*3+1]-=(g*(y1-y2));
-					grad_xyz1[(i*n+j2)*3+2]-=(g*(z1-z2));
-				}
-			}
+			});
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("NnDistanceGrad").Device(DEVICE_CPU), NnDistanceGradOp);
 
+// Built without the CUDA kernels by the cpu make target
+#ifndef NNDISTANCE_CPU_ONLY
+
 void NmDistanceKernelLauncher(int b,int n,const float * xyz,int m,const float * xyz2,float * result,int * result_i,float * result2,int * result2_i);
 class NnDistanceGpuOp : public OpKernel{
 	public:
@@ -252,3 +264,4 @@ class NnDistanceGradGpuOp : public OpKernel{
 		}
 };
 REGISTER_KERNEL_BUILDER(Name("NnDistanceGrad").Device(DEVICE_GPU), NnDistanceGradGpuOp);
+#endif
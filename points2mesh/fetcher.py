@@ -1,60 +1,185 @@
+import os
+import sys
+import argparse
+import multiprocessing
+
 import numpy as np
-import cPickle as pickle
-import threading
-import Queue
-# np.random.seed(123)
-
-
-class DataFetcher(threading.Thread):
-    def __init__(self, file_list):
-        super(DataFetcher, self).__init__()
-        self.stopped = False
-        self.queue = Queue.Queue(64)
-
-        self.pkl_list = []
-        with open(file_list, 'r') as f:
-            while(True):
-                line = f.readline().strip()
-                if not line:
-                    break
-                self.pkl_list.append(line)
-        self.index = 0
-        self.number = len(self.pkl_list)
-        np.random.shuffle(self.pkl_list)
-
-    def work(self, idx):
-        pkl_path = self.pkl_list[idx]
-        pkl = pickle.load(open(pkl_path, 'rb'))
-        img = pkl[0].astype('float32')/255.0
-        label = pkl[1]
-
-        return img, label, pkl_path.split('/')[-1]
-
-    def run(self):
-        while self.index < 90000000 and not self.stopped:
-            self.queue.put(self.work(self.index % self.number))
-            self.index += 1
-            if self.index % self.number == 0:
-                np.random.shuffle(self.pkl_list)
-
-    def fetch(self):
-        if self.stopped:
-            return None
-        return self.queue.get()
-
-    def shutdown(self):
-        self.stopped = True
-        while not self.queue.empty():
-            self.queue.get()
+from six.moves import cPickle as pickle
+from six.moves import queue
+from tensorpack.dataflow import RNGDataFlow, TestDataSpeed
+from tensorpack.utils.concurrency import ensure_proc_terminate, start_proc_mask_signal
+from tensorpack.utils import logger
+
+
+def read_file_list(file_list):
+    """
+    :param file_list: Text file with one path per line
+    :return: List of paths
+    """
+    with open(file_list, 'r') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_pointcloud_file(path):
+    """
+    Loads a point cloud stored in its own file.
+
+    - .npz with an array 'points' of shape [3 or 6, N] or [N, 3 or 6] and an optional scalar 'label'
+    - .pkl with a dict of the same keys or a tuple (points, label)
+
+    :return: Record [label, positions, normals] of shapes [3, N] and [3 or 0, N] like the lmdb records,
+     label is -1 if the file has none
+    """
+    if path.endswith('.npz'):
+        with np.load(path) as data:
+            points = data['points']
+            label = int(data['label']) if 'label' in data else -1
+    else:
+        with open(path, 'rb') as f:
+            if sys.version_info[0] >= 3:
+                data = pickle.load(f, encoding='latin1')
+            else:
+                data = pickle.load(f)
+        if isinstance(data, dict):
+            points, label = data['points'], data.get('label', -1)
+        else:
+            points, label = data[0], data[1]
+    points = np.asarray(points, dtype=np.float32)
+    if points.shape[0] not in [3, 6]:
+        points = points.T
+    assert points.shape[0] in [3, 6], "Expected 3 or 6 channels, got shape " + str(points.shape)
+    return [label, points[:3], points[3:6]]
+
+
+def _load_worker(tasks, results):
+    while True:
+        path = tasks.get()
+        if path is None:
+            return
+        try:
+            results.put(load_pointcloud_file(path))
+        except Exception as e:
+            results.put(e.__class__.__name__ + " in " + path + ": " + str(e))
+
+
+class PointCloudFileData(RNGDataFlow):
+    """
+    Reads file-per-object point cloud data sets of .pkl and .npz files with a pool of worker processes.
+    Produces records [label, positions, normals] like LMDBCategoryData.
+
+    The paths are reshuffled every epoch and handed to the workers one at a time. At most buffer_size files
+    are in flight, which bounds memory. Every file is read exactly once per epoch, unreadable files are
+    skipped with a warning. Workers exit on close(), when the dataflow is garbage collected or when
+    the process exits. A worker that dies while files are in flight raises a RuntimeError.
+
+    The dataflow starts its own processes, so it is a top-level source only: it cannot be reset inside
+    daemonic prefetch workers (SharedMemoryPrefetchData, PrefetchDataZMQ), and copies in several prefetch
+    workers would each read every file. Prefetch the datapoints derived from it in the main process instead.
+    """
+
+    def __init__(self, file_list, num_proc=4, shuffle=True, buffer_size=64, timeout=10.0):
+        """
+        :param file_list: Text file with one path per line or list of paths
+        :param num_proc: Number of worker processes
+        :param shuffle: Wether to reshuffle the files every epoch
+        :param buffer_size: Maximum number of files loaded ahead
+        :param timeout: Seconds between checks wether the workers are alive while waiting for a file
+        """
+        self.paths = file_list if isinstance(file_list, list) else read_file_list(file_list)
+        for path in self.paths:
+            assert os.path.splitext(path)[1] in ['.pkl', '.npz'], "Unsupported file " + path
+        assert num_proc > 0 and buffer_size > 0
+        self.num_proc = num_proc
+        self.shuffle = shuffle
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self._procs = None
+        self._in_flight = 0
+
+    def reset_state(self):
+        super(PointCloudFileData, self).reset_state()
+        if self._procs is not None:
+            return
+        if multiprocessing.current_process().daemon:
+            raise RuntimeError("PointCloudFileData starts worker processes and cannot be reset in a "
+                               "daemonic process, e.g. a prefetch worker. Use it as the top-level source")
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._procs = [multiprocessing.Process(target=_load_worker, args=(self._tasks, self._results))
+                       for _ in range(self.num_proc)]
+        for proc in self._procs:
+            proc.daemon = True
+        ensure_proc_terminate(self._procs)
+        start_proc_mask_signal(self._procs)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results.get(timeout=self.timeout)
+            except queue.Empty:
+                dead = [proc for proc in self._procs if not proc.is_alive()]
+                if dead:
+                    raise RuntimeError("PointCloudFileData worker exited with code " +
+                                       str(dead[0].exitcode) + " while loading files")
+
+    def __iter__(self):
+        # Discard files still in flight from an epoch that was not iterated to the end
+        while self._in_flight > 0:
+            self._get_result()
+            self._in_flight -= 1
+        paths = list(self.paths)
+        if self.shuffle:
+            self.rng.shuffle(paths)
+        pending = iter(paths)
+        for path in pending:
+            self._tasks.put(path)
+            self._in_flight += 1
+            if self._in_flight == self.buffer_size:
+                break
+        while self._in_flight > 0:
+            record = self._get_result()
+            self._in_flight -= 1
+            # Refill before yielding, so workers stay busy while the record is consumed
+            for path in pending:
+                self._tasks.put(path)
+                self._in_flight += 1
+                break
+            if isinstance(record, str):
+                logger.warn("Skipping file, " + record)
+                continue
+            yield record
+
+    def close(self):
+        """
+        Stops the workers. The dataflow cannot be iterated afterwards.
+        """
+        if self._procs is None:
+            return
+        for _ in self._procs:
+            self._tasks.put(None)
+        for proc in self._procs:
+            proc.join(timeout=5.0)
+            if proc.is_alive():
+                proc.terminate()
+        self._procs = None
+        self._in_flight = 0
+
+    def __del__(self):
+        self.close()
 
 
 if __name__ == '__main__':
-    file_list = sys.argv[1]
-    data = DataFetcher(file_list)
-    data.start()
-
-    image, point, _ = data.fetch()
-    print image.shape
-    print point.shape
-    print normal.shape
-    data.stopped = True
+    parser = argparse.ArgumentParser(description='Measure reading speed of point cloud files')
+    parser.add_argument('file_list', help='text file with one .pkl or .npz path per line')
+    parser.add_argument('--num_proc', type=int, default=4)
+    args = parser.parse_args()
+
+    df = PointCloudFileData(args.file_list, num_proc=args.num_proc)
+    df.reset_state()
+    label, positions, normals = next(iter(df))
+    logger.info("label %s, positions %s, normals %s" % (label, positions.shape, normals.shape))
+    TestDataSpeed(df, 1000).start()
+    df.close()
@@ -17,7 +17,9 @@
 # Authors: Fabian Groh, Patrick Wieschollek, Hendrik P.A. Lensch
 
 
+import os
 import tensorflow as tf
+from tensorpack.utils import logger
 from user_ops import flex_convolution as _flex_convolution
 from user_ops import flex_pooling as _flex_pooling
 from user_ops import knn_bruteforce as _knn_bruteforce
@@ -33,7 +35,25 @@ from tensorflow.python.framework import ops
 
 all = ['FlexPooling', 'FlexConvolution', 'FlexConvolutionTranspose',
        'flex_pooling', 'flex_convolution', 'flex_convolution_transpose',
-       'knn_bruteforce', 'KnnBruteforce', 'knn_bf_sym']
+       'knn_bruteforce', 'KnnBruteforce', 'knn_bf_sym', 'knn_search', 'knn_neighborhood']
+
+# Searches comparing more point pairs than this use the kd-tree op
+KDTREE_MIN_PAIRS = 2 ** 24
+
+
+def _load_knn_library(name, op_name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'external', name)
+    try:
+        module = tf.load_op_library(path)
+    except tf.errors.NotFoundError:
+        logger.warn("external/%s not built, %s is not available" % (name, op_name))
+        return None
+    ops.NotDifferentiable(op_name)
+    return module
+
+
+_knn_kdtree_module = _load_knn_library('tf_knn_kdtree_so.so', 'KnnKdtree')
+_knn_tiled_module = _load_knn_library('tf_knn_tiled_so.so', 'KnnTiled')
 
 
 def _remove_dim(x, axis=2):
@@ -124,7 +144,7 @@ class KnnBruteforce(Layer):
         if self.data_format == 'expanded':
             positions = _remove_dim(positions, 2)
 
-        NN, _, _ = _knn_bruteforce(positions, K=4)
+        NN, _, _ = _knn_bruteforce(positions, K=self.K)
         NN = tf.transpose(NN, [0, 2, 1])
 
         if self.data_format == 'expanded':
@@ -143,6 +163,71 @@ def knn_bruteforce(positions,
     return layer.apply(positions)
 
 
+def knn_search(queries,
+               references,
+               K,
+               min_pairs=KDTREE_MIN_PAIRS,
+               memory_budget=0,
+               name=None):
+    """K nearest neighbors in references of every query point.
+
+    Small searches run brute-force with knn_bf_sym. When the number of
+    compared pairs N * M exceeds min_pairs, a kd-tree is built over every
+    reference cloud on the CPU instead. If N or M is unknown while building
+    the graph, the choice is made at run time from the actual sizes.
+    With a memory_budget in bytes, the brute-force searches run on the CPU
+    over tiles of queries and references whose distance buffers stay within
+    the budget, rather than on one dense [N, M] buffer.
+
+    Inputs:
+        queries: A `Tensor` of the format [B, Dp, N].
+        references: A `Tensor` of the format [B, Dp, M], M >= K.
+
+    Outputs:
+        neighborhoods: A `Tensor` of the format [B, N, K] (tf.int32).
+        distances: A `Tensor` of the format [B, N, K].
+    """
+    with tf.name_scope(name, "knn_search", [queries, references]):
+        def kdtree():
+            return _knn_kdtree_module.knn_kdtree(queries, references, K=K)
+
+        def bruteforce():
+            if _knn_tiled_module is not None and memory_budget > 0:
+                return _knn_tiled_module.knn_tiled(queries, references, K=K,
+                                                   memory_budget=memory_budget)
+            NN, dist, _ = knn_bf_sym(queries, references, K=K)
+            return NN, dist
+
+        if _knn_kdtree_module is None:
+            return bruteforce()
+        N = queries.shape[2].value
+        M = references.shape[2].value
+        if N is not None and M is not None:
+            return kdtree() if N * M > min_pairs else bruteforce()
+        pairs = tf.to_int64(tf.shape(queries)[2]) * tf.to_int64(tf.shape(references)[2])
+        return tf.cond(pairs > min_pairs, kdtree, bruteforce)
+
+
+def knn_neighborhood(positions,
+                     K,
+                     name=None):
+    """Neighborhoods of a point cloud with the distances to the neighbors.
+
+    One search serves the flex convolutions and pooling as well as density
+    estimates on the same positions.
+
+    Inputs:
+        positions: A `Tensor` of the format [B, Dp, N].
+
+    Outputs:
+        neighborhoods: A `Tensor` of the format [B, K, N] (tf.int32).
+        distances: A `Tensor` of the format [B, N, K].
+    """
+    with tf.name_scope(name, "knn_neighborhood", [positions]):
+        NN, dist = knn_search(positions, positions, K=K)
+        return tf.transpose(NN, [0, 2, 1]), dist
+
+
 class FlexPooling(Layer):
     """flex pooling layer.
 
@@ -6,6 +6,7 @@ import cv2
 from models import *
 from fetcher import *
 from pc_meshlab_loader import *
+from staged_inference import load_predictor, AdaptivePredictor
 import re
 import cPickle as pickle
 import time
@@ -31,14 +32,21 @@ flags.DEFINE_integer('feature_depth', 32,
 flags.DEFINE_integer('coord_dim', 3, 'Number of units in output layer')
 flags.DEFINE_float('weight_decay', 5e-6, 'Weight decay for L2 loss.')
 flags.DEFINE_float('collapse_epsilon', 0.008, 'Collapse loss epsilon')
+flags.DEFINE_float('collapse_softness', 0.0,
+                   'Width of the sigmoid replacing the collapse loss threshold, 0 keeps the hard threshold')
 flags.DEFINE_integer('pc_num', PC['num'],
                      'Number of points per pointcloud object')
 flags.DEFINE_integer('dp', 3, 'Dimension of points in pointcloud')
 flags.DEFINE_integer(
     'num_neighbors', 6, 'Number of neighbors considered during Graph projection layer')
 flags.DEFINE_integer('batch_size', 1, 'Batchsize')
+flags.DEFINE_integer('knn_memory_budget', 0,
+                     'Megabytes of distance buffers for tiled brute-force knn on the CPU, 0 runs knn_bf_sym')
 flags.DEFINE_string('base_model_path', 'utils/ellipsoid/info_ellipsoid.dat',
                     'Path to base model for mesh deformation')
+flags.DEFINE_integer('stages', 3, 'Last deformation stage built, 1, 2 or 3')
+flags.DEFINE_float('early_exit_chamfer', 0.0,
+                   'Stop after the first stage closer to the input cloud than this chamfer distance, 0 disables')
 # flags.DEFINE_string('base_model_path', 'utils/ellipsoid/torus_small.dat',
 #                    'Path to base model for mesh deformation')
 # flags.DEFINE_string('base_model_path', 'utils/ellipsoid/ellipsoid.dat',
@@ -88,9 +96,11 @@ def create_inference_mesh(vertices, num, pc,  path_to_input, output, display_mes
 
 
 def predict(predictor, data, path):
-    vertices_1 = predictor(data)[0]
-    vertices_2 = predictor(data)[1]
-    vertices_3 = predictor(data)[2]
+    # Outputs are batched [B, N, 3], data holds a single point cloud
+    if isinstance(predictor, AdaptivePredictor):
+        meshes, _ = predictor(data)
+    else:
+        meshes = predictor(data)
 
     #pkl = pickle.load(open(FLAGS.base_model_path, 'rb'))
     #coord = pkl[0]
@@ -98,22 +108,15 @@ def predict(predictor, data, path):
     #vertices_2 = coord
     #vertices_3 = coord
 
-    return [vertices_1, vertices_2, vertices_3]
+    return [mesh[0] for mesh in meshes]
 
 
 def loadModel():
-    prediction = PredictConfig(
-        session_init=get_model_loader(
-            "/graphics/scratch/students/heid/train_log/true_c1_7500_big2_/checkpoint"),
-        model=FlexmeshModel(PC, name="Flexmesh"),
-        input_names=['positions'],
-        output_names=['mesh_outputs/output1',
-                      'mesh_outputs/output2',
-                      'mesh_outputs/output3']
-    )
+    checkpoint = "/graphics/scratch/students/heid/train_log/true_c1_7500_big2_/checkpoint"
     # predict mesh
-    predictor = OfflinePredictor(prediction)
-    return predictor
+    if FLAGS.early_exit_chamfer > 0:
+        return AdaptivePredictor(checkpoint, PC, FLAGS.early_exit_chamfer, stages=FLAGS.stages)
+    return load_predictor(checkpoint, PC, stages=FLAGS.stages)
 
 
 def loadTxtFiles(path):
@@ -163,6 +166,6 @@ pc = '/graphics/scratch/students/heid/evaluation_set/custom/pr7500.txt'
 path_pc = pc
 pc_inp = load_pc(path_pc, num_points=PC['num'])
 vertices = predict(predictor, pc_inp, path_pc)
-create_inference_mesh(vertices[2], 3, pc,
+create_inference_mesh(vertices[-1], len(vertices), pc,
                       path_pc, path_output, display_mesh=False, num_obj=counter)
 counter = counter + 1
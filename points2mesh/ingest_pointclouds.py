@@ -0,0 +1,317 @@
+"""
+Ingests raw point clouds and meshes into the lmdb training store read by PointCloudDataFlow.
+
+Expects one directory per category below the input root, e.g.
+
+    root/airplane/airplane_0627.off
+    root/chair/scan_01.ply
+    root/chair/scan_02.xyz
+
+Supported formats are
+    .xyz, .txt  - one point per line, 3 (x y z) or 6 (x y z nx ny nz) comma or whitespace separated columns
+    .ply        - ascii or binary vertex element with x, y, z and optional nx, ny, nz properties
+    .off        - vertices and faces. Points are sampled on the surface, weighted by face area
+
+Every file is parsed, normalized to the unit sphere and resampled to the configured number of points
+by a pool of worker processes. Records [label, array(3 or 6, num_points)] are written in bulk
+transactions with LMDBSerializer, followed by the sidecar category index.
+Missing normals are estimated from the local neighborhood.
+
+Example:
+    python ingest_pointclouds.py /data/scans model40-train-10000.lmdb --num_points 10000 --normals
+"""
+
+import os
+import argparse
+import multiprocessing
+
+import numpy as np
+from scipy.spatial import cKDTree
+from tensorpack.dataflow import DataFlow
+from tensorpack.dataflow.serialize import LMDBSerializer
+from tensorpack.utils import logger
+
+from PointCloudDataFlow import build_category_index
+from pointcloud_shards import convert_lmdb_to_shards
+
+# Category ids as listed in PointCloudDataFlow.get_allowed_categories
+MODELNET40_CATEGORIES = [
+    "airplane", "bathtub", "bed", "bench", "bookshelf", "bottle", "bowl", "car", "chair", "cone",
+    "cup", "curtain", "desk", "door", "dresser", "flower_pot", "glass_box", "guitar", "keyboard",
+    "lamp", "laptop", "mantel", "monitor", "night_stand", "person", "piano", "plant", "radio",
+    "range_hood", "sink", "sofa", "stairs", "stool", "table", "tent", "toilet", "tv_stand", "vase",
+    "wardrobe", "xbox"]
+
+EXTENSIONS = ['.xyz', '.txt', '.ply', '.off']
+
+_PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+def load_xyz(path):
+    """
+    :return: Points of shape [N, 3] and normals of shape [N, 3] or None
+    """
+    with open(path, 'r') as f:
+        first = f.readline()
+    data = np.loadtxt(path, delimiter=',' if ',' in first else None, ndmin=2)
+    normals = data[:, 3:6] if data.shape[1] >= 6 else None
+    return data[:, :3], normals
+
+
+def load_ply(path):
+    """
+    Reads the vertex element of a ply file. The vertex element has to be the first element.
+
+    :return: Points of shape [N, 3] and normals of shape [N, 3] or None
+    """
+    with open(path, 'rb') as f:
+        assert f.readline().strip() == b'ply', "Not a ply file: " + path
+        fmt = None
+        num_vertices = None
+        properties = []
+        element = None
+        while True:
+            line = f.readline().decode('ascii').strip()
+            if line == 'end_header':
+                break
+            words = line.split()
+            if not words:
+                continue
+            if words[0] == 'format':
+                fmt = words[1]
+            elif words[0] == 'element':
+                element = words[1]
+                if element == 'vertex':
+                    assert not properties and num_vertices is None, \
+                        "vertex has to be the first element: " + path
+                    num_vertices = int(words[2])
+            elif words[0] == 'property' and element == 'vertex':
+                assert words[1] != 'list', "Unsupported vertex list property: " + path
+                properties.append((words[2], _PLY_TYPES[words[1]]))
+        names = [name for name, _ in properties]
+
+        if fmt == 'ascii':
+            data = np.loadtxt(f, max_rows=num_vertices, ndmin=2)
+            columns = dict((name, data[:, i]) for i, name in enumerate(names))
+        else:
+            assert fmt in ['binary_little_endian', 'binary_big_endian'], \
+                "Unsupported ply format: " + str(fmt)
+            order = '<' if fmt == 'binary_little_endian' else '>'
+            dtype = np.dtype([(name, order + t) for name, t in properties])
+            data = np.frombuffer(f.read(dtype.itemsize * num_vertices), dtype=dtype)
+            columns = dict((name, data[name]) for name in names)
+
+    points = np.stack([columns['x'], columns['y'], columns['z']], axis=1)
+    normals = None
+    if all(n in columns for n in ['nx', 'ny', 'nz']):
+        normals = np.stack([columns['nx'], columns['ny'], columns['nz']], axis=1)
+    return points, normals
+
+
+def load_off(path, num_points, rng):
+    """
+    Samples num_points points on the surface of an off mesh, weighted by face area.
+    Normals are the normals of the sampled faces.
+    Meshes without faces are treated as point clouds.
+
+    :return: Points of shape [N, 3] and normals of shape [N, 3] or None
+    """
+    with open(path, 'r') as f:
+        tokens = f.read().split()
+    # Some ModelNet files have the counts glued to the header, e.g. "OFF490 518 0"
+    assert tokens[0].startswith('OFF'), "Not an off file: " + path
+    if tokens[0] != 'OFF':
+        tokens = [tokens[0][3:]] + tokens[1:]
+    else:
+        tokens = tokens[1:]
+    num_vertices, num_faces = int(tokens[0]), int(tokens[1])
+    values = tokens[3:]
+    vertices = np.array(values[:3 * num_vertices], dtype=np.float64).reshape(num_vertices, 3)
+    if num_faces == 0:
+        return vertices, None
+
+    # Faces are "n i_1 ... i_n", polygons are fanned into triangles
+    faces = np.array(values[3 * num_vertices:], dtype=np.int64)
+    triangles = []
+    pos = 0
+    for _ in range(num_faces):
+        n = faces[pos]
+        polygon = faces[pos + 1:pos + 1 + n]
+        for k in range(1, n - 1):
+            triangles.append([polygon[0], polygon[k], polygon[k + 1]])
+        pos += n + 1
+    triangles = vertices[np.array(triangles)]
+
+    cross = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+    area = np.linalg.norm(cross, axis=1)
+    face_idx = rng.choice(len(triangles), num_points, p=area / area.sum())
+    # Uniform barycentric coordinates
+    u, v = rng.random_sample(num_points), rng.random_sample(num_points)
+    flip = u + v > 1
+    u[flip], v[flip] = 1 - u[flip], 1 - v[flip]
+    t = triangles[face_idx]
+    points = t[:, 0] + u[:, None] * (t[:, 1] - t[:, 0]) + v[:, None] * (t[:, 2] - t[:, 0])
+    normals = cross[face_idx] / np.maximum(area[face_idx], 1e-12)[:, None]
+    return points, normals
+
+
+def estimate_normals(points, K=16):
+    """
+    Estimates unoriented normals as the direction of least variance of the K nearest neighbors.
+
+    :param points: Points of shape [N, 3]
+    :return: Normals of shape [N, 3]
+    """
+    K = min(K, len(points))
+    _, neighbors = cKDTree(points).query(points, k=K)
+    local = points[neighbors] - points[neighbors].mean(axis=1, keepdims=True)
+    covariance = np.einsum('nki,nkj->nij', local, local)
+    _, eigenvectors = np.linalg.eigh(covariance)
+    return eigenvectors[:, :, 0]
+
+
+def normalize_points(points):
+    """
+    Centers points at the center of their bounding box and scales them into the unit sphere.
+    """
+    points = points - (points.min(axis=0) + points.max(axis=0)) / 2
+    return points / max(np.linalg.norm(points, axis=1).max(), 1e-12)
+
+
+def resample_points(points, normals, num_points, rng):
+    """
+    Draws num_points points without replacement, or with replacement if there are too few.
+    """
+    idx = rng.choice(len(points), num_points, replace=len(points) < num_points)
+    return points[idx], None if normals is None else normals[idx]
+
+
+def load_record(task):
+    """
+    Loads one file into a training record. Runs in the worker processes.
+
+    :param task: (path, label, num_points, normals, seed)
+    :return: [label, array(3 or 6, num_points)] float32 or None if the file cannot be read
+    """
+    path, label, num_points, with_normals, seed = task
+    rng = np.random.RandomState(seed)
+    try:
+        ext = os.path.splitext(path)[1].lower()
+        if ext == '.off':
+            points, normals = load_off(path, num_points, rng)
+        elif ext == '.ply':
+            points, normals = load_ply(path)
+        else:
+            points, normals = load_xyz(path)
+        points, normals = resample_points(points, normals, num_points, rng)
+        points = normalize_points(points)
+        data = points.T
+        if with_normals:
+            if normals is None:
+                normals = estimate_normals(points)
+            normals = normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+            data = np.concatenate([points.T, normals.T], axis=0)
+        return [label, data.astype(np.float32)]
+    except Exception as e:
+        logger.warn("Skipping " + path + ": " + str(e))
+        return None
+
+
+def find_files(root, categories=MODELNET40_CATEGORIES):
+    """
+    Lists supported files in the category directories below root.
+    Category names not in categories get ids following the known ones.
+
+    :return: List of (path, label)
+    """
+    categories = list(categories)
+    files = []
+    for category in sorted(os.listdir(root)):
+        directory = os.path.join(root, category)
+        if not os.path.isdir(directory):
+            continue
+        if category not in categories:
+            categories.append(category)
+            logger.info("New category " + category + " has id " + str(len(categories) - 1))
+        label = categories.index(category)
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if os.path.splitext(filename)[1].lower() in EXTENSIONS:
+                    files.append((os.path.join(dirpath, filename), label))
+    return files
+
+
+class RawPointCloudData(DataFlow):
+    """
+    Parses raw point cloud files with a pool of worker processes.
+    Produces records [label, array(3 or 6, num_points)], unreadable files are skipped.
+    """
+
+    def __init__(self, files, num_points=10000, normals=True, parallel=None, seed=0):
+        """
+        :param files: List of (path, label)
+        :param num_points: Number of points per record
+        :param normals: Wether records include normals
+        :param parallel: Number of worker processes
+        :param seed: Seed of the per file resampling
+        """
+        self.files = files
+        self.num_points = num_points
+        self.normals = normals
+        self.parallel = parallel or multiprocessing.cpu_count()
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        tasks = [(path, label, self.num_points, self.normals, self.seed + i)
+                 for i, (path, label) in enumerate(self.files)]
+        pool = multiprocessing.Pool(self.parallel)
+        try:
+            for record in pool.imap(load_record, tasks, chunksize=8):
+                if record is not None:
+                    yield record
+        finally:
+            pool.terminate()
+
+
+def ingest(root, path, num_points=10000, normals=True, parallel=None, write_frequency=1000,
+           seed=0, shards=None):
+    """
+    Writes all supported files below root into a new lmdb training store at path
+    and builds its category index.
+
+    :param shards: If set, also converts the store into a shard directory at this path
+    """
+    files = find_files(root)
+    logger.info("Ingesting " + str(len(files)) + " files from " + root)
+    df = RawPointCloudData(files, num_points=num_points, normals=normals,
+                           parallel=parallel, seed=seed)
+    LMDBSerializer.save(df, path, write_frequency=write_frequency)
+    build_category_index(path, force=True)
+    if shards is not None:
+        convert_lmdb_to_shards(path, shards)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Ingest raw point clouds and meshes into the lmdb training store')
+    parser.add_argument('root', help='directory with one sub directory per category')
+    parser.add_argument('output', help='path of the lmdb file to create')
+    parser.add_argument('--num_points', type=int, default=10000)
+    parser.add_argument('--normals', action='store_true', help='store normals')
+    parser.add_argument('--parallel', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--write_frequency', type=int, default=1000,
+                        help='records per lmdb transaction')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shards', default=None, help='also write a shard directory')
+    args = parser.parse_args()
+
+    ingest(args.root, args.output, num_points=args.num_points, normals=args.normals,
+           parallel=args.parallel, write_frequency=args.write_frequency,
+           seed=args.seed, shards=args.shards)
@@ -1,7 +1,8 @@
 from inits import *
 import tensorflow as tf
 from tensorpack.utils import logger
-from flex_conv_layers import flex_convolution, flex_pooling, knn_bruteforce, knn_bf_sym
+from flex_conv_layers import flex_convolution, flex_pooling, knn_bruteforce, knn_bf_sym, knn_search
+from support_plan import support_matmul
 
 flags = tf.app.flags
 FLAGS = flags.FLAGS
@@ -85,7 +86,7 @@ class Layer(object):
 
 
 class GraphConvolution(Layer):
-    """Graph convolution layer."""
+    """Graph convolution layer on vertex-major features [N, B, F]."""
 
     def __init__(self, input_dim, output_dim, placeholders, dropout=False,
                  sparse_inputs=False, act=tf.nn.relu, bias=True, gcn_block_id=1,
@@ -104,10 +105,16 @@ class GraphConvolution(Layer):
             self.support = placeholders['support2']
         elif gcn_block_id == 3:
             self.support = placeholders['support3']
+        # All supports of the level in one adjacency, see ellipsoid.combine_supports.
+        # Sparse, dense or ELL per output width, as chosen by support_plan.read_plan
+        combined_support = placeholders.get('combined_support' + str(gcn_block_id))
+        self.combined_support = combined_support.get(output_dim) if combined_support else None
 
         self.sparse_inputs = sparse_inputs
         self.featureless = featureless
         self.bias = bias
+        self.input_dim = input_dim
+        self.output_dim = output_dim
 
         # helper variable for sparse dropout
         self.num_features_nonzero = 3  # placeholders['num_features_nonzero']
@@ -131,6 +138,15 @@ class GraphConvolution(Layer):
         else:
             x = tf.nn.dropout(x, 1 - self.dropout)
 
+        if self.combined_support is not None and not (self.sparse_inputs or self.featureless):
+            return self._fused_call(x)
+
+        # Vertex-major [N, B, F]: one dense product over [N * B, F] and one sparse
+        # product over [N, B * F] convolve the whole batch
+        B = tf.shape(x)[1]
+        if not self.featureless:
+            x = tf.reshape(x, [-1, self.input_dim])
+
         # convolve
         supports = list()
         for i in range(len(self.support)):
@@ -138,10 +154,35 @@ class GraphConvolution(Layer):
                 pre_sup = dot(x, self.vars['weights_' + str(i)],
                               sparse=self.sparse_inputs)
             else:
-                pre_sup = self.vars['weights_' + str(i)]
+                pre_sup = tf.tile(self.vars['weights_' + str(i)], [1, B])
+            pre_sup = tf.reshape(pre_sup, [tf.shape(self.support[i])[1], -1])
             support = dot(self.support[i], pre_sup, sparse=True)
             supports.append(support)
-        output = tf.add_n(supports)
+        output = tf.reshape(tf.add_n(supports), [-1, B, self.output_dim])
+
+        # bias
+        if self.bias:
+            output += self.vars['bias']
+
+        return self.act(output)
+
+    def _fused_call(self, x):
+        """Convolves with all supports in one dense and one sparse product.
+
+        x [N, B, F] @ [W_0 .. W_S-1] gives [N, B, S, O]. Interleaved per vertex as [N * S, B * O]
+        it is multiplied with the combined adjacency [N, N * S], which sums over the supports.
+        """
+        B = tf.shape(x)[1]
+        num_supports = len(self.support)
+        weights = tf.concat([self.vars['weights_' + str(i)]
+                             for i in range(num_supports)], 1)
+
+        pre_sup = dot(tf.reshape(x, [-1, self.input_dim]), weights)
+        pre_sup = tf.reshape(pre_sup, [-1, B, num_supports, self.output_dim])
+        pre_sup = tf.transpose(pre_sup, [0, 2, 1, 3])
+        pre_sup = tf.reshape(pre_sup, [-1, B * self.output_dim])
+        output = support_matmul(self.combined_support, pre_sup)
+        output = tf.reshape(output, [-1, B, self.output_dim])
 
         # bias
         if self.bias:
@@ -164,7 +205,7 @@ class GraphPooling(Layer):
     def _call(self, inputs):
         X = inputs
 
-        # Create vertices in the middle of each edge
+        # Create vertices in the middle of each edge, [E, B, F]
         add_feat = (1 / 2.0) * tf.reduce_sum(tf.gather(X, self.pool_idx), 1)
         '''
         graph_tension = self.get_vertex_tension(self.gt_pt,X)
@@ -247,7 +288,8 @@ class GraphAlignment(Layer):
 
 
 class GraphProjection(Layer):
-    """Graph Projection layer."""
+    """Graph Projection layer. Appends point cloud features of the K nearest points
+    to vertex-major vertex coordinates [N, B, 3]."""
 
     def __init__(self, placeholders, **kwargs):
         super(GraphProjection, self).__init__(**kwargs)
@@ -271,7 +313,7 @@ class GraphProjection(Layer):
         outputs = tf.concat([inputs,
                              stage_1[1],
                              stage_2[1],
-                             stage_3[1]], 1)
+                             stage_3[1]], -1)
         # outputs = tf.concat([inputs,
         #                    stage_0[0],
         #                    stage_1[0], stage_1[1],
@@ -282,12 +324,8 @@ class GraphProjection(Layer):
         return outputs
 
     def inverse_square_dist(self, target, distances):
-        assert target.shape.as_list()[0] == distances.shape.as_list()[0]
-
         distances = 1.0 / (1.0 + tf.square(distances))
-        distances_adjusted = tf.stack([distances] * target.shape.as_list()[2])
-        distances_adjusted = tf.transpose(distances_adjusted, [1, 2, 0])
-        target_adjusted = tf.multiply(target, distances_adjusted)
+        target_adjusted = tf.multiply(target, tf.expand_dims(distances, -1))
 
         return target_adjusted
 
@@ -300,13 +338,11 @@ class GraphProjection(Layer):
         knn_neighbors, knn_features = self.get_neighborhood(
             inputs, num_feature)
 
-        # Repeat [N,3] -> [N,K,3]
-        broadcasted_inputs = tf.stack(
-            [inputs] * knn_neighbors.shape.as_list()[1])
-        broadcasted_inputs = tf.transpose(broadcasted_inputs, [1, 0, 2])
-        vec_to_neighbors = tf.subtract(knn_neighbors, broadcasted_inputs)
+        # Broadcast [N,B,3] -> [N,B,K,3]
+        vec_to_neighbors = tf.subtract(
+            knn_neighbors, tf.expand_dims(inputs, 2))
 
-        knn_dist = tf.norm(vec_to_neighbors, ord='euclidean', axis=2)
+        knn_dist = tf.norm(vec_to_neighbors, ord='euclidean', axis=3)
 
         # Scale vectors towards neighbors depending on technique. Pick one\
 
@@ -322,21 +358,21 @@ class GraphProjection(Layer):
 
         # more ?
 
-        target_coord = tf.reduce_mean(target_coord, axis=1) + inputs
-        target_feature = tf.reduce_mean(target_feature, axis=1)
+        target_coord = tf.reduce_mean(target_coord, axis=2) + inputs
+        target_feature = tf.reduce_mean(target_feature, axis=2)
         return target_coord, target_feature
 
-    def get_neighborhood(self, inputs, num_feature):
-        coord = inputs
-
-        B = FLAGS.batch_size
-        Dp = coord.shape.as_list()[1]
-
-        if num_feature > 0:
-            D_feature = FLAGS.feature_depth * pow(2, num_feature-1)
+    def gather_neighbors(self, pc, knn):
+        """Gathers [B, D, M] point features at knn [B, N, K] into vertex-major [N, B, K, D]."""
+        B, N = tf.shape(knn)[0], tf.shape(knn)[1]
+        D = pc.shape.as_list()[1]
 
-        coord_expanded = tf.expand_dims(coord, -1)
+        Y = tf.transpose(pc, [0, 2, 1])
+        knnY = tf.batch_gather(Y, tf.reshape(knn, [B, N * self.K]))
+        knnY = tf.reshape(knnY, [B, N, self.K, D])
+        return tf.transpose(knnY, [1, 0, 2, 3])
 
+    def get_neighborhood(self, inputs, num_feature):
         # transform PC feature to usable format
         if num_feature > 0:
             pc_coords = self.pc_feat[num_feature][0]
@@ -344,32 +380,19 @@ class GraphProjection(Layer):
         else:
             pc_coords = self.pc_feat[num_feature]
 
-        ellipsoid = tf.transpose(coord_expanded, [2, 1, 0])
-
-        Y = tf.transpose(pc_coords, [0, 2, 1])
-        if num_feature > 0:
-            Y_feature = tf.transpose(pc_feature, [0, 2, 1])
-
-        N = ellipsoid.shape.as_list()[2]
-        # Neighbors: [B, K, N]
-        # Distances: [B, K, N]
-        knn, _, _ = knn_bf_sym(ellipsoid, pc_coords, K=self.K)
-        # Easier shape to work on
-        knnr = tf.reshape(knn, [1, B * N * self.K])
-
-        bv = tf.ones([B, N*self.K], dtype=tf.int32) * \
-            tf.constant(np.arange(0, B), shape=[B, 1], dtype=tf.int32)
+        # [N, B, Dp] -> [B, Dp, N]
+        ellipsoid = tf.transpose(inputs, [1, 2, 0])
 
-        knnr = tf.stack([tf.reshape(bv, [1, B*N*self.K]),
-                         tf.reshape(knn, [1, B*N*self.K])], -1)
-        knnY = tf.reshape(tf.gather_nd(Y, knnr), [B, N, self.K, Dp])
-        knnY_mean = tf.reduce_mean(knnY, axis=2)
+        # Neighbors: [B, N, K]
+        # Distances: [B, N, K]
+        knn, _ = knn_search(ellipsoid, pc_coords, K=self.K,
+                            memory_budget=FLAGS.knn_memory_budget * 2 ** 20)
+        knnY = self.gather_neighbors(pc_coords, knn)
 
         if num_feature > 0:
-            knnY_feature = tf.reshape(tf.gather_nd(Y_feature, knnr), [
-                                      B, N, self.K, D_feature])
-            return knnY[0], knnY_feature[0]
-        return knnY[0], knnY[0]
+            knnY_feature = self.gather_neighbors(pc_feature, knn)
+            return knnY, knnY_feature
+        return knnY, knnY
         '''
             if self.use_maximum:
                 max_features = tf.reduce_max(
@@ -1,7 +1,7 @@
 import tensorflow as tf
 from cd_dist import *
 from user_ops import knn_bruteforce as _knn_bruteforce
-from flex_conv_layers import knn_bf_sym
+from flex_conv_layers import knn_bf_sym, knn_search
 
 flags = tf.app.flags
 FLAGS = flags.FLAGS
@@ -38,19 +38,27 @@ def tension_loss(pred, positions, gt_positions, placeholders, block_id):
 
 
 def collapse_loss(pred):
-    # dist1, _, _, _  = nn_distance(pred,pred)
-    p = tf.transpose(pred, [1, 0])
-    p = tf.expand_dims(p, 0)
-    _, dist, _, = knn_bf_sym(p, p, K=2)
-    dist = tf.squeeze(dist)
-    dist1 = tf.identity(dist)
-    coll_loss = tf.map_fn(lambda x: tf.cond(
-        tf.less(x[1], FLAGS.collapse_epsilon),
-        lambda: 1.0,
-        lambda: 0.0), dist1)
-    sum_collapsed = tf.reduce_sum(coll_loss)
-    all_verts = pred.shape.as_list()[0]
-    return sum_collapsed/all_verts
+    """
+    Fraction of vertices closer than collapse_epsilon to their nearest other vertex.
+    With collapse_softness > 0 the step is replaced by a sigmoid of that width, so the
+    loss is differentiable and pushes collapsing vertices apart.
+
+    :param pred: Vertices [N, B, 3]
+    :return: Scalar loss
+    """
+    # [N, B, 3] -> [B, 3, N]
+    p = tf.transpose(pred, [1, 2, 0])
+    # The nearest neighbor of every vertex is the vertex itself
+    knn, _ = knn_search(p, p, K=2, memory_budget=FLAGS.knn_memory_budget * 2 ** 20)
+    # The search has no gradient, so the squared distances are computed from the positions
+    vertices = tf.transpose(pred, [1, 0, 2])
+    nearest = tf.batch_gather(vertices, knn[:, :, 1])
+    dist = tf.reduce_sum(tf.square(vertices - nearest), axis=-1)
+    if FLAGS.collapse_softness > 0:
+        collapsed = tf.sigmoid((FLAGS.collapse_epsilon - dist) / FLAGS.collapse_softness)
+    else:
+        collapsed = tf.cast(tf.less(dist, FLAGS.collapse_epsilon), tf.float32)
+    return tf.reduce_mean(collapsed)
 
 
 def point2triangle_loss(pred, placeholders, block_id):
@@ -61,12 +69,13 @@ def point2triangle_loss(pred, placeholders, block_id):
 
 
 def laplace_coord(pred, placeholders, block_id):
-    vertex = tf.concat([pred, tf.zeros([1, 3])], 0)
+    # pred is vertex-major [N, B, 3], the padding index points to a zero vertex
+    vertex = tf.concat([pred, tf.zeros_like(pred[:1])], 0)
     indices = placeholders['lape_idx'][block_id - 1][:, :8]
     weights = tf.cast(placeholders['lape_idx']
                       [block_id - 1][:, -1], tf.float32)
 
-    weights = tf.tile(tf.reshape(tf.reciprocal(weights), [-1, 1]), [1, 3])
+    weights = tf.reshape(tf.reciprocal(weights), [-1, 1, 1])
     laplace = tf.reduce_sum(tf.gather(vertex, indices), 1)
     laplace = tf.subtract(pred, tf.multiply(laplace, weights))
     return laplace
@@ -77,44 +86,67 @@ def laplace_loss(pred1, pred2, placeholders, block_id):
     lap2 = laplace_coord(pred2, placeholders, block_id)
 
     laplace_loss = tf.reduce_mean(tf.reduce_sum(
-        tf.square(tf.subtract(lap1, lap2)), 1)) * 1500
+        tf.square(tf.subtract(lap1, lap2)), -1)) * 1500
 
     move_loss = tf.reduce_mean(tf.reduce_sum(
-        tf.square(tf.subtract(pred1, pred2)), 1)) * 100
+        tf.square(tf.subtract(pred1, pred2)), -1)) * 100
     move_loss = tf.cond(tf.equal(block_id, 1), lambda: 0., lambda: move_loss)
     return laplace_loss + move_loss
 
 
 def unit(tensor):
     # return tf.nn.l2_normalize(tensor, dim=1)
-    return tf.nn.l2_normalize(tensor, axis=1)
+    return tf.nn.l2_normalize(tensor, axis=-1)
 
 
-def mesh_loss(pred, positions, gt_positions, vertex_normals, placeholders, block_id):
+def chamfer_to_input(pred, positions, mask=None, name=None):
+    """Symmetric chamfer distance [B] of vertex-major meshes [N, B, 3] to point clouds [B, 3, M].
+
+    With a mask [B, M] only the real input points enter the input to mesh term.
+    """
+    dist1, _, dist2, _ = batch_nn_distance(
+        tf.transpose(positions, [0, 2, 1]), tf.transpose(pred, [1, 0, 2]))
+    if mask is None:
+        dist1 = tf.reduce_mean(dist1, 1)
+    else:
+        # Padded points lie far away, they never are a vertex's nearest point but must not
+        # count as points the mesh misses
+        dist1 = tf.reduce_sum(dist1 * mask, 1) / tf.maximum(tf.reduce_sum(mask, 1), 1.0)
+    return tf.add(dist1, tf.reduce_mean(dist2, 1), name=name)
+
+
+def mesh_loss(pred, positions, gt_positions, vertex_normals, placeholders, block_id, gt_mask=None):
     chamfer_block_loss_metrics = [
         [0.55, 1.0], [0.75, 0.6], [1.0, 0.55]
     ]
-    gt_pt = tf.transpose(gt_positions[0], [1, 0])
-    gt_nm = tf.transpose(vertex_normals[0], [1, 0])
+    # [B, 3, M] -> [B, M, 3]
+    gt_pt = tf.transpose(gt_positions, [0, 2, 1])
+    gt_nm = tf.transpose(vertex_normals, [0, 2, 1])
+    # vertex-major [N, B, 3] -> [B, N, 3]
+    pred = tf.transpose(pred, [1, 0, 2])
 
     # edge in graph
-    nod1 = tf.gather(pred, placeholders['edges'][block_id - 1][:, 0])
-    nod2 = tf.gather(pred, placeholders['edges'][block_id - 1][:, 1])
+    nod1 = tf.gather(pred, placeholders['edges'][block_id - 1][:, 0], axis=1)
+    nod2 = tf.gather(pred, placeholders['edges'][block_id - 1][:, 1], axis=1)
     edge = tf.subtract(nod1, nod2)
 
     # edge length loss
-    edge_length = tf.reduce_sum(tf.square(edge), 1)
+    edge_length = tf.reduce_sum(tf.square(edge), -1)
     edge_loss = tf.reduce_mean(edge_length) * 300
 
     # chamfer distance
-    dist1, idx1, dist2, idx2 = nn_distance(gt_pt, pred)
+    dist1, idx1, dist2, idx2 = batch_nn_distance(gt_pt, pred)
+    # Padded ground truth points repeat real ones and only reweight the gt to pred term
+    if gt_mask is not None:
+        dist1 = dist1 * gt_mask * tf.cast(tf.size(dist1), tf.float32) / \
+            tf.maximum(tf.reduce_sum(gt_mask), 1.0)
     point_loss = (chamfer_block_loss_metrics[block_id-1][0] * tf.reduce_mean(dist1)
                   + chamfer_block_loss_metrics[block_id-1][1] * tf.reduce_mean(dist2)) * 3000
 
     # normal cosine loss
-    normal = tf.gather(gt_nm, tf.squeeze(idx2, 0))
-    normal = tf.gather(normal, placeholders['edges'][block_id - 1][:, 0])
-    cosine = tf.abs(tf.reduce_sum(tf.multiply(unit(normal), unit(edge)), 1))
+    normal = tf.batch_gather(gt_nm, idx2)
+    normal = tf.gather(normal, placeholders['edges'][block_id - 1][:, 0], axis=1)
+    cosine = tf.abs(tf.reduce_sum(tf.multiply(unit(normal), unit(edge)), -1))
     normal_loss = tf.reduce_mean(cosine) * 0.5
 
     total_loss = point_loss + edge_loss + normal_loss
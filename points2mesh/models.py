@@ -7,11 +7,13 @@ import cv2
 from sampler import wrs_downsample_ids, downsample_by_id
 
 from tensorpack import *
-from flex_conv_layers import flex_convolution, flex_pooling, knn_bruteforce
+from flex_conv_layers import flex_convolution, flex_pooling, knn_bruteforce, knn_neighborhood
 from layers import *
 from losses import *
 
 from fetcher import *
+from ellipsoid import load_template
+from support_plan import read_plan, support_to_tensor
 
 enable_argscope_for_module(tf.layers)
 
@@ -21,7 +23,7 @@ FLAGS = flags.FLAGS
 
 class FlexmeshModel(ModelDesc):
     def __init__(self, PC, **kwargs):
-        allowed_kwargs = {'name', 'logging'}
+        allowed_kwargs = {'name', 'logging', 'stages'}
         for kwarg in kwargs.keys():
             assert kwarg in allowed_kwargs, 'Invalid keyword argument: ' + kwarg
         name = kwargs.get('name')
@@ -31,6 +33,9 @@ class FlexmeshModel(ModelDesc):
         self.name = name
         logging = kwargs.get('logging', False)
         self.logging = logging
+        # Number of deformation blocks built, meshes of 156, 618 and 2466 vertices
+        self.stages = kwargs.get('stages', 3)
+        assert self.stages in [1, 2, 3], 'stages must be 1, 2 or 3'
 
         self.vars = {}
         self.placeholders = {}
@@ -43,6 +48,8 @@ class FlexmeshModel(ModelDesc):
         self.output3 = None
         self.output_stage_1 = None
         self.output_stage_2 = None
+        # Activation indices of output1 and output2
+        self.stage_ends = [28, 56]
 
         self.loss = 0
         self.cost = 0
@@ -52,20 +59,29 @@ class FlexmeshModel(ModelDesc):
         self.PC = PC
 
     def inputs(self):
-        return [tf.placeholder(tf.float32, (None, self.PC['dp'], self.PC['num']), "positions"),
-                tf.placeholder(
-                    tf.float32, (None, self.PC['dp'], self.PC['gt']), "vertex_normals"),
-                tf.placeholder(
-                    tf.float32, (None, self.PC['dp'], self.PC['gt']), "gt_positions"),
-                ]
-
-    def build_graph(self, positions, vertex_normals, gt_positions):
+        inputs = [tf.placeholder(tf.float32, (None, self.PC['dp'], self.PC['num']), "positions"),
+                  tf.placeholder(
+                      tf.float32, (None, self.PC['dp'], self.PC['gt']), "vertex_normals"),
+                  tf.placeholder(
+                      tf.float32, (None, self.PC['dp'], self.PC['gt']), "gt_positions"),
+                  ]
+        # Padded batches of varying size, see PointCloudDataFlow.PaddedBatchData
+        # PC['num'] and PC['gt'] may be None then
+        if self.PC.get('masked', False):
+            inputs += [tf.placeholder(tf.float32, (None, self.PC['num']), "positions_mask"),
+                       tf.placeholder(tf.float32, (None, self.PC['gt']), "gt_mask")]
+        return inputs
+
+    def build_graph(self, positions, vertex_normals, gt_positions, positions_mask=None, gt_mask=None):
         self.load_ellipsoid_as_tensor()
-        self.input = self.placeholders["features"]
+        # Every sample of the batch deforms its own copy of the base mesh.
+        # Mesh features are vertex-major [N, B, F], see GraphConvolution
+        self.input = tf.tile(tf.expand_dims(self.placeholders["features"], 1),
+                             [1, tf.shape(positions)[0], 1])
 
         # Build graphs
         with tf.variable_scope("pointcloud_features"):
-            self.cost += self.build_flex_graph(positions)
+            self.cost += self.build_flex_graph(positions, positions_mask)
 
         self.build_gcn_graph(positions)
 
@@ -87,50 +103,70 @@ class FlexmeshModel(ModelDesc):
                 if idx in eltwise:
                     hidden = tf.add(hidden, self.activations[-2]) * 0.5
                 if idx in concat:
-                    hidden = tf.concat([hidden, self.activations[-2]], 1)
+                    hidden = tf.concat([hidden, self.activations[-2]], -1)
                 self.activations.append(hidden)
 
         with tf.name_scope("mesh_outputs"):
             # define outputs for multi stage mesh views
+            # Named outputs are batch-major [B, N, 3]
             # self.output1 = tf.identity(self.activations[15],name="output1")
-            self.output1 = tf.identity(self.activations[28], name="output1")
-            unpool_layer = GraphPooling(
-                placeholders=self.placeholders, gt_pt=positions, pool_id=1)
-            self.output_stage_1 = unpool_layer(self.output1)
+            self.output1 = self.activations[self.stage_ends[0]]
+            tf.transpose(self.output1, [1, 0, 2], name="output1")
 
-            # self.output2 = tf.identity(self.activations[31],name="output2")
-            self.output2 = tf.identity(self.activations[56], name="output2")
-            unpool_layer = GraphPooling(
-                placeholders=self.placeholders, gt_pt=positions, pool_id=2)
-            self.output_stage_2 = unpool_layer(self.output2)
+            if self.stages > 1:
+                unpool_layer = GraphPooling(
+                    placeholders=self.placeholders, gt_pt=positions, pool_id=1)
+                self.output_stage_1 = unpool_layer(self.output1)
 
-            self.output3 = tf.identity(self.activations[-1], name="output3")
+                # self.output2 = tf.identity(self.activations[31],name="output2")
+                self.output2 = self.activations[self.stage_ends[1]]
+                tf.transpose(self.output2, [1, 0, 2], name="output2")
+
+            if self.stages > 2:
+                unpool_layer = GraphPooling(
+                    placeholders=self.placeholders, gt_pt=positions, pool_id=2)
+                self.output_stage_2 = unpool_layer(self.output2)
+
+                self.output3 = self.activations[-1]
+                tf.transpose(self.output3, [1, 0, 2], name="output3")
+
+            # Chamfer distance [B] of every stage to the input cloud, for early exit
+            for i, output in enumerate(self.mesh_outputs()):
+                chamfer_to_input(output, positions, positions_mask,
+                                 name="chamfer" + str(i + 1))
 
         variables = tf.get_collection(
             tf.GraphKeys.GLOBAL_VARIABLES, scope=self.name)
         self.vars = {var.name: var for var in variables}
 
         # return cost of graph
-        self.cost += self.get_loss(positions, vertex_normals, gt_positions)
+        self.cost += self.get_loss(positions, vertex_normals, gt_positions, gt_mask)
         with tf.name_scope("loss_summaries"):
             tf.summary.scalar('total_loss', self.cost)
         return self.cost
 
-    def build_flex_graph(self, positions):
-        def wrs_subsample(positions, features):
+    def build_flex_graph(self, positions, mask=None):
+        def wrs_subsample(positions, features, dist, mask):
             # weighted reservoir sampling
-            # Calculate density for each node
-            _, dist, _ = knn_bf_sym(positions, positions, K=8)
+            # Density of each node from the distances of its neighborhood
             # feed relative density to wrs subsampling
             density = tf.reduce_sum(dist, axis=2)
-            density = tf.divide(density, tf.reduce_sum(density, 1))
-            wrs_idxs = wrs_downsample_ids(
-                density, positions.shape.as_list()[2]//2)
+            # padded points never survive while there are enough real ones. They lie far away
+            # at PAD_POSITION, so they do not show up in the neighborhoods of real points
+            if mask is not None:
+                density = density * mask
+            density = tf.divide(density, tf.reduce_sum(density, 1, keepdims=True))
+            num_points = positions.shape.as_list()[2]
+            if num_points is None:
+                num_points = tf.shape(positions)[2]
+            wrs_idxs = wrs_downsample_ids(density, num_points // 2)
             # choose positions and features based on indices
             coarse_positions = downsample_by_id(positions, wrs_idxs)
             coarse_features = downsample_by_id(features, wrs_idxs)
+            if mask is not None:
+                mask = tf.batch_gather(mask, wrs_idxs)
             # return sampled positions and features
-            return coarse_positions, coarse_features
+            return coarse_positions, coarse_features, mask
 
         def subsample(x, factor=4):
             # Number of samples
@@ -140,7 +176,8 @@ class FlexmeshModel(ModelDesc):
         # Features for each point is its own position in space
         features = positions
         x = features
-        neighbors = knn_bruteforce(positions, K=8)
+        # One neighborhood search per level, shared by convolutions and subsampling
+        neighbors, dist = knn_neighborhood(positions, K=8)
         x0 = features
         # feature 0
         x = flex_convolution(x, positions, neighbors,
@@ -150,8 +187,8 @@ class FlexmeshModel(ModelDesc):
         x = flex_pooling(x, neighbors)
         x = tf.identity(x, name="flex_layer_1")
         x1 = [positions, x]
-        positions, x = wrs_subsample(positions, x)
-        neighbors = knn_bruteforce(positions, K=8)
+        positions, x, mask = wrs_subsample(positions, x, dist, mask)
+        neighbors, dist = knn_neighborhood(positions, K=8)
 
         x = flex_convolution(x, positions, neighbors,
                              FLAGS.feature_depth * 2, activation=tf.nn.relu)
@@ -161,8 +198,8 @@ class FlexmeshModel(ModelDesc):
         x = tf.identity(x, name="flex_layer_2")
 
         x2 = [positions, x]
-        positions, x = wrs_subsample(positions, x)
-        neighbors = knn_bruteforce(positions, K=8)
+        positions, x, mask = wrs_subsample(positions, x, dist, mask)
+        neighbors, dist = knn_neighborhood(positions, K=8)
 
         x = flex_convolution(x, positions, neighbors,
                              FLAGS.feature_depth * 4, activation=tf.nn.relu)
@@ -196,6 +233,8 @@ class FlexmeshModel(ModelDesc):
                                             gcn_block_id=1,
                                             placeholders=self.placeholders, logging=self.logging))
 
+        if self.stages == 1:
+            return
         # second project block
         self.layers.append(GraphProjection(placeholders=self.placeholders))
         self.layers.append(GraphPooling(placeholders=self.placeholders,
@@ -216,6 +255,8 @@ class FlexmeshModel(ModelDesc):
                                             act=lambda x: x,
                                             gcn_block_id=2,
                                             placeholders=self.placeholders, logging=self.logging))
+        if self.stages == 2:
+            return
         # third project block
         self.layers.append(GraphProjection(placeholders=self.placeholders))
         self.layers.append(GraphPooling(
@@ -236,59 +277,57 @@ class FlexmeshModel(ModelDesc):
                                             gcn_block_id=3,
                                             placeholders=self.placeholders, logging=self.logging))
 
-    def get_loss(self, positions, vertex_normals, gt_positions):
-        mesh_loss_first_block = mesh_loss(
-            self.output1, positions, gt_positions, vertex_normals, self.placeholders, 1)
-        mesh_loss_second_block = mesh_loss(
-            self.output2, positions, gt_positions, vertex_normals, self.placeholders, 2)
-        mesh_loss_third_block = mesh_loss(
-            self.output3, positions, gt_positions, vertex_normals, self.placeholders, 3)
+    def mesh_outputs(self):
+        """Vertex-major meshes [N, B, 3] of the stages built."""
+        return [self.output1, self.output2, self.output3][:self.stages]
+
+    def stage_state(self, stage):
+        """
+        Tensors the blocks after stage depend on. Feeding them runs only the later blocks.
+        """
+        end = self.stage_ends[stage - 1]
+        pc_feature = self.placeholders['pc_feature']
+        return [self.activations[end - 1], self.activations[end], pc_feature[0]] + \
+            pc_feature[1] + pc_feature[2] + pc_feature[3]
+
+    def get_loss(self, positions, vertex_normals, gt_positions, gt_mask=None):
+        outputs = self.mesh_outputs()
+        mesh_losses = [mesh_loss(output, positions, gt_positions, vertex_normals,
+                                 self.placeholders, i + 1, gt_mask)
+                       for i, output in enumerate(outputs)]
 
         #distance_loss0 = distance_density_loss(self.output1)
         #distance_loss1 = distance_density_loss(self.output2)
         #distance_loss2 = distance_density_loss(self.output3)
 
         with tf.name_scope("Mesh_loss"):
-            summary.add_tensor_summary(mesh_loss_first_block, [
-                                       'scalar'], name="mesh_loss")
-            summary.add_tensor_summary(mesh_loss_second_block, [
-                                       'scalar'], name="mesh_loss")
-            summary.add_tensor_summary(mesh_loss_third_block, [
-                                       'scalar'], name="mesh_loss")
-
-        loss = mesh_loss_first_block + \
-            mesh_loss_second_block +\
-            mesh_loss_third_block
-
-        l_loss_first = .3 * \
-            laplace_loss(self.input, self.output1, self.placeholders, 1)
-        l_loss_second = laplace_loss(
-            self.output_stage_1, self.output2, self.placeholders, 2)
-        l_loss_third = laplace_loss(
-            self.output_stage_2, self.output3, self.placeholders, 3)
+            for block_loss in mesh_losses:
+                summary.add_tensor_summary(block_loss, [
+                                           'scalar'], name="mesh_loss")
+
+        loss = tf.add_n(mesh_losses)
+
+        # Each block is compared to the unpooled output of the previous one
+        previous = [self.input, self.output_stage_1, self.output_stage_2]
+        l_losses = [laplace_loss(previous[i], output, self.placeholders, i + 1)
+                    for i, output in enumerate(outputs)]
+        l_losses[0] = .3 * l_losses[0]
 
         with tf.name_scope("laplacian_loss"):
-            summary.add_tensor_summary(
-                l_loss_first, ['scalar'], name="laplacian_loss")
-            summary.add_tensor_summary(
-                l_loss_second, ['scalar'], name="laplacian_loss")
-            summary.add_tensor_summary(
-                l_loss_third, ['scalar'], name="laplacian_loss")
+            for block_loss in l_losses:
+                summary.add_tensor_summary(
+                    block_loss, ['scalar'], name="laplacian_loss")
 
-        loss += l_loss_first + l_loss_second + l_loss_third
+        loss += tf.add_n(l_losses)
 
-        c_loss_first = 0.3*collapse_loss(self.output1)
-        c_loss_second = collapse_loss(self.output2)
-        c_loss_third = collapse_loss(self.output3)
+        c_losses = [collapse_loss(output) for output in outputs]
+        c_losses[0] = 0.3*c_losses[0]
 
         with tf.name_scope("collapse_loss"):
-            summary.add_tensor_summary(
-                c_loss_first, ['scalar'], name="collapse_loss")
-            summary.add_tensor_summary(
-                c_loss_second, ['scalar'], name="collapse_loss")
-            summary.add_tensor_summary(
-                c_loss_third, ['scalar'], name="collapse_loss")
-        loss += c_loss_first + c_loss_second + c_loss_third
+            for block_loss in c_losses:
+                summary.add_tensor_summary(
+                    block_loss, ['scalar'], name="collapse_loss")
+        loss += tf.add_n(c_losses)
 
         # t_loss = tension_loss(self.output1, positions,self.placeholders, 1)
 
@@ -302,7 +341,7 @@ class FlexmeshModel(ModelDesc):
         # GCN loss
         # conv_layers = range(1, 15) + range(17, 31) + range(33, 48)
         conv_layers = range(1, 27) + range(29, 55) + range(57, 84)
-        conv_layers = [e + 1 for e in conv_layers]
+        conv_layers = [e + 1 for e in conv_layers if e + 1 < len(self.layers)]
         for layer_id in conv_layers:
             for var in self.layers[layer_id].vars.values():
                 loss += FLAGS.weight_decay * tf.nn.l2_loss(var)
@@ -320,39 +359,40 @@ class FlexmeshModel(ModelDesc):
         print("Model restored from file: %s" % save_path)
 
     def load_ellipsoid_as_tensor(self):
-        pkl = pickle.load(open(FLAGS.base_model_path, 'rb'))
-        coord = pkl[0]
-        pool_idx = pkl[4]
-        faces = pkl[5]
-        lape_idx = pkl[7]
-        edges = []
+        # Cached per process, see ellipsoid.load_template
+        template = load_template(FLAGS.base_model_path)
         #coord = self.normalize_coord(coord)
-        # 156 vertices
-        for i in range(1, 4):
-            adj = pkl[i][1]
-            edges.append(adj[0])
-        for i in range(0, 3):
-            lape_idx[i] = np.array(lape_idx[i])
-            lape_idx[i][lape_idx[i] == -1] = np.max(lape_idx[i]) + 1
-
-        # Define tensors based on loaded pkl object
+
+        # Define tensors based on loaded template
         self.placeholders["features"] = tf.convert_to_tensor(
-            coord, dtype=tf.float32)
+            template['coord'], dtype=tf.float32)
         self.placeholders["support1"] = [
-            self.convert_support_to_tensor(s) for s in pkl[1]]
+            self.convert_support_to_tensor(s) for s in template['supports'][0]]
         self.placeholders["support2"] = [
-            self.convert_support_to_tensor(s) for s in pkl[2]]
+            self.convert_support_to_tensor(s) for s in template['supports'][1]]
         self.placeholders["support3"] = [
-            self.convert_support_to_tensor(s) for s in pkl[3]]
+            self.convert_support_to_tensor(s) for s in template['supports'][2]]
+        # Fastest representation per level and output features of the graph convolutions,
+        # from the plan benchmarked offline by support_plan.py
+        output_dims = sorted(set([FLAGS.hidden, FLAGS.coord_dim]))
+        formats = [read_plan(FLAGS.base_model_path, template['combined_supports'],
+                             FLAGS.batch_size * output_dim) for output_dim in output_dims]
+        for i, combined in enumerate(template['combined_supports']):
+            tensors = {}
+            for fmt in set(level_formats[i] for level_formats in formats):
+                tensors[fmt] = support_to_tensor(combined, fmt)
+            self.placeholders["combined_support" + str(i + 1)] = dict(
+                (output_dim, tensors[level_formats[i]])
+                for output_dim, level_formats in zip(output_dims, formats))
         # Not used
         # self.placeholders["faces"] = [
-        #   tf.convert_to_tensor(f, dtype=tf.int32) for f in faces]
+        #   tf.convert_to_tensor(f, dtype=tf.int32) for f in template['faces']]
         self.placeholders["edges"] = [
-            tf.convert_to_tensor(e, dtype=tf.int32) for e in edges]
+            tf.convert_to_tensor(e, dtype=tf.int32) for e in template['edges']]
         self.placeholders["lape_idx"] = [
-            tf.convert_to_tensor(l, dtype=tf.int32) for l in lape_idx]
+            tf.convert_to_tensor(l, dtype=tf.int32) for l in template['lape_idx']]
         self.placeholders["pool_idx"] = [
-            tf.convert_to_tensor(p, dtype=tf.int32) for p in pool_idx]
+            tf.convert_to_tensor(p, dtype=tf.int32) for p in template['pool_idx']]
 
         logger.info("Loaded Basic Shape into Graph context")
 
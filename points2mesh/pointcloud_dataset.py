@@ -0,0 +1,158 @@
+import time
+import argparse
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+from tensorpack.utils import logger
+
+from PointCloudDataFlow import (
+    get_modelnet_records, augment_batch, SAMPLING_METHODS, GT_SAMPLING_METHODS)
+
+
+def get_modelnet_dataset(
+    name, batch_size=6,
+    num_points=10000,
+    gt_points=10000,
+    gt_sampling="random",
+    parallel=None,
+    model_ver="40",
+    shuffle=False,
+    normals=False,
+    noise_level=0.00,
+    storage="lmdb",
+    sampling="first",
+    rotate=False,
+    scale_level=0.0,
+    dropout_ratio=0.0,
+    prefetch=4,
+    repeat=True,
+    seed=None,
+    shard_index=0,
+    num_shards=1
+):
+    """
+    tf.data counterpart of PointCloudDataFlow.get_modelnet_dataflow reading from the same record store.
+    Records are read and subsampled by a parallel map, batched, augmented with augment_batch
+    and prefetched inside the TensorFlow runtime, so no Python queue sits between data and training step.
+    Elements are (positions [B, 3, num_points], vertex_normals [B, 3, gt_points],
+    gt_positions [B, 3, gt_points]) matching FlexmeshModel.inputs(). Use with tensorpack's TFDatasetInput.
+
+    See get_modelnet_dataflow for the meaning of the shared arguments.
+
+    :param gt_points: Number of ground truth points per object. Subsampled from the stored points if fewer
+    :param gt_sampling: How gt_points ground truth points are drawn. String in {'random', 'stratified', 'fps'}
+    :param parallel: Number of parallel calls reading and subsampling records
+    :param prefetch: Number of batches to prefetch
+    :param repeat: Wether to repeat the data set indefinitely
+    :param seed: Seed of shuffling, subsampling and augmentation. Needs to be the same for all shards
+    :param shard_index: Index of the shard of records to read. In [0, num_shards)
+    :param num_shards: Number of disjoint shards every epoch is split into
+    :return: tf.data.Dataset object
+    """
+    assert batch_size > 0
+    assert sampling in SAMPLING_METHODS
+    assert gt_sampling in GT_SAMPLING_METHODS
+    assert 0 <= shard_index < num_shards
+    assert num_shards == 1 or not shuffle or seed is not None, \
+        "All shards need the same seed to be disjoint"
+
+    if parallel is None:
+        parallel = min(40, multiprocessing.cpu_count() // 2)
+        logger.info("Using " + str(parallel) + " parallel calls")
+
+    records = get_modelnet_records(name, model_ver=model_ver, normals=normals,
+                                   storage=storage)
+    records.reset_state()
+    num_records = len(records)
+    stored_points = records.get(0)[1].shape[1]
+    assert num_points <= stored_points and gt_points <= stored_points
+    # RandomState serializes concurrent calls, so all map threads can share it
+    rng = np.random.RandomState(seed)
+    sample = SAMPLING_METHODS[sampling]
+    sample_gt = GT_SAMPLING_METHODS[gt_sampling]
+
+    def read(idx):
+        _, positions, vertex_normals = records.get(idx)
+        sampled = sample(positions, num_points, rng=rng)
+        if gt_points < stored_points:
+            gt_idx = sample_gt(positions, gt_points, rng=rng)
+            positions, vertex_normals = positions[:, gt_idx], vertex_normals[:, gt_idx]
+        return [np.asarray(x, dtype=np.float32) for x in [sampled, vertex_normals, positions]]
+
+    def augment(positions, vertex_normals, gt_positions):
+        # Tensors handed to py_func may be read-only, augment_batch works in place on positions
+        return augment_batch(np.array(positions), vertex_normals, gt_positions, rng,
+                             noise_level=noise_level, rotate=rotate,
+                             scale_level=scale_level, dropout_ratio=dropout_ratio)
+
+    normal_dim = 3 if normals else 0
+
+    def read_op(idx):
+        positions, vertex_normals, gt_positions = tf.py_func(
+            read, [idx], [tf.float32] * 3, stateful=True)
+        positions.set_shape([3, num_points])
+        vertex_normals.set_shape([normal_dim, gt_points])
+        gt_positions.set_shape([3, gt_points])
+        return positions, vertex_normals, gt_positions
+
+    def augment_op(positions, vertex_normals, gt_positions):
+        outputs = tf.py_func(augment, [positions, vertex_normals, gt_positions],
+                             [tf.float32] * 3, stateful=True)
+        for output, source in zip(outputs, [positions, vertex_normals, gt_positions]):
+            output.set_shape(source.shape)
+        return tuple(outputs)
+
+    ds = tf.data.Dataset.range(num_records)
+    if shuffle:
+        ds = ds.shuffle(num_records, seed=seed, reshuffle_each_iteration=True)
+    if num_shards > 1:
+        # Shards take every num_shards-th record of the same permutation
+        ds = ds.shard(num_shards, shard_index)
+    if repeat:
+        ds = ds.repeat()
+    ds = ds.map(read_op, num_parallel_calls=parallel)
+    ds = ds.batch(batch_size, drop_remainder=True)
+    if noise_level > 0 or rotate or scale_level > 0 or dropout_ratio > 0:
+        ds = ds.map(augment_op, num_parallel_calls=2)
+    ds = ds.prefetch(prefetch)
+    return ds
+
+
+def measure_input_rate(ds, num_batches=500, warmup=20):
+    """
+    Measures how fast a data set produces batches, without any model attached.
+
+    :param ds: tf.data.Dataset object producing batches
+    :param num_batches: Number of timed batches
+    :param warmup: Number of batches fetched before timing starts
+    :return: Batches per second
+    """
+    next_batch = ds.make_one_shot_iterator().get_next()
+    with tf.Session() as sess:
+        for _ in range(warmup):
+            sess.run(next_batch)
+        start = time.time()
+        for _ in range(num_batches):
+            sess.run(next_batch)
+        elapsed = time.time() - start
+    return num_batches / elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure the input rate of the tf.data pipeline')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--num_points', type=int, default=1024)
+    parser.add_argument('--parallel', type=int, default=None)
+    parser.add_argument('--storage', default='lmdb', choices=['lmdb', 'shards'])
+    parser.add_argument('--sampling', default='first',
+                        choices=sorted(SAMPLING_METHODS.keys()))
+    parser.add_argument('--normals', action='store_true')
+    args = parser.parse_args()
+
+    ds = get_modelnet_dataset('train', batch_size=args.batch_size, num_points=args.num_points,
+                              parallel=args.parallel, shuffle=True, normals=args.normals,
+                              storage=args.storage, sampling=args.sampling)
+    rate = measure_input_rate(ds)
+    logger.info("%.2f batches/sec, %.2f samples/sec" % (rate, rate * args.batch_size))
@@ -0,0 +1,150 @@
+"""
+Columnar shard storage for point cloud training data.
+
+A shard directory holds
+    meta.json                   - number of records, records per shard, points per record, normals
+    labels.npy                  - int32 [num_records]
+    positions-{shard:05d}.npy   - float32 [records_per_shard, 3, num_points]
+    normals-{shard:05d}.npy     - float32 [records_per_shard, 3, num_points] (only if normals are stored)
+
+Each record has a fixed stride inside its shard, so the reader can memory-map the shards and hand out
+views of single records without deserializing or copying them.
+All dataflow workers mapping the same files share the pages in the OS page cache.
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from tensorpack.dataflow import RNGDataFlow
+from tensorpack.dataflow.serialize import LMDBSerializer
+from tensorpack.utils import logger
+
+
+def _shard_path(directory, column, shard):
+    return os.path.join(directory, "%s-%05d.npy" % (column, shard))
+
+
+def convert_lmdb_to_shards(lmdb_path, directory, records_per_shard=1024):
+    """
+    Converts an lmdb file of [label, array(3 or 6, num_points)] records written by LMDBSerializer
+    into a shard directory readable by ShardData.
+
+    :param lmdb_path: Path to the lmdb file
+    :param directory: Output shard directory. Created if it does not exist
+    :param records_per_shard: Number of records per shard file
+    """
+    assert records_per_shard > 0
+    df = LMDBSerializer.load(lmdb_path, shuffle=False)
+    df.reset_state()
+    num_records = len(df)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    labels = np.empty([num_records], dtype=np.int32)
+    columns = {}
+    has_normals = False
+    num_points = 0
+    for idx, dp in enumerate(df):
+        data = np.asarray(dp[1], dtype=np.float32)
+        shard, slot = divmod(idx, records_per_shard)
+        if slot == 0:
+            if idx == 0:
+                has_normals = data.shape[0] == 6
+                num_points = data.shape[1]
+            for column in columns.values():
+                column.flush()
+            shape = (min(records_per_shard, num_records - idx), 3, num_points)
+            columns = {'positions': open_memmap(_shard_path(directory, 'positions', shard),
+                                                mode='w+', dtype=np.float32, shape=shape)}
+            if has_normals:
+                columns['normals'] = open_memmap(_shard_path(directory, 'normals', shard),
+                                                 mode='w+', dtype=np.float32, shape=shape)
+        assert data.shape[1] == num_points, "All records need the same number of points"
+        columns['positions'][slot] = data[:3]
+        if has_normals:
+            columns['normals'][slot] = data[3:6]
+        labels[idx] = dp[0]
+    for column in columns.values():
+        column.flush()
+
+    np.save(os.path.join(directory, "labels.npy"), labels)
+    with open(os.path.join(directory, "meta.json"), 'w') as f:
+        json.dump({'num_records': num_records,
+                   'records_per_shard': records_per_shard,
+                   'num_points': num_points,
+                   'normals': has_normals}, f)
+    logger.info("Wrote " + str(num_records) + " records to " + directory)
+
+
+class ShardData(RNGDataFlow):
+    """
+    Reads records from a shard directory written by convert_lmdb_to_shards.
+    Produces datapoints [label, positions, normals] where positions and normals are read-only
+    [3, num_points] views into the memory-mapped shards. normals has shape [0, num_points]
+    if the shards were written without normals.
+    """
+
+    def __init__(self, directory, categories=None, shuffle=False):
+        """
+        :param directory: Shard directory
+        :param categories: List of category ids to read. All records are read if None
+        :param shuffle: Wether to shuffle the records every epoch
+        """
+        self._directory = directory
+        self._shuffle = shuffle
+        with open(os.path.join(directory, "meta.json"), 'r') as f:
+            self._meta = json.load(f)
+        self._labels = np.load(os.path.join(directory, "labels.npy"))
+        if categories is None:
+            self.indices = np.arange(len(self._labels))
+        else:
+            self.indices = np.flatnonzero(np.isin(self._labels, categories))
+
+    def reset_state(self):
+        super(ShardData, self).reset_state()
+        # Map the files after forking, every worker gets its own mapping of the shared pages
+        num_shards = -(-self._meta['num_records'] // self._meta['records_per_shard'])
+        self._positions = [np.load(_shard_path(self._directory, 'positions', s), mmap_mode='r')
+                           for s in range(num_shards)]
+        if self._meta['normals']:
+            self._normals = [np.load(_shard_path(self._directory, 'normals', s), mmap_mode='r')
+                             for s in range(num_shards)]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _record(self, idx):
+        shard, slot = divmod(idx, self._meta['records_per_shard'])
+        positions = self._positions[shard][slot]
+        if self._meta['normals']:
+            normals = self._normals[shard][slot]
+        else:
+            normals = positions[:0]
+        return [self._labels[idx], positions, normals]
+
+    def get(self, idx):
+        """
+        Random access to the idx-th selected record. Safe to call from several threads.
+        """
+        return self._record(self.indices[idx])
+
+    def __iter__(self):
+        indices = self.indices.copy()
+        if self._shuffle:
+            self.rng.shuffle(indices)
+        for idx in indices:
+            yield self._record(idx)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a point cloud lmdb file into memory-mapped shards')
+    parser.add_argument('lmdb', help='path to lmdb file')
+    parser.add_argument('output', help='output shard directory')
+    parser.add_argument('--records_per_shard', type=int, default=1024)
+    args = parser.parse_args()
+
+    convert_lmdb_to_shards(args.lmdb, args.output, args.records_per_shard)
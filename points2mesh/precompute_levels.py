@@ -0,0 +1,179 @@
+"""
+Offline precomputation of the multi-level subsampling done online by Idiss_df.WRSDataFlow.
+
+Without augmentation the levels, neighborhoods and subsample indices of a record only depend on the
+record and the random draw. This stage computes several draws per record for a fixed
+sample_sizes / neighborhood_sizes schedule and stores them next to the points of a shard directory
+written by pointcloud_shards.py, so training only reads them.
+
+A levels directory <shard directory>/levels-<name> holds
+    meta.json                   - schedule, number of draws, dtypes and shapes of the components
+    component-{idx:02d}.npy     - [num_records, draws, ...] for every component of compute_levels
+
+Example:
+    python precompute_levels.py model40-train-10000.shards --sample_sizes 10000,1024,256 \
+        --neighborhood_sizes 8 --draws 4
+"""
+
+import os
+import json
+import argparse
+import multiprocessing
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from tensorpack.dataflow import RNGDataFlow
+from tensorpack.utils import logger
+
+from Idiss_df import compute_levels
+from pointcloud_shards import ShardData
+
+
+def _levels_path(directory, name):
+    return os.path.join(directory, "levels-" + name)
+
+
+_worker_records = None
+
+
+def _init_worker(directory):
+    global _worker_records
+    _worker_records = ShardData(directory)
+    _worker_records.reset_state()
+
+
+def _compute_record(task):
+    idx, draws, sample_sizes, neighborhood_sizes, global_density, seed = task
+    _, positions, normals = _worker_records.get(idx)
+    location = np.asarray(positions).T
+    # Records without normals use their positions as features
+    feature = np.asarray(normals if len(normals) else positions).T
+    rng = np.random.RandomState(seed + idx)
+    return [compute_levels(location, feature, sample_sizes, neighborhood_sizes, rng,
+                           global_density=global_density)
+            for _ in range(draws)]
+
+
+def precompute_levels(directory, sample_sizes, neighborhood_sizes, draws=4, name="default",
+                      global_density=False, parallel=None, seed=0):
+    """
+    Computes draws random multi-level subsamplings for every record of a shard directory.
+
+    :param directory: Shard directory written by convert_lmdb_to_shards
+    :param sample_sizes: Number of points per level
+    :param neighborhood_sizes: Neighborhood size per level, or one size for all levels
+    :param draws: Number of random draws stored per record
+    :param name: Name of the levels directory, to keep several schedules next to each other
+    :param global_density: See WRSDataFlow
+    :param parallel: Number of worker processes
+    :param seed: Seed of the draws
+    """
+    if not isinstance(neighborhood_sizes, list):
+        neighborhood_sizes = [neighborhood_sizes] * len(sample_sizes)
+    assert len(neighborhood_sizes) == len(sample_sizes)
+    num_records = len(ShardData(directory))
+    if num_records == 0:
+        raise ValueError("No records to precompute in " + directory)
+    output = _levels_path(directory, name)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+
+    tasks = [(idx, draws, sample_sizes, neighborhood_sizes, global_density, seed)
+             for idx in range(num_records)]
+    pool = multiprocessing.Pool(parallel or multiprocessing.cpu_count(),
+                                initializer=_init_worker, initargs=(directory,))
+    components = None
+    try:
+        for idx, record in enumerate(pool.imap(_compute_record, tasks, chunksize=4)):
+            if components is None:
+                # Shapes are fixed by the schedule, the first record defines them
+                components = [open_memmap(os.path.join(output, "component-%02d.npy" % c),
+                                          mode='w+', dtype=x.dtype,
+                                          shape=(num_records, draws) + x.shape)
+                              for c, x in enumerate(record[0])]
+            for d, levels in enumerate(record):
+                for component, x in zip(components, levels):
+                    component[idx, d] = x
+            if (idx + 1) % 1000 == 0:
+                logger.info("Precomputed " + str(idx + 1) + " of " + str(num_records) + " records")
+    finally:
+        pool.terminate()
+    for component in components:
+        component.flush()
+
+    with open(os.path.join(output, "meta.json"), 'w') as f:
+        json.dump({'sample_sizes': list(sample_sizes),
+                   'neighborhood_sizes': list(neighborhood_sizes),
+                   'global_density': global_density,
+                   'draws': draws,
+                   'num_components': len(components),
+                   'seed': seed}, f)
+    logger.info("Wrote " + str(draws) + " draws of " + str(num_records) + " records to " + output)
+
+
+class PrecomputedLevelData(RNGDataFlow):
+    """
+    Reads levels written by precompute_levels. Produces the same datapoints as WRSDataFlow,
+    as read-only views into the memory-mapped files. Every epoch one of the stored draws
+    is picked at random per record.
+    """
+
+    def __init__(self, directory, name="default", categories=None, shuffle=False):
+        """
+        :param directory: Shard directory
+        :param name: Name of the levels directory
+        :param categories: List of category ids to read. All records are read if None
+        :param shuffle: Wether to shuffle the records every epoch
+        """
+        self._output = _levels_path(directory, name)
+        self._shuffle = shuffle
+        with open(os.path.join(self._output, "meta.json"), 'r') as f:
+            self._meta = json.load(f)
+        labels = np.load(os.path.join(directory, "labels.npy"))
+        if categories is None:
+            self.indices = np.arange(len(labels))
+        else:
+            self.indices = np.flatnonzero(np.isin(labels, categories))
+
+    def reset_state(self):
+        super(PrecomputedLevelData, self).reset_state()
+        self._components = [np.load(os.path.join(self._output, "component-%02d.npy" % c),
+                                    mmap_mode='r')
+                            for c in range(self._meta['num_components'])]
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        indices = self.indices.copy()
+        if self._shuffle:
+            self.rng.shuffle(indices)
+        draws = self.rng.randint(self._meta['draws'], size=len(indices))
+        for idx, draw in zip(indices, draws):
+            yield [component[idx, draw] for component in self._components]
+
+
+def _list(value):
+    return [int(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute multi-level neighborhoods and subsample indices of a shard directory')
+    parser.add_argument('shards', help='shard directory')
+    parser.add_argument('--sample_sizes', type=_list, required=True)
+    parser.add_argument('--neighborhood_sizes', type=_list, required=True,
+                        help='one size for all levels or one per level')
+    parser.add_argument('--draws', type=int, default=4, help='random draws per record')
+    parser.add_argument('--name', default='default')
+    parser.add_argument('--global_density', action='store_true')
+    parser.add_argument('--parallel', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    neighborhood_sizes = args.neighborhood_sizes
+    if len(neighborhood_sizes) == 1:
+        neighborhood_sizes = neighborhood_sizes[0]
+    precompute_levels(args.shards, args.sample_sizes, neighborhood_sizes, draws=args.draws,
+                      name=args.name, global_density=args.global_density,
+                      parallel=args.parallel, seed=args.seed)
@@ -12,7 +12,7 @@ def wrs_downsample_ids(survive_pobability, coarse_resolution):
         ids: to downsample [B, coarse_resolution]
     '''
     B = tf.shape(survive_pobability)[0]
-    N = int(survive_pobability.shape[1])
+    N = tf.shape(survive_pobability)[1]
 
     u = tf.random_uniform([B, N])
     k = tf.pow(u, 1.0 / survive_pobability)
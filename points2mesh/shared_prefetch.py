@@ -0,0 +1,86 @@
+import ctypes
+import multiprocessing
+
+import numpy as np
+from tensorpack.dataflow import ProxyDataFlow
+from tensorpack.utils.concurrency import ensure_proc_terminate, start_proc_mask_signal
+
+
+class SharedMemoryPrefetchData(ProxyDataFlow):
+    """
+    Prefetches datapoints of fixed shape with several worker processes, like PrefetchDataZMQ,
+    but moves them through a ring buffer of preallocated shared memory slots instead of sockets.
+    Workers copy each datapoint into a free slot and only pass the slot id to the consumer,
+    which receives numpy views of the slot without any copy or pickling.
+
+    The views of a datapoint stay valid until the next datapoint is requested. Consumers that
+    keep datapoints around, e.g. BatchData, have to run inside the workers, i.e. before this dataflow.
+
+    Like PrefetchDataZMQ, every worker iterates its own copy of the incoming dataflow forever,
+    so the order of datapoints is not preserved.
+    """
+
+    def __init__(self, ds, num_proc, shapes, dtypes=None, num_slots=None):
+        """
+        :param ds: Incoming dataflow, reset in each worker
+        :param num_proc: Number of worker processes
+        :param shapes: Shape of each datapoint component
+        :param dtypes: dtype of each datapoint component. float32 if None
+        :param num_slots: Number of slots of the ring buffer. 2 * num_proc + 2 if None
+        """
+        super(SharedMemoryPrefetchData, self).__init__(ds)
+        assert num_proc > 0
+        self.num_proc = num_proc
+        self.shapes = [tuple(shape) for shape in shapes]
+        if dtypes is None:
+            dtypes = [np.float32] * len(shapes)
+        assert len(dtypes) == len(shapes)
+        self.dtypes = [np.dtype(dtype) for dtype in dtypes]
+        self.num_slots = num_slots or 2 * num_proc + 2
+        self._procs = None
+
+    def reset_state(self):
+        # The incoming dataflow is only reset inside the workers
+        if self._procs is not None:
+            return
+        # One shared buffer per component holding that component for all slots
+        self._slots = []
+        for shape, dtype in zip(self.shapes, self.dtypes):
+            nbytes = self.num_slots * int(np.prod(shape)) * dtype.itemsize
+            buf = multiprocessing.RawArray(ctypes.c_byte, nbytes)
+            self._slots.append(np.frombuffer(buf, dtype=dtype).reshape((self.num_slots,) + shape))
+
+        self._free = multiprocessing.Queue()
+        for slot in range(self.num_slots):
+            self._free.put(slot)
+        self._full = multiprocessing.Queue()
+        self._current = None
+
+        self._procs = [multiprocessing.Process(target=self._work) for _ in range(self.num_proc)]
+        for proc in self._procs:
+            proc.daemon = True
+        ensure_proc_terminate(self._procs)
+        start_proc_mask_signal(self._procs)
+
+    def _work(self):
+        self.ds.reset_state()
+        while True:
+            for dp in self.ds:
+                assert len(dp) == len(self._slots), \
+                    "Datapoint has %i components, expected %i" % (len(dp), len(self._slots))
+                slot = self._free.get()
+                for component, slots in zip(dp, self._slots):
+                    component = np.asarray(component)
+                    assert component.shape == slots.shape[1:], \
+                        "Component of shape %s does not fit slot of shape %s" % (
+                            component.shape, slots.shape[1:])
+                    slots[slot] = component
+                self._full.put(slot)
+
+    def __iter__(self):
+        for _ in range(len(self.ds)):
+            # Hand back the slot of the previous datapoint
+            if self._current is not None:
+                self._free.put(self._current)
+            self._current = self._full.get()
+            yield [slots[self._current] for slots in self._slots]
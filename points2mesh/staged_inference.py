@@ -0,0 +1,81 @@
+"""
+Inference up to a chosen deformation stage, with optional early exit.
+
+load_predictor builds the graph only up to the requested stage, so a coarse 156 or 618 vertex
+mesh costs a fraction of the full network.
+
+AdaptivePredictor builds all stages but runs them one at a time. After every stage it reads the
+chamfer distance of the meshes to their input clouds and stops once it is below a threshold for
+all samples of the batch. The next stage is run by feeding back the tensors it depends on
+(FlexmeshModel.stage_state), so the encoder and earlier blocks are not computed again.
+"""
+
+import numpy as np
+from tensorpack import PredictConfig, OfflinePredictor, get_model_loader
+
+from models import FlexmeshModel
+
+
+def stage_output_names(stages):
+    return ['mesh_outputs/output' + str(stage) for stage in range(1, stages + 1)]
+
+
+def load_predictor(checkpoint, PC, stages=3):
+    """
+    :param checkpoint: Path of the checkpoint
+    :param PC: Point cloud settings as in train.py
+    :param stages: Last deformation stage built, 1, 2 or 3
+    :return: OfflinePredictor returning the meshes [B, N, 3] of all stages up to stages
+    """
+    prediction = PredictConfig(
+        session_init=get_model_loader(checkpoint),
+        model=FlexmeshModel(PC, name="Flexmesh", stages=stages),
+        input_names=['positions'],
+        output_names=stage_output_names(stages))
+    return OfflinePredictor(prediction)
+
+
+class AdaptivePredictor(object):
+    """
+    Runs the deformation stages one after another and stops after the first stage
+    whose chamfer distance to the input cloud is below threshold for every sample.
+    """
+
+    def __init__(self, checkpoint, PC, threshold, stages=3):
+        """
+        :param checkpoint: Path of the checkpoint
+        :param PC: Point cloud settings as in train.py
+        :param threshold: Chamfer distance to the input cloud that is good enough
+        :param stages: Last deformation stage run
+        """
+        self.model = FlexmeshModel(PC, name="Flexmesh", stages=stages)
+        self.predictor = OfflinePredictor(PredictConfig(
+            session_init=get_model_loader(checkpoint),
+            model=self.model,
+            input_names=['positions'],
+            output_names=stage_output_names(stages)))
+        self.threshold = threshold
+        self.stages = stages
+        self.chamfers = [self.predictor.graph.get_tensor_by_name(
+            'mesh_outputs/chamfer%i:0' % stage) for stage in range(1, stages + 1)]
+
+    def __call__(self, positions):
+        """
+        :param positions: Point clouds [B, 3, N]
+        :return: List of the meshes [B, N_i, 3] of the stages run and the chamfer distances [B]
+         of the last one
+        """
+        positions_tensor = self.predictor.input_tensors[0]
+        feed = {positions_tensor: positions}
+        meshes = []
+        for stage in range(1, self.stages + 1):
+            state = self.model.stage_state(stage) if stage < self.stages else []
+            mesh, chamfer, values = self.predictor.sess.run(
+                [self.predictor.output_tensors[stage - 1], self.chamfers[stage - 1], state],
+                feed_dict=feed)
+            meshes.append(mesh)
+            if np.max(chamfer) < self.threshold:
+                break
+            feed = dict(zip(state, values))
+            feed[positions_tensor] = positions
+        return meshes, chamfer
@@ -0,0 +1,253 @@
+"""
+Chooses how the support matrix of every mesh level is multiplied in the graph convolutions.
+
+The levels are small and fixed, so the generic sparse product is not always the fastest.
+Three representations of a support [N, M] are compared:
+    sparse  - tf.SparseTensor and sparse_tensor_dense_matmul
+    dense   - a dense [N, M] matrix and matmul, only for small levels
+    ell     - fixed neighbor width W, indices and values [N, W], a gather and a weighted sum
+
+get_plan times the forward and backward product of every level in a throwaway graph and stores
+the fastest representation in a JSON plan next to the template. Benchmarking opens its own session,
+which would fix the process-wide GPU allocator options before the trainer's session, so it is an
+offline step. Building the model only reads the plan with read_plan, levels not found in it use
+the sparse product.
+Plans are keyed by level size, product width, TensorFlow version, host and visible GPUs. The width
+is the batch size times the output features of a graph convolution, hidden or coord_dim.
+
+Example, batch size 1 with 192 hidden and 3 output features:
+    python support_plan.py utils/ellipsoid/info_ellipsoid.dat --num_cols 192 3
+"""
+
+import os
+import json
+import timeit
+import argparse
+import platform
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+from tensorpack.utils import logger
+
+from ellipsoid import load_template
+
+FORMATS = ['sparse', 'dense', 'ell']
+
+# Largest dense support considered, in elements
+MAX_DENSE_SIZE = 2 ** 22
+
+EllMatrix = namedtuple('EllMatrix', ['indices', 'values'])
+
+
+def ell_support(indices, values, shape):
+    """
+    Converts a support into ELL format with the width of its fullest row.
+    Padding entries point to column 0 with value 0.
+
+    :param indices: Row-major COO indices [nnz, 2]
+    :param values: Values [nnz]
+    :param shape: Dense shape [N, M]
+    :return: Indices [N, W] int32 and values [N, W] float32
+    """
+    rows = indices[:, 0]
+    counts = np.bincount(rows, minlength=shape[0])
+    width = max(int(counts.max()), 1)
+    # Position of every entry within its row
+    slots = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    ell_indices = np.zeros([shape[0], width], dtype=np.int32)
+    ell_values = np.zeros([shape[0], width], dtype=np.float32)
+    ell_indices[rows, slots] = indices[:, 1]
+    ell_values[rows, slots] = values
+    return ell_indices, ell_values
+
+
+def support_to_tensor(support, fmt):
+    """
+    :param support: (indices, values, shape) of a support
+    :param fmt: One of FORMATS
+    :return: tf.SparseTensor, dense tf.Tensor or EllMatrix
+    """
+    indices, values, shape = support
+    if fmt == 'sparse':
+        return tf.SparseTensor(indices=tf.convert_to_tensor(indices, dtype=tf.int64),
+                               values=tf.convert_to_tensor(values, dtype=tf.float32),
+                               dense_shape=tf.convert_to_tensor(shape, dtype=tf.int64))
+    if fmt == 'dense':
+        dense = np.zeros(shape, dtype=np.float32)
+        dense[indices[:, 0], indices[:, 1]] = values
+        return tf.convert_to_tensor(dense)
+    if fmt == 'ell':
+        ell_indices, ell_values = ell_support(indices, values, shape)
+        return EllMatrix(tf.convert_to_tensor(ell_indices), tf.convert_to_tensor(ell_values))
+    raise ValueError("Unknown support format " + str(fmt))
+
+
+def support_matmul(support, y):
+    """
+    Multiplies a support in any of the FORMATS with a dense matrix.
+
+    :param support: tf.SparseTensor, dense tf.Tensor or EllMatrix [N, M]
+    :param y: Dense matrix [M, C]
+    :return: [N, C]
+    """
+    if isinstance(support, tf.SparseTensor):
+        return tf.sparse_tensor_dense_matmul(support, y)
+    if isinstance(support, EllMatrix):
+        neighbors = tf.gather(y, support.indices)
+        return tf.reduce_sum(neighbors * tf.expand_dims(support.values, -1), 1)
+    return tf.matmul(support, y)
+
+
+def _candidates(shape):
+    return [fmt for fmt in FORMATS
+            if fmt != 'dense' or int(shape[0]) * int(shape[1]) <= MAX_DENSE_SIZE]
+
+
+def benchmark_support(support, num_cols, iterations=20):
+    """
+    Times the forward and backward product of a support with a [M, num_cols] matrix
+    for every candidate format, in a separate graph and session.
+
+    :param support: (indices, values, shape) of a support
+    :param num_cols: Width of the dense matrix, batch size times features
+    :param iterations: Timed runs per format after two warmup runs
+    :return: Dict of format to median seconds
+    """
+    timings = {}
+    shape = support[2]
+    y_init = np.random.rand(int(shape[1]), num_cols).astype(np.float32)
+    grad_init = np.random.rand(int(shape[0]), num_cols).astype(np.float32)
+    for fmt in _candidates(shape):
+        with tf.Graph().as_default():
+            y = tf.Variable(y_init)
+            out = support_matmul(support_to_tensor(support, fmt), y)
+            grad = tf.gradients(out, y, grad_ys=tf.constant(grad_init))[0]
+            step = tf.group(out, grad)
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+            with tf.Session(config=config) as sess:
+                sess.run(y.initializer)
+                for _ in range(2):
+                    sess.run(step)
+                runs = []
+                for _ in range(iterations):
+                    start = timeit.default_timer()
+                    sess.run(step)
+                    runs.append(timeit.default_timer() - start)
+        timings[fmt] = float(np.median(runs))
+    return timings
+
+
+def _plan_key(support, num_cols):
+    indices, _, shape = support
+    return "%ix%i-nnz%i-cols%i-tf%s-%s-gpu%s" % (
+        shape[0], shape[1], len(indices), num_cols, tf.__version__, platform.node(),
+        os.environ.get('CUDA_VISIBLE_DEVICES', 'all'))
+
+
+def _plan_path(path):
+    return os.path.splitext(path)[0] + ".plan.json"
+
+
+def _fallback_path(plan_path):
+    return os.path.join(tempfile.gettempdir(), os.path.basename(plan_path))
+
+
+def _read_plan(path):
+    if not os.path.isfile(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        logger.warn("Ignoring unreadable support plan " + path)
+        return {}
+
+
+def _load_plan(plan_path):
+    plan = _read_plan(plan_path)
+    if not plan:
+        plan = _read_plan(_fallback_path(plan_path))
+    return plan
+
+
+def read_plan(template_path, supports, num_cols, plan_path=None):
+    """
+    Looks up the format of every support in a plan written by get_plan, without benchmarking.
+
+    :param template_path: Path of the base mesh template, the plan is stored next to it
+    :param supports: List of (indices, values, shape), one per mesh level
+    :param num_cols: Width of the products, batch size times output features
+    :param plan_path: Plan file. Next to the template if None, or in the temp directory
+    :return: List of formats, one per support. 'sparse' for supports not in the plan
+    """
+    plan_path = plan_path or _plan_path(template_path)
+    plan = _load_plan(plan_path)
+    formats = []
+    for support in supports:
+        entry = plan.get(_plan_key(support, num_cols))
+        if entry is None:
+            logger.warn("No support plan for %ix%i with %i columns, using sparse. Run "
+                        "python support_plan.py %s --num_cols %i" % (
+                            support[2][0], support[2][1], num_cols, template_path, num_cols))
+            formats.append('sparse')
+        else:
+            formats.append(entry['format'])
+    return formats
+
+
+def get_plan(template_path, supports, num_cols, plan_path=None, force=False):
+    """
+    Picks the fastest format for every support, running the microbenchmark only for
+    supports not found in the plan file. Opens TensorFlow sessions, so run it offline.
+
+    :param template_path: Path of the base mesh template, the plan is stored next to it
+    :param supports: List of (indices, values, shape), one per mesh level
+    :param num_cols: Width of the products, batch size times output features
+    :param plan_path: Plan file. Next to the template if None, or in the temp directory
+     if that location is not writable
+    :param force: Rerun the benchmark for all supports
+    :return: List of formats, one per support
+    """
+    plan_path = plan_path or _plan_path(template_path)
+    plan = _load_plan(plan_path)
+
+    formats = []
+    updated = False
+    for support in supports:
+        key = _plan_key(support, num_cols)
+        if force or key not in plan:
+            timings = benchmark_support(support, num_cols)
+            plan[key] = {'format': min(timings, key=timings.get), 'timings': timings}
+            logger.info("Support %ix%i, %i columns: %s" % (
+                support[2][0], support[2][1], num_cols, ", ".join(
+                    "%s %.3fms" % (fmt, t * 1000) for fmt, t in sorted(timings.items()))))
+            updated = True
+        formats.append(plan[key]['format'])
+
+    if updated:
+        try:
+            with open(plan_path, 'w') as f:
+                json.dump(plan, f, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            logger.warn("Cannot write support plan, " + str(e))
+            with open(_fallback_path(plan_path), 'w') as f:
+                json.dump(plan, f, indent=2, sort_keys=True)
+    return formats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the support formats of a base mesh')
+    parser.add_argument('template', help='.dat or .npz base mesh')
+    parser.add_argument('--num_cols', type=int, nargs='+', default=[192, 3],
+                        help='product widths, batch size times hidden and times coord_dim features')
+    parser.add_argument('--force', action='store_true', help='rerun cached benchmarks')
+    args = parser.parse_args()
+
+    template = load_template(args.template)
+    for num_cols in args.num_cols:
+        formats = get_plan(args.template, template['combined_supports'], num_cols, force=args.force)
+        for support, fmt in zip(template['combined_supports'], formats):
+            logger.info("%i vertices, %i columns: %s" % (support[2][0], num_cols, fmt))
@@ -4,10 +4,11 @@ import cv2
 import argparse
 import os
 from tensorpack import *
-from tensorpack.input_source import QueueInput
+from tensorpack.input_source import QueueInput, TFDatasetInput
 from tensorpack.dataflow import (PrintData, BatchData)
 
-from PointCloudDataFlow import get_modelnet_dataflow
+from PointCloudDataFlow import get_modelnet_dataflow, get_modelnet_records, GTSizeSchedule
+from pointcloud_dataset import get_modelnet_dataset
 from models import *
 from fetcher import *
 from Idiss_df import *
@@ -38,6 +39,8 @@ flags.DEFINE_integer(
 flags.DEFINE_integer('hidden', 192, 'Number of units in hidden layer')
 flags.DEFINE_float('weight_decay', 5e-6, 'Weight decay for L2 loss.')
 flags.DEFINE_float('collapse_epsilon', 0.008, 'Collapse loss epsilon')
+flags.DEFINE_float('collapse_softness', 0.0,
+                   'Width of the sigmoid replacing the collapse loss threshold, 0 keeps the hard threshold')
 flags.DEFINE_float('learning_rate', 3e-5, 'Initial learning rage.')
 flags.DEFINE_integer('pc_num', PC['num'],
                      'Number of points per pointcloud object')
@@ -47,6 +50,8 @@ flags.DEFINE_integer('feature_depth', 32,
 flags.DEFINE_integer(
     'num_neighbors', 6, 'Number of neighbors considered during Graph projection layer')
 flags.DEFINE_integer('batch_size', 1, 'Batchsize')
+flags.DEFINE_integer('knn_memory_budget', 0,
+                     'Megabytes of distance buffers for tiled brute-force knn on the CPU, 0 runs knn_bf_sym')
 flags.DEFINE_string('base_model_path', 'utils/ellipsoid/info_ellipsoid.dat',
                     'Path to base model for mesh deformation')
 #
@@ -60,8 +65,34 @@ if __name__ == '__main__':
     parser.add_argument('--gpu', help='comma separated list of GPU(s) to use.')
     parser.add_argument('--load', help='load model')
     parser.add_argument('--fusion', help='run sampling', default='')
+    parser.add_argument('--batch_size', help='number of meshes deformed per step',
+                        type=int, default=None)
+    parser.add_argument('--input', help='input pipeline feeding the model',
+                        choices=['queue', 'tfdata'], default='queue')
+    parser.add_argument('--shard_index', help='index of the data shard trained on by this process',
+                        type=int, default=0)
+    parser.add_argument('--num_shards', help='number of training processes splitting each epoch',
+                        type=int, default=1)
+    parser.add_argument('--gt_points', help='number of ground truth points per object, e.g. 2048 or 4096',
+                        type=int, default=None)
+    parser.add_argument('--gt_sampling', help='how the ground truth points are drawn',
+                        choices=['random', 'stratified', 'fps'], default='random')
+    parser.add_argument('--gt_schedule', help='raise the ground truth points during training, '
+                        'comma separated epoch:gt_points, e.g. 100:4096,120:10000', default=None)
     args = parser.parse_args()
 
+    if args.batch_size is not None:
+        FLAGS.batch_size = args.batch_size
+    gt_schedule = None
+    if args.gt_points is not None:
+        PC['gt'] = args.gt_points
+    if args.gt_schedule:
+        assert args.input == 'queue', "gt_schedule needs the dataflow input pipeline"
+        gt_schedule = [tuple(int(v) for v in entry.split(':'))
+                       for entry in args.gt_schedule.split(',')]
+        # Ground truth size changes during training
+        PC['gt'] = None
+
     if args.gpu:
         os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
     os.environ['CUDA_VISIBLE_DEVICES'] = "3"
@@ -70,21 +101,39 @@ if __name__ == '__main__':
         '/path/to/train_log/true_c1_1024_small_%s' % (args.fusion))
 
     # Loading Data
-    df_train = get_modelnet_dataflow('train', batch_size=FLAGS.batch_size,
-                                     num_points=PC["num"], model_ver=PC["ver"], shuffle=True, normals=True, prefetch_data=True, noise_level=0.0)
-    df_test = get_modelnet_dataflow('test', batch_size=2 * FLAGS.batch_size,
-                                    num_points=PC["num"], model_ver=PC["ver"], shuffle=True, normals=True, prefetch_data=True, noise_level=0.0)
-    steps_per_epoch = len(df_train)
+    if args.input == 'tfdata':
+        ds_train = get_modelnet_dataset('train', batch_size=FLAGS.batch_size, num_points=PC["num"],
+                                        gt_points=PC["gt"], gt_sampling=args.gt_sampling,
+                                        model_ver=PC["ver"], shuffle=True, normals=True,
+                                        noise_level=0.0, seed=seed,
+                                        shard_index=args.shard_index, num_shards=args.num_shards)
+        data = TFDatasetInput(ds_train)
+        steps_per_epoch = len(get_modelnet_records(
+            'train', model_ver=PC["ver"], normals=True)) // (args.num_shards * FLAGS.batch_size)
+    else:
+        df_train = get_modelnet_dataflow('train', batch_size=FLAGS.batch_size,
+                                         num_points=PC["num"], model_ver=PC["ver"], shuffle=True, normals=True, prefetch_data=True, noise_level=0.0,
+                                         shard_index=args.shard_index, num_shards=args.num_shards, seed=seed,
+                                         gt_points=args.gt_points, gt_sampling=args.gt_sampling,
+                                         gt_schedule=gt_schedule)
+        df_test = get_modelnet_dataflow('test', batch_size=2 * FLAGS.batch_size,
+                                        num_points=PC["num"], model_ver=PC["ver"], shuffle=True, normals=True, prefetch_data=True, noise_level=0.0)
+        data = QueueInput(df_train)
+        steps_per_epoch = len(df_train)
+
+    callbacks = [
+        ModelSaver(),
+        MinSaver('total_loss'),
+    ]
+    if gt_schedule is not None:
+        callbacks.append(GTSizeSchedule(df_train, gt_schedule))
 
     # Setup Model
     # Setup training step
     config = TrainConfig(
         model=FlexmeshModel(PC, name="Flexmesh"),
-        data=QueueInput(df_train),
-        callbacks=[
-            ModelSaver(),
-            MinSaver('total_loss'),
-        ],
+        data=data,
+        callbacks=callbacks,
         extra_callbacks=[
             MovingAverageSummary(),
             ProgressBar([]),